@@ -16,6 +16,5 @@
 # You should have received a copy of the GNU General Public License along with
 # Solent. If not, see <http://www.gnu.org/licenses/>.
 
-from .eng import FakeEngine
 from .eng import FakeClock
 
@@ -17,5 +17,4 @@
 # Solent. If not, see <http://www.gnu.org/licenses/>.
 
 from .fake_clock import FakeClock
-from .fake_engine import FakeEngine
 
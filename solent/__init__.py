@@ -32,6 +32,20 @@ from .base import pool_rail_class
 # log
 from .base import hexdump
 from .base import log
+from .base import log_debug
+from .base import log_warn
+from .base import log_error
+from .base import log_enabled
+from .base import set_log_level
+from .base import get_log_level
+from .base import flush_log
+from .base import log_ring_on
+from .base import log_ring_off
+from .base import get_net_logger
+from .base import LOG_DEBUG
+from .base import LOG_INFO
+from .base import LOG_WARN
+from .base import LOG_ERROR
 from .base import init_logging
 from .base import init_network_logging
 # test
@@ -40,7 +40,21 @@ from .ref import ref_release
 
 from .liblog import init_logging
 from .liblog import init_network_logging
+from .liblog import get_net_logger
 from .liblog import log
+from .liblog import log_debug
+from .liblog import log_warn
+from .liblog import log_error
+from .liblog import log_enabled
+from .liblog import set_log_level
+from .liblog import get_log_level
+from .liblog import log_ring_on
+from .liblog import log_ring_off
+from .liblog import flush_log
+from .liblog import LOG_DEBUG
+from .liblog import LOG_INFO
+from .liblog import LOG_WARN
+from .liblog import LOG_ERROR
 from .liblog import hexdump
 
 from .rail_line_finder import RailLineFinder
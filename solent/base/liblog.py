@@ -21,27 +21,150 @@
 # want to be able to broadcast logs to the network rather than write to file.
 # (yes, udp broadcast is unreliable, but for many applications it's damn
 # useful). This library includes functionality that makes that easy.
+#
+# Levels. Each line has a level, and lines below the current level are
+# dropped before any formatting happens. So on a hot path, prefer
+#     log('metasock %s closed', sid)
+# to
+#     log('metasock %s closed'%(sid))
+# The first form only formats the line if it is going to be kept. If
+# building the arguments is itself expensive, check log_enabled first.
+#
+# Ring. Once an engine exists, log does not write anything. Rather, it puts
+# the formatted line into a ring buffer, and the engine drains the ring to the
+# sink in batches as part of its turn. If the ring fills, we drop the oldest
+# lines and count them. Without an engine (scripts, tools), log writes
+# straight through to the sink as it always has.
+#
+# Sinks. The sink is where drained lines go. By default, that is python
+# logging. NetLogger is a sink that broadcasts to the network. It coalesces
+# lines into mtu-sized datagrams, never blocks, and counts what it has to
+# drop. When an engine is running, NetLogger sends through an engine pub
+# rather than through its own socket.
 
+from collections import deque
+import atexit
 import logging
 import socket
 import sys
 
+LOG_DEBUG = 10
+LOG_INFO = 20
+LOG_WARN = 30
+LOG_ERROR = 40
+
+LOG_LEVEL = LOG_INFO
+
+# Sink. Has write_lines(lines).
 LOGGER = None
 
+# Set when lines should be buffered for the engine. See log_ring_on.
+LOG_RING = None
+LOG_RING_USERS = 0
+
 def outer_exception():
     logging.exception("outer_except")
 
-def log(msg):
-    global LOGGER
+def set_log_level(level):
+    global LOG_LEVEL
+    LOG_LEVEL = level
+
+def get_log_level():
+    return LOG_LEVEL
+
+def log_enabled(level):
+    return level >= LOG_LEVEL
+
+def log(msg, *args, level=LOG_INFO):
+    if level < LOG_LEVEL:
+        return
+    if args:
+        line = msg%args
+    else:
+        line = str(msg)
+    if LOG_RING != None:
+        LOG_RING.push(line)
+        return
     if None == LOGGER:
         init_logging()
-    LOGGER(str(msg))
+    LOGGER.write_lines( (line,) )
 
-def newliney_info(msg):
-    if msg.endswith('\n'):
-        logging.info(msg[:-1])
-    else:
-        logging.info(msg)
+def log_debug(msg, *args):
+    log(msg, *args, level=LOG_DEBUG)
+
+def log_warn(msg, *args):
+    log(msg, *args, level=LOG_WARN)
+
+def log_error(msg, *args):
+    log(msg, *args, level=LOG_ERROR)
+
+class LogRing:
+    def __init__(self, capacity):
+        self.capacity = capacity
+        #
+        self.lines = deque()
+        self.drops = 0
+    def push(self, line):
+        if len(self.lines) >= self.capacity:
+            self.lines.popleft()
+            self.drops += 1
+        self.lines.append(line)
+    def take(self):
+        'Returns the buffered lines, oldest first, and empties the ring.'
+        lines = self.lines
+        self.lines = deque()
+        if self.drops:
+            lines.appendleft('[log ring dropped %s lines]'%(self.drops))
+            self.drops = 0
+        return lines
+
+def log_ring_on(capacity=8192):
+    '''
+    From now on, log buffers lines until flush_log is called. Engine does
+    this when it is created, and then flushes on each turn. Calls nest: the
+    ring stays on until each log_ring_on has had its log_ring_off.
+    '''
+    global LOG_RING
+    global LOG_RING_USERS
+    LOG_RING_USERS += 1
+    if LOG_RING != None:
+        return
+    LOG_RING = LogRing(
+        capacity=capacity)
+
+def log_ring_off():
+    global LOG_RING
+    global LOG_RING_USERS
+    if LOG_RING_USERS == 0:
+        return
+    LOG_RING_USERS -= 1
+    if LOG_RING_USERS > 0:
+        return
+    flush_log()
+    LOG_RING = None
+
+def flush_log():
+    '''
+    Hands whatever is in the ring to the sink, in one batch. Cheap when the
+    ring is empty.
+    '''
+    if LOG_RING == None or not LOG_RING.lines:
+        return
+    if None == LOGGER:
+        init_logging()
+    LOGGER.write_lines(LOG_RING.take())
+
+# If the process goes down without the engine getting a chance to flush,
+# we still want to see what it had to say.
+atexit.register(flush_log)
+
+class StdLogSink:
+    def write_lines(self, lines):
+        for line in lines:
+            if line.endswith('\n'):
+                logging.info(line[:-1])
+            else:
+                logging.info(line)
 
 def init_logging():
     fstring='%(asctime)-15s | %(message)s'
@@ -50,41 +173,121 @@ def init_logging():
                        , datefmt='%Y%m%d %H:%M.%S'
                        )
     global LOGGER
-    LOGGER = newliney_info
+    LOGGER = StdLogSink()
 
 class NetLogger:
+    '''
+    Sink that broadcasts log lines over udp.
+
+    Each line goes out as '[label] line\n'. Lines longer than the mtu are
+    split over several datagrams. Short lines are packed together, so that a
+    batch from the ring costs us a few sends rather than one per line.
+
+    We never block. If the kernel (or the engine's send queue) is backed
+    up, we drop the datagram and add to drops.
+    '''
     def __init__(self, mtu, addr, port, label):
         self.mtu = mtu
         self.addr = addr
         self.port = port
         self.label = label
         #
-        self.buffer = []
+        self.drops = 0
+        # Limit on how much we let pile up in the engine's send queue.
+        self.max_queue = 64 * mtu
         #
         self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)  
         self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)  
         self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_BROADCAST, 1)  
         self.sock.connect((addr, port))
-    def send(self, msg):
-        self.buffer.clear()
-        if '' == msg:
-            # blank line
-            self.buffer.append('')
-        else:
-            while len(msg) > self.mtu:
-                s = msg[:self.mtu]
-                self.buffer.append(s)
-                msg = msg[self.mtu:]
-            if msg:
-                self.buffer.append(msg)
+        self.sock.setblocking(0)
         #
-        for line in self.buffer:
-            if line.endswith('\n'):
-                line = '[%s] %s'%(self.label, line)
-            else:
-                line = '[%s] %s\n'%(self.label, line)
-            bb = bytes(line, 'utf8')
+        # Set while we are sending through an engine pub. See bind_engine.
+        self.engine = None
+        self.pub_sid = None
+    def bind_engine(self, engine):
+        '''
+        From now on, send through a pub on engine rather than through our
+        own socket. When the pub stops, we go back to our own socket.
+        '''
+        if self.engine != None:
+            return
+        self.engine = engine
+        self.pub_sid = engine.open_pub(
+            addr=self.addr,
+            port=self.port,
+            cb_pub_start=self.cb_pub_start,
+            cb_pub_stop=self.cb_pub_stop)
+    def unbind_engine(self):
+        if self.engine == None:
+            return
+        engine = self.engine
+        pub_sid = self.pub_sid
+        self.engine = None
+        self.pub_sid = None
+        engine.close_pub(
+            pub_sid=pub_sid)
+    def cb_pub_start(self, cs_pub_start):
+        pass
+    def cb_pub_stop(self, cs_pub_stop):
+        self.engine = None
+        self.pub_sid = None
+    def _chunks(self, lines):
+        '''
+        Splits and decorates lines, and yields the pieces, each of which will
+        fit in a datagram.
+        '''
+        mtu = self.mtu
+        for msg in lines:
+            if msg.endswith('\n'):
+                msg = msg[:-1]
+            if '' == msg:
+                yield '[%s] \n'%(self.label)
+                continue
+            while msg:
+                yield '[%s] %s\n'%(self.label, msg[:mtu])
+                msg = msg[mtu:]
+    def write_lines(self, lines):
+        acc = []
+        acc_len = 0
+        limit = self.mtu + len(self.label) + 4
+        if self.engine != None:
+            limit = min(limit, self.engine.mtu)
+        for piece in self._chunks(lines):
+            bb = bytes(piece, 'utf8')
+            if acc and acc_len + len(bb) > limit:
+                self._send(b''.join(acc))
+                acc.clear()
+                acc_len = 0
+            acc.append(bb)
+            acc_len += len(bb)
+        if acc:
+            self._send(b''.join(acc))
+    def _send(self, bb):
+        if self.engine != None and len(bb) <= self.engine.mtu:
+            if self.engine.get_send_queue_depth(self.pub_sid) > self.max_queue:
+                self.drops += 1
+                return
+            self.engine.send_owned(
+                sid=self.pub_sid,
+                bb=bb)
+            return
+        try:
             self.sock.send(bb)
+        except (BlockingIOError, InterruptedError):
+            self.drops += 1
+        except OSError:
+            # e.g. nobody is listening, or the network is down. Logging must
+            # not be the thing that brings the application down.
+            self.drops += 1
+
+def get_net_logger():
+    '''
+    Returns the NetLogger if network logging is on, otherwise None.
+    '''
+    if isinstance(LOGGER, NetLogger):
+        return LOGGER
+    return None
 
 def init_network_logging(mtu, addr, port, label):
     global LOGGER
@@ -94,7 +297,8 @@ def init_network_logging(mtu, addr, port, label):
         addr=addr,
         port=port,
         label=label)
-    LOGGER = net_logger.send
+    LOGGER = net_logger
+    return net_logger
 
 def hexdump(bb, title='hexdump'):
     #
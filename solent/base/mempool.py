@@ -38,6 +38,10 @@ class Mempool:
         # int size vs int count
         self.lent = {}
         self.ltotal = 0
+        # Allocations, and those of them that had to create a new sip
+        # because the pool was empty.
+        self.count_alloc = 0
+        self.count_create = 0
     def alloc(self, size):
         'Returns a sip of size.'
         if size not in self.pool:
@@ -45,8 +49,10 @@ class Mempool:
             self.lent[size] = 0
         self.lent[size] += 1
         self.ltotal += 1
+        self.count_alloc += 1
         if len(self.pool[size]) == 0:
             sip = Sip(size)
+            self.count_create += 1
         else:
             sip = self.pool[size].pop()
         # This is part of a hack to allow sip references in this python
@@ -0,0 +1,35 @@
+#
+# bench
+#
+# // overview
+# Loopback benchmarks for the engine. Run them with,
+#
+#     python -m solent.bench > results.json
+#
+# and compare two result files with,
+#
+#     python -m solent.bench --compare baseline.json results.json
+#
+# See scenarios.py for what each benchmark measures.
+#
+# // license
+# Copyright 2016, Free Software Foundation.
+#
+# This file is part of Solent.
+#
+# Solent is free software: you can redistribute it and/or modify it under the
+# terms of the GNU Lesser General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option)
+# any later version.
+#
+# Solent is distributed in the hope that it will be useful, but WITHOUT ANY
+# WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE. See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along with
+# Solent. If not, see <http://www.gnu.org/licenses/>.
+
+from .runner import compare_results
+from .runner import run_benchmarks
+from .runner import SCENARIOS
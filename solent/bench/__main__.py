@@ -0,0 +1,129 @@
+#
+# __main__
+#
+# // license
+# Copyright 2016, Free Software Foundation.
+#
+# This file is part of Solent.
+#
+# Solent is free software: you can redistribute it and/or modify it under the
+# terms of the GNU Lesser General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option)
+# any later version.
+#
+# Solent is distributed in the hope that it will be useful, but WITHOUT ANY
+# WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE. See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along with
+# Solent. If not, see <http://www.gnu.org/licenses/>.
+
+from .runner import compare_results
+from .runner import run_benchmarks
+from .runner import SCENARIOS
+
+from solent import set_log_level
+from solent import LOG_WARN
+
+import json
+import sys
+
+def usage(ecode=1):
+    print('Usage:')
+    print('  python -m solent.bench [options] [scenario ...]')
+    print('  python -m solent.bench --compare BASELINE.json CURRENT.json')
+    print('')
+    print('Options:')
+    print('  --duration SECONDS   time to spend on each scenario (default 2)')
+    print('  --selector NAME      epoll, poll or select (default: best)')
+    print('  --port PORT          first port to use (default 5300)')
+    print('  --out FILE           write json here rather than to stdout')
+    print('  --verbose            keep engine logging')
+    print('')
+    print('Scenarios:')
+    for name in SCENARIOS.keys():
+        print('  %s'%(name))
+    sys.exit(ecode)
+
+def print_comparison(baseline_fname, current_fname):
+    with open(baseline_fname) as f_ptr:
+        baseline = json.load(f_ptr)
+    with open(current_fname) as f_ptr:
+        current = json.load(f_ptr)
+    rows = compare_results(
+        baseline=baseline,
+        current=current)
+    width = max([len(row[0]) for row in rows] + [4])
+    for (name, base_value, curr_value, change) in rows:
+        if change == None:
+            s_change = '-'
+        else:
+            s_change = '%+.1f%%'%(change)
+        print('%s  %14.3f  %14.3f  %8s'%(
+            name.ljust(width), base_value, curr_value, s_change))
+
+def main():
+    args = sys.argv[1:]
+    if '--help' in args:
+        usage(0)
+    if args and args[0] == '--compare':
+        if 3 != len(args):
+            usage()
+        print_comparison(
+            baseline_fname=args[1],
+            current_fname=args[2])
+        return
+    #
+    duration = 2.0
+    selector = None
+    base_port = 5300
+    out = None
+    b_verbose = False
+    names = []
+    while args:
+        arg = args.pop(0)
+        if arg in ('--duration', '--selector', '--port', '--out'):
+            if not args:
+                usage()
+            value = args.pop(0)
+            if arg == '--duration':
+                duration = float(value)
+            elif arg == '--selector':
+                selector = value
+            elif arg == '--port':
+                base_port = int(value)
+            else:
+                out = value
+        elif arg == '--verbose':
+            b_verbose = True
+        elif arg.startswith('--'):
+            usage()
+        else:
+            names.append(arg)
+    if not names:
+        names = None
+    #
+    # The engine logs every socket open and close. That is noise here, and
+    # in the connect scenario it would dominate what we measure.
+    if not b_verbose:
+        set_log_level(LOG_WARN)
+    #
+    def cb_progress(name):
+        sys.stderr.write('running %s\n'%(name))
+    result = run_benchmarks(
+        names=names,
+        duration=duration,
+        base_port=base_port,
+        selector=selector,
+        cb_progress=cb_progress)
+    s = json.dumps(result, indent=4)
+    if out == None:
+        print(s)
+    else:
+        with open(out, 'w') as f_ptr:
+            f_ptr.write(s)
+            f_ptr.write('\n')
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,105 @@
+#
+# runner
+#
+# // license
+# Copyright 2016, Free Software Foundation.
+#
+# This file is part of Solent.
+#
+# Solent is free software: you can redistribute it and/or modify it under the
+# terms of the GNU Lesser General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option)
+# any later version.
+#
+# Solent is distributed in the hope that it will be useful, but WITHOUT ANY
+# WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE. See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along with
+# Solent. If not, see <http://www.gnu.org/licenses/>.
+
+from .scenarios import bench_nearcast_batch
+from .scenarios import bench_tcp_connect_rate
+from .scenarios import bench_tcp_echo_latency
+from .scenarios import bench_tcp_fan_in
+from .scenarios import bench_tcp_throughput
+from .scenarios import bench_udp_fanout
+from .scenarios import bench_udp_pps
+from .scenarios import bench_unix_echo_latency
+
+from collections import OrderedDict as od
+import platform
+import sys
+import time
+
+# name vs fn. Each scenario gets its own port, so that sockets from one
+# scenario that are lingering in TIME_WAIT do not trouble the next.
+SCENARIOS = od([
+    ('tcp_echo_latency', bench_tcp_echo_latency),
+    ('unix_echo_latency', bench_unix_echo_latency),
+    ('tcp_throughput', bench_tcp_throughput),
+    ('tcp_fan_in', bench_tcp_fan_in),
+    ('udp_pps', bench_udp_pps),
+    ('tcp_connect_rate', bench_tcp_connect_rate),
+    ('udp_fanout', bench_udp_fanout),
+    ('nearcast_batch', bench_nearcast_batch),
+    ])
+
+def run_benchmarks(names=None, duration=2.0, base_port=5300, selector=None, cb_progress=None):
+    '''
+    Runs the named scenarios (or all of them) and returns a dict suitable
+    for writing out as json.
+    '''
+    if names == None:
+        names = list(SCENARIOS.keys())
+    for name in names:
+        if name not in SCENARIOS:
+            raise Exception("No scenario %s. (Have: %s)"%(
+                name, ', '.join(SCENARIOS.keys())))
+    results = od()
+    for (idx, name) in enumerate(names):
+        if cb_progress != None:
+            cb_progress(name)
+        fn = SCENARIOS[name]
+        results[name] = fn(
+            port=base_port+idx,
+            duration=duration,
+            selector=selector)
+    return od([
+        ('meta', od([
+            ('time', time.strftime('%Y-%m-%dT%H:%M:%S')),
+            ('python', sys.version.split()[0]),
+            ('platform', platform.platform()),
+            ('selector', selector),
+            ('duration', duration)])),
+        ('results', results)])
+
+def _flatten(d, prefix, acc):
+    for (key, value) in d.items():
+        name = '%s%s'%(prefix, key)
+        if isinstance(value, dict):
+            _flatten(value, '%s.'%(name), acc)
+        elif isinstance(value, (int, float)):
+            acc[name] = value
+
+def compare_results(baseline, current):
+    '''
+    Returns a list of (name, baseline value, current value, percent change)
+    for every number that the two result sets have in common.
+    '''
+    d_base = od()
+    _flatten(baseline['results'], '', d_base)
+    d_curr = od()
+    _flatten(current['results'], '', d_curr)
+    rows = []
+    for (name, base_value) in d_base.items():
+        if name not in d_curr:
+            continue
+        curr_value = d_curr[name]
+        if base_value == 0:
+            change = None
+        else:
+            change = 100.0 * (curr_value - base_value) / base_value
+        rows.append( (name, base_value, curr_value, change) )
+    return rows
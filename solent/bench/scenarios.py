@@ -0,0 +1,564 @@
+#
+# scenarios
+#
+# // overview
+# Each scenario drives a real Engine over loopback for a fixed duration, and
+# returns a dict of results. Client and server share the one engine, so what
+# we measure is the cost of a full trip through the engine on both sides.
+#
+# Latencies are reported in microseconds, rates per second, and throughput in
+# megabytes (10**6) per second.
+#
+# nearcast_batch is the exception. It measures the orb rather than the
+# network, and ignores its port.
+#
+# // license
+# Copyright 2016, Free Software Foundation.
+#
+# This file is part of Solent.
+#
+# Solent is free software: you can redistribute it and/or modify it under the
+# terms of the GNU Lesser General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option)
+# any later version.
+#
+# Solent is distributed in the hope that it will be useful, but WITHOUT ANY
+# WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE. See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along with
+# Solent. If not, see <http://www.gnu.org/licenses/>.
+
+from solent import Engine
+
+import os
+import tempfile
+import time
+
+ADDR = '127.0.0.1'
+MTU = 1500
+
+def percentiles(samples):
+    '''
+    Nearest-rank percentiles over a list of numbers. Returns a dict with
+    count, min, p50, p90, p99, p999 and max.
+    '''
+    d = {'count': len(samples)}
+    if not samples:
+        return d
+    ordered = sorted(samples)
+    count = len(ordered)
+    def rank(p):
+        idx = int(p * count / 100.0 + 0.5) - 1
+        return ordered[min(max(idx, 0), count - 1)]
+    d['min'] = ordered[0]
+    d['p50'] = rank(50)
+    d['p90'] = rank(90)
+    d['p99'] = rank(99)
+    d['p999'] = rank(99.9)
+    d['max'] = ordered[-1]
+    return d
+
+def run_engine(engine, duration, fn_done=None):
+    '''
+    Turns the engine as event_loop would, until duration has passed or
+    fn_done returns True. Returns the time that elapsed.
+    '''
+    t_start = time.perf_counter()
+    t_end = t_start + duration
+    timeout = 0
+    while True:
+        timeout = engine.turn(
+            timeout=min(timeout, 0.01))
+        now = time.perf_counter()
+        if now >= t_end:
+            break
+        if fn_done != None and fn_done():
+            break
+    return now - t_start
+
+def noop(**kwargs):
+    pass
+
+class TcpServer:
+    '''
+    Server side for the tcp scenarios. Counts what arrives, and echoes it
+    back if asked to. If you supply path, it listens on a unix domain socket
+    rather than on port.
+    '''
+    def __init__(self, engine, port, b_echo, path=None):
+        self.engine = engine
+        self.b_echo = b_echo
+        #
+        self.accept_sids = []
+        self.d_accept_bytes = {}
+        if path == None:
+            self.server_sid = engine.open_tcp_server(
+                addr=ADDR,
+                port=port,
+                cb_tcp_server_start=noop,
+                cb_tcp_server_stop=noop,
+                cb_tcp_accept_connect=self.cb_tcp_accept_connect,
+                cb_tcp_accept_condrop=self.cb_tcp_accept_condrop,
+                cb_tcp_accept_recv=self.cb_tcp_accept_recv)
+        else:
+            self.server_sid = engine.open_unix_server(
+                path=path,
+                cb_tcp_server_start=noop,
+                cb_tcp_server_stop=noop,
+                cb_tcp_accept_connect=self.cb_tcp_accept_connect,
+                cb_tcp_accept_condrop=self.cb_tcp_accept_condrop,
+                cb_tcp_accept_recv=self.cb_tcp_accept_recv)
+    def total_bytes(self):
+        return sum(self.d_accept_bytes.values())
+    def cb_tcp_accept_connect(self, cs_tcp_accept_connect):
+        accept_sid = cs_tcp_accept_connect.accept_sid
+        #
+        self.accept_sids.append(accept_sid)
+        self.d_accept_bytes[accept_sid] = 0
+    def cb_tcp_accept_condrop(self, cs_tcp_accept_condrop):
+        pass
+    def cb_tcp_accept_recv(self, cs_tcp_accept_recv):
+        accept_sid = cs_tcp_accept_recv.accept_sid
+        bb = cs_tcp_accept_recv.bb
+        #
+        self.d_accept_bytes[accept_sid] += len(bb)
+        if self.b_echo:
+            self.engine.send(
+                sid=accept_sid,
+                bb=bb)
+
+def bench_tcp_echo_latency(port, duration, selector=None, msg_size=64, warmup=100, path=None):
+    '''
+    One client sends msg_size bytes, waits for the echo, and repeats. Each
+    round trip is a sample. If you supply path, this runs over a unix domain
+    socket instead of tcp.
+    '''
+    engine = Engine(
+        mtu=MTU,
+        selector=selector)
+    samples = []
+    state = {'t_send': 0.0, 'got': 0, 'trips': 0}
+    payload = bytes(msg_size)
+    def send_one(client_sid):
+        state['got'] = 0
+        state['t_send'] = time.perf_counter()
+        engine.send_owned(
+            sid=client_sid,
+            bb=payload)
+    def cb_tcp_client_connect(cs_tcp_client_connect):
+        send_one(cs_tcp_client_connect.client_sid)
+    def cb_tcp_client_recv(cs_tcp_client_recv):
+        state['got'] += len(cs_tcp_client_recv.bb)
+        if state['got'] < msg_size:
+            return
+        rtt = time.perf_counter() - state['t_send']
+        state['trips'] += 1
+        if state['trips'] > warmup:
+            samples.append(rtt * 1000000.0)
+        send_one(cs_tcp_client_recv.client_sid)
+    try:
+        TcpServer(
+            engine=engine,
+            port=port,
+            b_echo=True,
+            path=path)
+        if path == None:
+            engine.open_tcp_client(
+                addr=ADDR,
+                port=port,
+                cb_tcp_client_connect=cb_tcp_client_connect,
+                cb_tcp_client_condrop=noop,
+                cb_tcp_client_recv=cb_tcp_client_recv)
+        else:
+            engine.open_unix_client(
+                path=path,
+                cb_tcp_client_connect=cb_tcp_client_connect,
+                cb_tcp_client_condrop=noop,
+                cb_tcp_client_recv=cb_tcp_client_recv)
+        elapsed = run_engine(
+            engine=engine,
+            duration=duration)
+    finally:
+        engine.close()
+    return {
+        'msg_size': msg_size,
+        'round_trips_per_sec': len(samples) / elapsed,
+        'rtt_us': percentiles(samples)}
+
+def bench_unix_echo_latency(port, duration, selector=None, msg_size=64, warmup=100):
+    '''
+    As for tcp_echo_latency, over a unix domain socket. Compare the two to
+    see what a local hop saves by not going through the tcp stack.
+    '''
+    tmp_dir = tempfile.mkdtemp()
+    try:
+        return bench_tcp_echo_latency(
+            port=port,
+            duration=duration,
+            selector=selector,
+            msg_size=msg_size,
+            warmup=warmup,
+            path=os.path.join(tmp_dir, 'bench.sock'))
+    finally:
+        os.rmdir(tmp_dir)
+
+class StreamingClient:
+    '''
+    Keeps a tcp client's send queue topped up, using the engine's pressure
+    and drain callbacks to know when to stop and start.
+    '''
+    def __init__(self, engine, port, chunk):
+        self.engine = engine
+        self.chunk = chunk
+        #
+        self.client_sid = None
+        self.b_paused = False
+        self.b_running = True
+        engine.open_tcp_client(
+            addr=ADDR,
+            port=port,
+            cb_tcp_client_connect=self.cb_tcp_client_connect,
+            cb_tcp_client_condrop=noop,
+            cb_tcp_client_recv=noop,
+            cb_tcp_client_pressure=self.cb_tcp_client_pressure,
+            cb_tcp_client_drain=self.cb_tcp_client_drain)
+    def fill(self):
+        while self.b_running and not self.b_paused:
+            self.engine.send_owned(
+                sid=self.client_sid,
+                bb=self.chunk)
+    def cb_tcp_client_connect(self, cs_tcp_client_connect):
+        self.client_sid = cs_tcp_client_connect.client_sid
+        self.engine.set_send_watermarks(
+            sid=self.client_sid,
+            high=262144,
+            low=65536)
+        self.fill()
+    def cb_tcp_client_pressure(self, cs_tcp_client_pressure):
+        self.b_paused = True
+    def cb_tcp_client_drain(self, cs_tcp_client_drain):
+        self.b_paused = False
+        self.fill()
+
+def bench_tcp_throughput(port, duration, selector=None, chunk_size=MTU):
+    '''
+    One client streams to one server as fast as the engine allows.
+    '''
+    return bench_tcp_fan_in(
+        port=port,
+        duration=duration,
+        selector=selector,
+        connections=1,
+        chunk_size=chunk_size)
+
+def bench_tcp_fan_in(port, duration, selector=None, connections=64, chunk_size=MTU):
+    '''
+    Many clients stream to one server at once. Alongside the aggregate rate,
+    we report the spread between the slowest and fastest connection, which
+    shows up starvation.
+    '''
+    engine = Engine(
+        mtu=MTU,
+        selector=selector)
+    chunk = bytes(chunk_size)
+    try:
+        server = TcpServer(
+            engine=engine,
+            port=port,
+            b_echo=False)
+        clients = []
+        for i in range(connections):
+            clients.append(StreamingClient(
+                engine=engine,
+                port=port,
+                chunk=chunk))
+        #
+        # Connect everyone before we start the clock.
+        def all_connected():
+            if len(server.accept_sids) < connections:
+                return False
+            for client in clients:
+                if client.client_sid == None:
+                    return False
+            return True
+        run_engine(
+            engine=engine,
+            duration=10,
+            fn_done=all_connected)
+        if not all_connected():
+            raise Exception("Only %s of %s connections came up."%(
+                len(server.accept_sids), connections))
+        bytes_before = server.total_bytes()
+        d_before = dict(server.d_accept_bytes)
+        elapsed = run_engine(
+            engine=engine,
+            duration=duration)
+        received = server.total_bytes() - bytes_before
+        per_conn = [
+            server.d_accept_bytes[sid] - d_before[sid]
+            for sid in server.accept_sids]
+        for client in clients:
+            client.b_running = False
+    finally:
+        engine.close()
+    return {
+        'connections': connections,
+        'chunk_size': chunk_size,
+        'bytes': received,
+        'mb_per_sec': received / elapsed / 1000000.0,
+        'per_conn_mb_per_sec_min': min(per_conn) / elapsed / 1000000.0,
+        'per_conn_mb_per_sec_max': max(per_conn) / elapsed / 1000000.0}
+
+def bench_udp_pps(port, duration, selector=None, msg_size=64, batch=64, max_queue=65536):
+    '''
+    A pub sends datagrams to a sub on the same host. We report what was sent
+    and what arrived. UDP has no flow control, so loss is a result, not an
+    error.
+    '''
+    engine = Engine(
+        mtu=MTU,
+        selector=selector)
+    payload = bytes(msg_size)
+    state = {'recv': 0, 'sent': 0}
+    def cb_sub_recv_batch(cs_sub_recv_batch):
+        state['recv'] += len(cs_sub_recv_batch.entries)
+    try:
+        engine.open_sub(
+            addr=ADDR,
+            port=port,
+            cb_sub_start=noop,
+            cb_sub_stop=noop,
+            cb_sub_recv=None,
+            cb_sub_recv_batch=cb_sub_recv_batch)
+        pub_sid = engine.open_pub(
+            addr=ADDR,
+            port=port,
+            cb_pub_start=noop,
+            cb_pub_stop=noop)
+        t_start = time.perf_counter()
+        t_end = t_start + duration
+        while True:
+            if engine.get_send_queue_depth(pub_sid) < max_queue:
+                for i in range(batch):
+                    engine.send_owned(
+                        sid=pub_sid,
+                        bb=payload)
+                state['sent'] += batch
+            engine.turn(
+                timeout=0)
+            now = time.perf_counter()
+            if now >= t_end:
+                break
+        #
+        # Whatever is still queued was not sent inside the window.
+        queued = engine.get_send_queue_depth(pub_sid) // msg_size
+        state['sent'] -= queued
+        elapsed = now - t_start
+        recv_in_time = state['recv']
+    finally:
+        engine.close()
+    sent = state['sent']
+    loss = 0.0
+    if sent:
+        loss = max(0.0, 1.0 - recv_in_time / sent)
+    return {
+        'msg_size': msg_size,
+        'sent': sent,
+        'received': recv_in_time,
+        'sent_per_sec': sent / elapsed,
+        'received_per_sec': recv_in_time / elapsed,
+        'loss': loss}
+
+def bench_tcp_connect_rate(port, duration, selector=None, concurrency=8):
+    '''
+    concurrency clients each connect, close as soon as the connection is up,
+    and connect again. Each connect is a sample.
+    '''
+    engine = Engine(
+        mtu=MTU,
+        selector=selector)
+    samples = []
+    # client_sid vs time we asked for the connection
+    d_t_open = {}
+    state = {'b_running': True}
+    def open_one():
+        client_sid = engine.open_tcp_client(
+            addr=ADDR,
+            port=port,
+            cb_tcp_client_connect=cb_tcp_client_connect,
+            cb_tcp_client_condrop=cb_tcp_client_condrop,
+            cb_tcp_client_recv=noop)
+        d_t_open[client_sid] = time.perf_counter()
+    def cb_tcp_client_connect(cs_tcp_client_connect):
+        client_sid = cs_tcp_client_connect.client_sid
+        #
+        t_open = d_t_open.pop(client_sid)
+        samples.append( (time.perf_counter() - t_open) * 1000000.0 )
+        engine.close_tcp_client(
+            client_sid=client_sid)
+    def cb_tcp_client_condrop(cs_tcp_client_condrop):
+        client_sid = cs_tcp_client_condrop.client_sid
+        #
+        d_t_open.pop(client_sid, None)
+        if state['b_running']:
+            open_one()
+    try:
+        TcpServer(
+            engine=engine,
+            port=port,
+            b_echo=False)
+        for i in range(concurrency):
+            open_one()
+        elapsed = run_engine(
+            engine=engine,
+            duration=duration)
+        state['b_running'] = False
+    finally:
+        engine.close()
+    return {
+        'concurrency': concurrency,
+        'connects_per_sec': len(samples) / elapsed,
+        'connect_us': percentiles(samples)}
+
+def bench_udp_fanout(port, duration, selector=None, msg_size=64, subscribers=20, batch=64, max_queue=65536):
+    '''
+    One fanout pub sends each datagram to several subs on the same host. The
+    subs listen on consecutive ports, starting at port. We report payloads
+    published, and datagrams delivered across all subs.
+    '''
+    engine = Engine(
+        mtu=MTU,
+        selector=selector)
+    payload = bytes(msg_size)
+    state = {'recv': 0, 'sent': 0}
+    def cb_sub_recv_batch(cs_sub_recv_batch):
+        state['recv'] += len(cs_sub_recv_batch.entries)
+    try:
+        dests = []
+        for i in range(subscribers):
+            engine.open_sub(
+                addr=ADDR,
+                port=port+i,
+                cb_sub_start=noop,
+                cb_sub_stop=noop,
+                cb_sub_recv=None,
+                cb_sub_recv_batch=cb_sub_recv_batch)
+            dests.append( (ADDR, port+i) )
+        pub_sid = engine.open_pub_fanout(
+            dests=dests,
+            cb_pub_start=noop,
+            cb_pub_stop=noop)
+        t_start = time.perf_counter()
+        t_end = t_start + duration
+        while True:
+            if engine.get_send_queue_depth(pub_sid) < max_queue:
+                for i in range(batch):
+                    engine.send_owned(
+                        sid=pub_sid,
+                        bb=payload)
+                state['sent'] += batch
+            engine.turn(
+                timeout=0)
+            now = time.perf_counter()
+            if now >= t_end:
+                break
+        queued = engine.get_send_queue_depth(pub_sid) // msg_size
+        state['sent'] -= queued
+        elapsed = now - t_start
+        recv_in_time = state['recv']
+    finally:
+        engine.close()
+    sent = state['sent']
+    expected = sent * subscribers
+    loss = 0.0
+    if expected:
+        loss = max(0.0, 1.0 - recv_in_time / expected)
+    return {
+        'msg_size': msg_size,
+        'subscribers': subscribers,
+        'published': sent,
+        'received': recv_in_time,
+        'published_per_sec': sent / elapsed,
+        'received_per_sec': recv_in_time / elapsed,
+        'loss': loss}
+
+I_NEARCAST_TICK = '''
+    i message h
+        i field h
+
+    message tick
+        field n
+'''
+
+class CogTickProducer:
+    def __init__(self, cog_h, orb, engine):
+        self.cog_h = cog_h
+        self.orb = orb
+        self.engine = engine
+
+class CogTickConsumer:
+    def __init__(self, cog_h, orb, engine):
+        self.cog_h = cog_h
+        self.orb = orb
+        self.engine = engine
+        #
+        self.total = 0
+    def on_tick(self, n):
+        self.total += n
+    def on_tick__batch(self, batch):
+        self.total += sum(batch.column('n'))
+
+def bench_nearcast_batch(port, duration, selector=None, batch_size=1000):
+    '''
+    Nearcasts tick messages from one cog to another, first one message at a
+    time and then in batches of batch_size rows. Each mode gets half of
+    duration. We report rows delivered per second for each.
+    '''
+    engine = Engine(
+        mtu=MTU,
+        selector=selector)
+    try:
+        orb = engine.init_orb(
+            i_nearcast=I_NEARCAST_TICK)
+        producer = orb.init_cog(CogTickProducer)
+        orb.init_cog(CogTickConsumer)
+        #
+        rows = 0
+        t_start = time.perf_counter()
+        t_end = t_start + duration / 2.0
+        while True:
+            for i in range(batch_size):
+                producer.nearcast.tick(
+                    n=i)
+            orb.distribute()
+            rows += batch_size
+            now = time.perf_counter()
+            if now >= t_end:
+                break
+        single_per_sec = rows / (now - t_start)
+        #
+        batch = orb.init_batch(
+            cog=producer,
+            message_h='tick',
+            typecodes={'n': 'q'})
+        values = range(batch_size)
+        rows = 0
+        t_start = time.perf_counter()
+        t_end = t_start + duration / 2.0
+        while True:
+            batch.column('n').extend(values)
+            batch.send()
+            orb.distribute()
+            rows += batch_size
+            now = time.perf_counter()
+            if now >= t_end:
+                break
+        batch_per_sec = rows / (now - t_start)
+    finally:
+        engine.close()
+    return {
+        'batch_size': batch_size,
+        'single_rows_per_sec': single_per_sec,
+        'batch_rows_per_sec': batch_per_sec}
@@ -29,5 +29,9 @@ if sys.version_info.major < 3:
 
 from .clock import Clock
 from .engine import Engine
+from .multi import multi_event_loop
+from .sim_engine import SimClock
+from .sim_engine import SimEngine
+from .worker_pool import SpinWorkerPool
 from .ip_validator import IpValidator
 
@@ -24,31 +24,47 @@
 # Solent. If not, see <http://www.gnu.org/licenses/>.
 
 class Action:
+    '''
+    A unit of scheduled work. Engine uses these to implement timers.
+
+    at_t: the time (in engine clock terms) when this should next run.
+    interval: for recurring actions, the gap between runs.
+    cb_eng_timer: the callback to make when the action runs.
+    b_recurring: whether the action should be rescheduled after it runs.
+    '''
     def __init__(self):
-        #
-        self.tmil = None
-        self.fn_ask = None
-        self.fn_turn = None
+        self.timer_h = None
+        self.at_t = None
+        self.interval = None
+        self.cb_eng_timer = None
         self.b_recurring = None
-    def set(self, tmil, fn_ask, fn_turn, b_recurring):
-        self.tmil = tmil
-        self.fn_ask = fn_ask
-        self.fn_turn = fn_turn
+        #
+        # Cancelled actions stay on the engine heap until their turn comes
+        # up. This flag tells the engine to discard them at that point.
+        self.b_live = False
+    def set(self, timer_h, at_t, interval, cb_eng_timer, b_recurring):
+        self.timer_h = timer_h
+        self.at_t = at_t
+        self.interval = interval
+        self.cb_eng_timer = cb_eng_timer
         self.b_recurring = b_recurring
+        self.b_live = True
 
 class ActionPool:
     def __init__(self):
         self.stack = []
     def push(self, action):
+        action.cb_eng_timer = None
+        action.b_live = False
         self.stack.append(action)
-    def pull(self, tmil, fn_ask, fn_turn, b_recurring):
+    def pull(self, timer_h, at_t, interval, cb_eng_timer, b_recurring):
         if 0 == len(self.stack):
             self.stack.append(Action())
         action = self.stack.pop()
         action.set(
-            tmil=tmil,
-            fn_ask=fn_ask,
-            fn_turn=fn_turn,
+            timer_h=timer_h,
+            at_t=at_t,
+            interval=interval,
+            cb_eng_timer=cb_eng_timer,
             b_recurring=b_recurring)
         return action
-
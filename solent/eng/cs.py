@@ -32,6 +32,10 @@
 # application that is using the engine. If you need an explanation
 # for what the different kinds of callback are, look at the 
 #
+# The bb field on the recv structs is normally a bytes. If you have put the
+# sid into view mode (Engine.recv_view_on), it is a memoryview that is only
+# valid for the duration of the callback.
+#
 # // implementation notes
 # Use-case: you want to understand why you get these struct things rather
 # than parameters.
@@ -94,6 +98,17 @@ class CsSubRecv:
         self.sub_sid = None
         self.bb = None
 
+class CsSubRecvBatch:
+    # Datagrams for a subscriber that was opened with cb_sub_recv_batch.
+    # entries is a list of (memoryview, addr), one per datagram, in arrival
+    # order. The views point into a buffer that the engine reuses, so they
+    # are only valid for the duration of the callback. Copy anything you
+    # want to keep.
+    def __init__(self):
+        self.engine = None
+        self.sub_sid = None
+        self.entries = None
+
 class CsTcpServerStart:
     # Fired when a TCP server is listening.
     def __init__(self):
@@ -135,6 +150,23 @@ class CsTcpAcceptRecv:
         self.accept_sid = None
         self.bb = None
 
+class CsTcpAcceptPressure:
+    # Fired when the send queue for an accept grows past its high watermark.
+    # Producers should stop queueing data until they see the corresponding
+    # drain callback.
+    def __init__(self):
+        self.engine = None
+        self.accept_sid = None
+        self.queued_bytes = None
+
+class CsTcpAcceptDrain:
+    # Fired when the send queue for an accept that was under pressure has
+    # fallen to its low watermark.
+    def __init__(self):
+        self.engine = None
+        self.accept_sid = None
+        self.queued_bytes = None
+
 class CsTcpClientConnect:
     # Data that is sent in the callback announcing that an attempt to
     # establish a TCP client connection has been successful.
@@ -172,3 +204,16 @@ class CsTcpClientRecv:
         self.client_sid = None
         self.bb = None
 
+class CsTcpClientPressure:
+    # As for CsTcpAcceptPressure, but for a tcp client.
+    def __init__(self):
+        self.engine = None
+        self.client_sid = None
+        self.queued_bytes = None
+
+class CsTcpClientDrain:
+    # As for CsTcpAcceptDrain, but for a tcp client.
+    def __init__(self):
+        self.engine = None
+        self.client_sid = None
+        self.queued_bytes = None
@@ -40,19 +40,41 @@ from .activity import Activity
 from .clock import Clock
 from .metasock import MetasockCloseCondition
 from .metasock import metasock_create_sub
+from .metasock import metasock_create_mcast_pub
+from .metasock import metasock_create_mcast_sub
 from .metasock import metasock_create_pub
+from .metasock import metasock_create_pub_fanout
 from .metasock import metasock_create_tcp_accept
 from .metasock import metasock_create_tcp_client
 from .metasock import metasock_create_tcp_server
+from .metasock import metasock_create_unix_client
+from .metasock import metasock_create_unix_pub
+from .metasock import metasock_create_unix_server
+from .metasock import metasock_create_unix_sub
+from .metasock import MS_TYPE_PUB
+from .metasock import MS_TYPE_SUB
+from .metasock import MS_TYPE_TCP_ACCEPT
+from .metasock import MS_TYPE_TCP_CLIENT
+from .metasock import MS_TYPE_TCP_SERVER
+from .metrics import Metrics
 from .orb import Orb
+from .selector import fd_to_fileno
+from .selector import init_selector
+from .selector import SELECTOR_READ
+from .selector import SELECTOR_WRITE
+from .selector import SELECTOR_EXCEPT
 
 from solent import uniq
 from solent import log
+from solent import flush_log
+from solent import get_net_logger
+from solent import log_ring_off
+from solent import log_ring_on
 from solent import Mempool
 
 from collections import OrderedDict as od
+import heapq
 import platform
-import select
 import socket
 import time
 import traceback
@@ -92,15 +114,88 @@ class CsEngCustomFdRead:
         self.cfd_h = None
         self.fd = None
 
+class CsEngTimer:
+    def __init__(self):
+        self.engine = None
+        self.timer_h = None
+        self.at_t = None
+
+class SpinWakeup:
+    '''
+    Handle that the engine gives to spins that opt in to wakeup scheduling.
+
+    Legacy spins have eng_turn called on every pass of the event loop. A spin
+    that defines eng_bind_wakeup(wakeup) instead gets one of these, and is
+    only turned after it has called wake(). Wakeups are one-shot: once the
+    spin has been turned, it must call wake() again to get another turn.
+
+    A spin that sometimes needs to be polled (for example an orb that hosts
+    legacy cogs) can flip itself into polled mode with set_polled.
+    '''
+    def __init__(self, engine, spin_h):
+        self.engine = engine
+        self.spin_h = spin_h
+        #
+        self.b_runnable = False
+        self.b_polled = False
+    def wake(self):
+        if self.b_runnable:
+            return
+        self.b_runnable = True
+        self.engine.runnable_spins.append(self.spin_h)
+    def wake_in(self, delay):
+        '''
+        Arranges for the spin to be woken once delay seconds have passed.
+        Returns the timer_h, which you can pass to engine.close_timer.
+        '''
+        return self.engine.open_timer(
+            delay=delay,
+            b_recurring=False,
+            cb_eng_timer=self.cb_eng_timer)
+    def set_polled(self, b_polled):
+        if b_polled == self.b_polled:
+            return
+        self.b_polled = b_polled
+        if b_polled:
+            self.engine.polled_spins.append(self.spin_h)
+        else:
+            self.engine.polled_spins.remove(self.spin_h)
+    #
+    def cb_eng_timer(self, cs_eng_timer):
+        self.wake()
+
 class Engine(object):
-    def __init__(self, mtu):
+    def __init__(self, mtu, selector=None):
+        '''
+        selector: 'epoll', 'poll' or 'select'. Leave it as None to get the
+        best that the platform offers. (See selector.py)
+        '''
         self.mtu = mtu
         #
+        self.selector = init_selector(
+            selector_h=selector)
         self.mempool = Mempool()
         self.clock = Clock()
         self.action_pool = ActionPool()
+        # heap of (at_t, seq, action). seq breaks ties, so that we never fall
+        # back to comparing actions, and so that timers due at the same time
+        # fire in the order they were scheduled.
+        self.timer_heap = []
+        self.timer_seq = 0
+        # timer_h vs action, for live timers only
+        self.d_timer = {}
+        self.cs_eng_timer = CsEngTimer()
         self.sid_to_metasock = od()
+        # fileno vs metasock. This is what we use to get back from the
+        # selector's results to the relevant metasock.
+        self.fd_to_metasock = {}
         self.spins = od()
+        # spin_h list. Legacy spins, turned on every pass.
+        self.polled_spins = []
+        # spin_h list. Spins that have asked for a turn via their wakeup.
+        self.runnable_spins = []
+        # spin_h vs SpinWakeup
+        self.d_spin_wakeup = {}
         #
         self.activity = Activity()
         self.b_debug_eloop = False
@@ -108,12 +203,77 @@ class Engine(object):
         self.default_timeout = 0.2
         self.b_nodelay = False
         #
+        # Reads are not tied to the mtu. See set_read_budget.
+        self.recv_size = 65536
+        self.read_budget_bytes = 262144
+        self.read_budget_reads = 64
+        self.accept_budget = 64
+        #
+        # Send queue accounting. See set_send_watermarks.
+        self.send_queue_bytes = 0
+        self.default_send_high_water = 1048576
+        self.default_send_low_water = 262144
+        #
         self.cb_ms_close = None
         self.cs_ms_close = CsMsClose()
         #
-        # fd vs (cfd_h, cb_eng_custom_fd_read)
+        # fileno vs (cfd_h, fd, cb_eng_custom_fd_read)
         self.d_eng_custom_read = {}
         self.cs_eng_custom_fd_read = CsEngCustomFdRead()
+        #
+        # Opt-in. See enable_metrics.
+        self.metrics = None
+        self.select_wait = 0.0
+        #
+        # From here, log lines are buffered, and we write them out in a batch
+        # once per turn. If network logging is on, it moves onto one of our
+        # pubs so that it cannot block the loop. (See liblog.py)
+        log_ring_on()
+        self.b_log_ring = True
+        net_logger = get_net_logger()
+        if net_logger != None:
+            net_logger.bind_engine(self)
+    def enable_metrics(self):
+        '''
+        Turns on metrics, and returns the registry. (See metrics.py.) Safe to
+        call more than once.
+        '''
+        if self.metrics != None:
+            return self.metrics
+        metrics = Metrics()
+        self.metric_turns = metrics.counter('eng.turns')
+        self.metric_turn_busy = metrics.histogram('eng.turn_busy')
+        self.metric_select_wait = metrics.histogram('eng.select_wait')
+        self.metric_ms_opened = metrics.counter('eng.metasocks_opened')
+        self.metric_ms_closed = metrics.counter('eng.metasocks_closed')
+        metrics.add_collector(self._collect_metrics)
+        self.metrics = metrics
+        return metrics
+    def get_metrics(self):
+        'The metrics registry, or None if metrics are not enabled.'
+        return self.metrics
+    def _collect_metrics(self, acc):
+        d_type_count = {}
+        for ms_type in (MS_TYPE_PUB, MS_TYPE_SUB, MS_TYPE_TCP_ACCEPT, MS_TYPE_TCP_CLIENT, MS_TYPE_TCP_SERVER):
+            d_type_count[ms_type] = 0
+        for (sid, ms) in self.sid_to_metasock.items():
+            d_type_count[ms.ms_type] += 1
+            acc.append( ('sid.%s.recv_bytes'%(sid), ms.count_recv_bytes) )
+            acc.append( ('sid.%s.recv_calls'%(sid), ms.count_recv_calls) )
+            acc.append( ('sid.%s.send_bytes'%(sid), ms.count_send_bytes) )
+            acc.append( ('sid.%s.send_calls'%(sid), ms.count_send_calls) )
+            acc.append( ('sid.%s.send_queue'%(sid), ms.get_send_queue_depth()) )
+        for (ms_type, count) in d_type_count.items():
+            acc.append( ('eng.metasocks.%s'%(ms_type), count) )
+        acc.append( ('eng.metasocks', len(self.sid_to_metasock)) )
+        acc.append( ('eng.send_queue_bytes', self.send_queue_bytes) )
+        acc.append( ('eng.spins', len(self.spins)) )
+        acc.append( ('eng.spins_polled', len(self.polled_spins)) )
+        acc.append( ('eng.timers', len(self.d_timer)) )
+        acc.append( ('eng.custom_fds', len(self.d_eng_custom_read)) )
+        acc.append( ('mempool.lent', self.mempool.ltotal) )
+        acc.append( ('mempool.allocs', self.mempool.count_alloc) )
+        acc.append( ('mempool.creates', self.mempool.count_create) )
     def enable_nodelay(self):
         self.b_nodelay = True
     def disable_nodelay(self):
@@ -122,19 +282,79 @@ class Engine(object):
         self.b_debug_eloop = True
     def debug_eloop_off(self):
         self.b_debug_eloop = False
+    def get_selector_h(self):
+        return self.selector.selector_h
     def get_clock(self):
         return self.clock
     def get_mtu(self):
         return self.mtu
     def set_mtu(self, mtu):
         self.mtu = mtu
+    def set_recv_size(self, recv_size):
+        '''
+        The size of buffer we offer to each recv call. Note that for udp, a
+        datagram larger than this will be truncated.
+        '''
+        self.recv_size = recv_size
+    def set_read_budget(self, max_bytes, max_reads):
+        '''
+        When a socket is readable, the engine reads from it repeatedly until
+        it would block. This limits how much it will take from any one socket
+        in a single turn, so that a fast sender cannot starve the others.
+        Whichever limit is reached first applies.
+        '''
+        self.read_budget_bytes = max_bytes
+        self.read_budget_reads = max_reads
+    def set_accept_budget(self, accept_budget):
+        '''
+        The most connections a tcp server will accept in a single turn.
+        '''
+        self.accept_budget = accept_budget
+    def set_default_send_watermarks(self, high, low):
+        '''
+        The watermarks that metasocks get when they are created. See
+        set_send_watermarks.
+        '''
+        self.default_send_high_water = high
+        self.default_send_low_water = low
+    def set_send_watermarks(self, sid, high, low):
+        '''
+        When the bytes queued for sending on sid grow past high, the engine
+        calls the pressure callback for that sid (e.g. cb_tcp_client_pressure).
+        Once the queue has fallen back to low, it calls the drain callback.
+        Producers can use this pair to pause and resume, rather than queueing
+        without limit against a slow peer.
+        '''
+        if low > high:
+            raise Exception("low watermark %s is above high %s"%(low, high))
+        ms = self._get_ms_for_sid(sid)
+        ms.send_high_water = high
+        ms.send_low_water = low
+    def get_send_queue_depth(self, sid):
+        'Bytes that are queued for sid, but not yet sent.'
+        ms = self._get_ms_for_sid(sid)
+        return ms.get_send_queue_depth()
+    def get_send_queue_bytes(self):
+        'Bytes that are queued for sending, across all sids.'
+        return self.send_queue_bytes
     def set_default_timeout(self, value):
+        '''
+        This is the longest the engine will wait in select when nothing is
+        happening. If a timer is due sooner, the engine will wait only until
+        that timer is due.
+        '''
         self.default_timeout = value
     def create_sid(self):
         next = self.sid_counter
         self.sid_counter += 1
         return next
     def close(self):
+        net_logger = get_net_logger()
+        if net_logger != None and net_logger.engine == self:
+            # Lines logged while we shut down go out on the net logger's
+            # own socket.
+            net_logger.unbind_engine()
+        flush_log()
         items = [pair for pair in self.sid_to_metasock.items()]
         for (sid, ms) in items:
             try:
@@ -148,6 +368,10 @@ class Engine(object):
                 orb.eng_close()
             except:
                 traceback.print_exc()
+        self.selector.close()
+        if self.b_log_ring:
+            self.b_log_ring = False
+            log_ring_off()
     def _add_spin(self, spin_h, spin):
         eng_methods = [m for m in dir(spin) if m.startswith('eng_')]
         m = "Missing method. Need eng_turn(activity), eng_close()"
@@ -160,6 +384,18 @@ class Engine(object):
         if spin in self.spins.values():
             raise Exception("Orb is already in engine. Don't double-add.")
         self.spins[spin_h] = spin
+        #
+        if 'eng_bind_wakeup' in eng_methods:
+            wakeup = SpinWakeup(
+                engine=self,
+                spin_h=spin_h)
+            self.d_spin_wakeup[spin_h] = wakeup
+            spin.eng_bind_wakeup(
+                wakeup=wakeup)
+            # Everyone gets a first turn.
+            wakeup.wake()
+        else:
+            self.polled_spins.append(spin_h)
     def init_orb(self, i_nearcast):
         '''
         Orb is a special kind of spin that does nearcasting.
@@ -189,13 +425,41 @@ class Engine(object):
     def del_spin(self, spin_h):
         # xxx unsubscribe logic if it is an orb
         del self.spins[spin_h]
+        if spin_h in self.polled_spins:
+            self.polled_spins.remove(spin_h)
+        if spin_h in self.d_spin_wakeup:
+            del self.d_spin_wakeup[spin_h]
     def turn(self, timeout=0):
         b_any_activity_at_all = False
+        metrics = self.metrics
+        if metrics != None:
+            t_turn = time.perf_counter()
+            self.select_wait = 0.0
+
+        # Timers
+        if self.timer_heap and self._fire_timers():
+            b_any_activity_at_all = True
+            if self.b_debug_eloop:
+                eloop_debug('timer activity')
 
-        spins_in_this_loop = list(self.spins.values())
-        for spin in spins_in_this_loop:
-            spin.eng_turn(
-                activity=self.activity)
+        # Spins. Legacy spins get polled. The others get a turn only if they
+        # have asked for one. Spins can be deleted by other spins during this
+        # section, hence the lookups against self.spins.
+        spins = self.spins
+        if self.polled_spins:
+            for spin_h in list(self.polled_spins):
+                if spin_h in spins:
+                    spins[spin_h].eng_turn(
+                        activity=self.activity)
+        if self.runnable_spins:
+            runnable_spins = self.runnable_spins
+            self.runnable_spins = []
+            for spin_h in runnable_spins:
+                if spin_h not in spins:
+                    continue
+                self.d_spin_wakeup[spin_h].b_runnable = False
+                spins[spin_h].eng_turn(
+                    activity=self.activity)
 
         # Determine if there was activity from the spins
         lst_orb_activity = self.activity.get()
@@ -206,7 +470,17 @@ class Engine(object):
                 for s in lst_orb_activity:
                     eloop_debug('*ACTIVITY* %s'%(s))
 
-        # Select
+        # Write out anything that has been logged since the last turn. Doing
+        # it before the select means that a net logger's datagrams can go out
+        # in this turn.
+        flush_log()
+
+        # Select. We must not sleep past the next timer, nor while there are
+        # spins waiting for a turn.
+        if self.runnable_spins:
+            timeout = 0
+        elif self.timer_heap:
+            timeout = self._bound_timeout_by_timers(timeout)
         activity_from_select = self._call_select(timeout)
         if activity_from_select:
             b_any_activity_at_all = True
@@ -215,13 +489,17 @@ class Engine(object):
 
         # If we have activity, we don't want select jamming
         # things up with delays.
-        if b_any_activity_at_all:
+        if b_any_activity_at_all or self.runnable_spins:
             # want no timeout in next loop
             timeout = 0
         else:
             # We are in a period of inactivity: let the next loop
             # select have some timeout.
             timeout = self.default_timeout
+        if metrics != None:
+            self.metric_turns.inc()
+            self.metric_turn_busy.record(
+                time.perf_counter() - t_turn - self.select_wait)
         return timeout
     def cycle(self):
         '''
@@ -242,6 +520,79 @@ class Engine(object):
         while True:
             timeout = self.turn(
                 timeout=timeout)
+    def open_timer(self, delay, b_recurring, cb_eng_timer):
+        '''
+        Schedules cb_eng_timer to be called in delay seconds. If b_recurring
+        is set, it will then be called every delay seconds until you cancel
+        it.
+
+        Returns a timer_h. Pass this to close_timer to cancel the timer.
+        It is safe to close a timer that has already fired.
+        '''
+        if b_recurring and delay <= 0:
+            raise Exception("Recurring timers need a positive delay.")
+        timer_h = self.timer_seq
+        self.timer_seq += 1
+        action = self.action_pool.pull(
+            timer_h=timer_h,
+            at_t=self.clock.now() + delay,
+            interval=delay,
+            cb_eng_timer=cb_eng_timer,
+            b_recurring=b_recurring)
+        self.d_timer[timer_h] = action
+        heapq.heappush(self.timer_heap, (action.at_t, timer_h, action))
+        return timer_h
+    def close_timer(self, timer_h):
+        if timer_h not in self.d_timer:
+            return
+        action = self.d_timer.pop(timer_h)
+        # The heap entry is discarded when it reaches the top. See
+        # _fire_timers.
+        action.b_live = False
+    def _bound_timeout_by_timers(self, timeout):
+        (at_t, seq, action) = self.timer_heap[0]
+        until = at_t - self.clock.now()
+        if until < 0:
+            return 0
+        if until < timeout:
+            return until
+        return timeout
+    def _fire_timers(self):
+        '''
+        Calls back any timers that are due. Returns True if any fired.
+        '''
+        b_fired = False
+        now = self.clock.now()
+        heap = self.timer_heap
+        while heap and heap[0][0] <= now:
+            (at_t, seq, action) = heapq.heappop(heap)
+            if not action.b_live:
+                self.action_pool.push(action)
+                continue
+            b_fired = True
+            #
+            # Reschedule recurring timers before the callback, so that the
+            # callback is free to close the timer.
+            if action.b_recurring:
+                action.at_t = at_t + action.interval
+                if action.at_t <= now:
+                    # We have fallen behind. Skip the missed runs rather than
+                    # firing a burst of catch-up callbacks.
+                    action.at_t = now + action.interval
+                heapq.heappush(heap, (action.at_t, seq, action))
+            else:
+                del self.d_timer[action.timer_h]
+                action.b_live = False
+            #
+            self.cs_eng_timer.engine = self
+            self.cs_eng_timer.timer_h = action.timer_h
+            self.cs_eng_timer.at_t = at_t
+            action.cb_eng_timer(
+                cs_eng_timer=self.cs_eng_timer)
+            #
+            if not action.b_recurring:
+                self.action_pool.push(action)
+        return b_fired
     def send(self, sid, bb):
         '''This is called send to correspond to user intent.
 
@@ -255,131 +606,203 @@ class Engine(object):
         in the mail, and carry on without further concern. So long as
         connectivity stays up, your user will get a copy of what was in
         bb when it was supplied to this method.
+
+        The copy is made once, into a sip from the engine mempool. If you
+        want to avoid even that copy, see send_sip and send_owned.
         '''
-        # --------------------------------------------------------
-        #   conversion logic from bb to sip
-        # --------------------------------------------------------
-        #
-        #   !   This is only needed whilst we are switching between the
-        #       new and old memory models.
-        #
+        ms = self._get_ms_for_send(
+            sid=sid,
+            size=len(bb))
         sip = self.mempool.alloc(
             size=len(bb))
         sip.arr[:] = bb
-        # --------------------------------------------------------
-        #   standard logic
-        # --------------------------------------------------------
-        #log('send sid:%s data_len:%s'%(sid, len(data)))
+        ms.add_to_send_queue(
+            bb=sip.arr,
+            sip=sip)
+    def send_sip(self, sid, sip):
+        '''
+        Hands a sip to the engine for sending, without copying it.
+
+        The sip must have been allocated from engine.mempool, and its whole
+        length is sent. The engine takes ownership: it returns the sip to the
+        mempool once it has been sent. You must not touch the sip after
+        calling this.
+        '''
+        ms = self._get_ms_for_send(
+            sid=sid,
+            size=len(sip))
+        ms.add_to_send_queue(
+            bb=sip.arr,
+            sip=sip)
+    def send_owned(self, sid, bb):
+        '''
+        Queues bb for sending, without copying it. bb can be bytes, a
+        bytearray or a memoryview.
+
+        The engine holds a reference to bb until it has been sent. You must
+        not modify the underlying memory in the meantime. Immutable bytes are
+        safe to pass to several sids at once, which makes this a good fit for
+        broadcasting the same payload.
+        '''
+        ms = self._get_ms_for_send(
+            sid=sid,
+            size=len(bb))
+        ms.add_to_send_queue(
+            bb=bb,
+            sip=None)
+    def _get_ms_for_send(self, sid, size):
         ms = self._get_ms_for_sid(sid)
         if not ms.can_it_send:
             raise Exception("%s does not have can_it_send"%(sid))
-        if len(bb) > self.mtu:
+        if size > self.mtu:
             raise Exception('Payload size %s is larger than mtu %s'%(
-                len(bb), self.mtu))
-        ms.copy_to_send_queue(
-            sip=sip)
-        # --------------------------------------------------------
-        #   cleanup of converstion logic
-        # --------------------------------------------------------
-        #
-        # This will need to go also
-        #
-        self.mempool.free(
-            sip=sip)
+                size, self.mtu))
+        return ms
+    def recv_view_on(self, sid):
+        '''
+        Switches sid into view mode for receives. The engine reads into a
+        sip from its mempool, and the bb in your recv callback is a
+        memoryview of that sip rather than a new bytes object.
+
+        The view is only valid for the duration of the callback. After that,
+        the memory is reused for the next read. If you need to keep the data,
+        either copy it, or call retain_recv from within the callback.
+        '''
+        ms = self._get_ms_for_sid(sid)
+        if not ms.can_it_recv:
+            raise Exception("%s does not have can_it_recv"%(sid))
+        ms.b_recv_view = True
+    def recv_view_off(self, sid):
+        ms = self._get_ms_for_sid(sid)
+        ms.b_recv_view = False
+    def retain_recv(self, sid):
+        '''
+        Call this from within a view-mode recv callback to take ownership of
+        the sip that holds the data. The first len(bb) bytes of sip.arr are
+        the data from the callback. The engine will use a fresh sip for its
+        next read. When you are finished, return the sip with
+        engine.mempool.free(sip).
+        '''
+        ms = self._get_ms_for_sid(sid)
+        return ms.retain_recv_sip()
     def add_custom_fd_read(self, cfd_h, fd, cb_eng_custom_fd_read):
-        self.d_eng_custom_read[fd] = (cfd_h, cb_eng_custom_fd_read)
+        fileno = fd_to_fileno(fd)
+        if fileno in self.d_eng_custom_read:
+            raise Exception("Already have a custom read for fd %s"%(fileno))
+        self.d_eng_custom_read[fileno] = (cfd_h, fd, cb_eng_custom_fd_read)
+        self.selector.register(
+            fd=fileno,
+            mask=SELECTOR_READ)
+    def remove_custom_fd_read(self, fd):
+        fileno = fd_to_fileno(fd)
+        if fileno not in self.d_eng_custom_read:
+            return
+        del self.d_eng_custom_read[fileno]
+        self.selector.unregister(
+            fd=fileno)
+    def _metasock_interest_changed(self, ms):
+        '''
+        Metasock calls this when its interest has changed. For example, its
+        send queue has gone from empty to non-empty, or a tcp client has
+        finished connecting.
+        '''
+        self.selector.modify(
+            fd=ms.fd,
+            mask=ms.interest)
+    def _wait_without_fds(self, timeout):
+        if self.metrics != None:
+            t_select = time.perf_counter()
+            time.sleep(timeout)
+            self.select_wait = time.perf_counter() - t_select
+            self.metric_select_wait.record(self.select_wait)
+        else:
+            time.sleep(timeout)
     def _call_select(self, timeout=0):
         "Return True or False depending on whether or not there was activity."
         #
         # Windows gives an OS error when you make a call to select with all
         # arguments being empty sets. We avoid this scenario by detecting if
         # there is no networking being done. In this case, we honour the
-        # timeout with a short sleep. [Emphasis: in the current logic below,
-        # xlist gets every socket in it. So if we get past this conditional,
-        # there should not be further circumstances in which the Windows error
-        # circumstance can be triggered.]
-        if 0 == len(self.sid_to_metasock) and not self.d_eng_custom_read:
-            time.sleep(timeout)
+        # timeout with a short sleep. [Emphasis: the select selector puts
+        # every registered socket in xlist. So if we get past this
+        # conditional, there should not be further circumstances in which the
+        # Windows error circumstance can be triggered.]
+        if 0 == self.selector.count():
+            if timeout > 0:
+                self._wait_without_fds(timeout)
             return False
         #
-        # Convenience for further down
-        sock_to_metasock = {}
-        def create_lookup_for_metasock(ms):
-            sock_to_metasock[ms.sock] = ms
+        # Note that we do not visit each metasock here to ask what it wants.
+        # The selector holds a registration table that metasocks keep up to
+        # date as their interest changes (see _metasock_interest_changed).
+        # So a turn costs us in proportion to the sockets that are ready,
+        # rather than to the sockets we hold.
         #
         # Say we're doing a read, and then find that we unexpectedly need
         # to shut the socket. In this case, we want a place to buffer the
-        # sockets that have been closed since the last select so we can
+        # metasocks that have been closed since the last select so we can
         # avoid processing them.
-        sock_ignore_list = []
-        # It is important we make a copy of this here, before the loop
-        # starts running
-        candidate_pairs = [pair
-            for pair
-            in self.sid_to_metasock.items()]
-        # This function combines the items above to give you socket resources
-        # that are still in play
-        def active_sid_ms_pairs():
-            'generator. yields (sid, ms).'
-            for (sid, ms) in candidate_pairs:
-                if ms.sock not in sock_ignore_list:
-                    yield (sid, ms)
+        ms_ignore_list = []
         #
         # All socket closes in the metasock give a callback. This allows us to
         # have cleanup functionality in a single place. The reason it's here
-        # rather than in metasock is so that we can access sock_ignore_list.
-        # This could probably be a global variable instead, but for the moment
-        # it's no big deal.
+        # rather than in metasock is so that we can access ms_ignore_list.
         def cb_ms_close(cs_ms_close):
             ms = cs_ms_close.ms
             sid = cs_ms_close.sid
             message = cs_ms_close.message
             #
-            sock_ignore_list.append(ms.sock)
+            ms_ignore_list.append(ms)
         self.cb_ms_close = cb_ms_close
         #
-        # Groundwork for the select
-        rlist = []
-        wlist = []
-        xlist = []
-        for (sid, ms) in active_sid_ms_pairs():
-            create_lookup_for_metasock(ms)
-            if ms.desire_for_readable_select_list():
-                rlist.append(ms.sock)
-            if ms.desire_for_writable_select_list():
-                wlist.append(ms.sock)
-            xlist.append(ms.sock)
-        for fd in self.d_eng_custom_read:
-            rlist.append(fd)
-        #
         # Select
-        rlist, wlist, xlist = select.select(rlist, wlist, xlist, timeout)
-        #log('select /r%s /w%s /x%s /t:%s'%(rlist, wlist, xlist, timeout))
+        if self.metrics != None:
+            t_select = time.perf_counter()
+            events = self.selector.select(timeout)
+            self.select_wait = time.perf_counter() - t_select
+            self.metric_select_wait.record(self.select_wait)
+        else:
+            events = self.selector.select(timeout)
+        #
+        # We resolve fds to metasocks before doing any work. Once callbacks
+        # start running, sockets can be closed and their fds reissued to new
+        # sockets (e.g. by an accept). A stale event must never reach the
+        # new owner of the fd.
+        ready = []
+        for (fd, mask) in events:
+            if fd in self.d_eng_custom_read:
+                ready.append( (None, fd, mask) )
+            else:
+                ready.append( (self.fd_to_metasock[fd], fd, mask) )
         #
         # Handle errors
-        for sock in xlist:
-            if sock in sock_ignore_list:
+        for (ms, fd, mask) in ready:
+            if ms == None or not mask & SELECTOR_EXCEPT:
+                continue
+            if ms in ms_ignore_list:
                 continue
-            ms = sock_to_metasock[sock]
             try:
                 ms.manage_exceptionable()
             except MetasockCloseCondition as e:
                 self._close_metasock(
                     sid=ms.sid,
                     reason=e.message)
-        for sock in rlist:
-            if sock in sock_ignore_list:
+        #
+        # Handle reads
+        for (ms, fd, mask) in ready:
+            if not mask & SELECTOR_READ:
                 continue
-            if sock in self.d_eng_custom_read:
-                tpl = self.d_eng_custom_read[sock]
-                fd = sock
-                (cfd_h, cb_eng_custom_fd_read) = tpl
+            if ms == None:
+                if fd not in self.d_eng_custom_read:
+                    continue
+                (cfd_h, cfd, cb_eng_custom_fd_read) = self.d_eng_custom_read[fd]
                 self._call_eng_custom_fd_read(
                     cfd_h=cfd_h,
-                    fd=fd,
+                    fd=cfd,
                     cb_eng_custom_fd_read=cb_eng_custom_fd_read)
                 continue
-            ms = sock_to_metasock[sock]
+            if ms in ms_ignore_list:
+                continue
             try:
                 ms.manage_readable()
             except MetasockCloseCondition as e:
@@ -388,10 +811,11 @@ class Engine(object):
                     reason=e.message)
         #
         # Handle writes (and pending connections)
-        for sock in wlist:
-            if sock in sock_ignore_list:
+        for (ms, fd, mask) in ready:
+            if ms == None or not mask & SELECTOR_WRITE:
+                continue
+            if ms in ms_ignore_list:
                 continue
-            ms = sock_to_metasock[sock]
             try:
                 ms.manage_writable()
             except MetasockCloseCondition as e:
@@ -406,11 +830,19 @@ class Engine(object):
         #
         # The caller may wish to use the return code to influence it on
         # the timeout that it passes in on a further iteration.
-        if rlist or wlist or xlist or sock_ignore_list:
+        if ready or ms_ignore_list:
             return True
         else:
             return False
-    def open_sub(self, addr, port, cb_sub_start, cb_sub_stop, cb_sub_recv):
+    def open_sub(self, addr, port, cb_sub_start, cb_sub_stop, cb_sub_recv, cb_sub_recv_batch=None):
+        '''
+        cb_sub_recv_batch: optional. If you supply it, datagrams are drained
+        in batches and handed to it as a list, and cb_sub_recv is not used
+        (you may pass None). This saves a callback per datagram on busy
+        feeds. See CsSubRecvBatch.
+        '''
+        if cb_sub_recv == None and cb_sub_recv_batch == None:
+            raise Exception("Need cb_sub_recv or cb_sub_recv_batch.")
         sid = self.create_sid()
         ms = metasock_create_sub(
             engine=self,
@@ -420,7 +852,29 @@ class Engine(object):
             port=port,
             cb_sub_start=cb_sub_start,
             cb_sub_stop=cb_sub_stop,
-            cb_sub_recv=cb_sub_recv)
+            cb_sub_recv=cb_sub_recv,
+            cb_sub_recv_batch=cb_sub_recv_batch)
+        return sid
+    def open_mcast_sub(self, addr, port, cb_sub_start, cb_sub_stop, cb_sub_recv, cb_sub_recv_batch=None, iface='0.0.0.0'):
+        '''
+        Joins the multicast group at addr. The callbacks are as for
+        open_sub, and you close it with close_sub. iface is the ip of the
+        interface to join on.
+        '''
+        if cb_sub_recv == None and cb_sub_recv_batch == None:
+            raise Exception("Need cb_sub_recv or cb_sub_recv_batch.")
+        sid = self.create_sid()
+        ms = metasock_create_mcast_sub(
+            engine=self,
+            mempool=self.mempool,
+            sid=sid,
+            addr=addr,
+            port=port,
+            iface=iface,
+            cb_sub_start=cb_sub_start,
+            cb_sub_stop=cb_sub_stop,
+            cb_sub_recv=cb_sub_recv,
+            cb_sub_recv_batch=cb_sub_recv_batch)
         return sid
     def close_sub(self, sub_sid):
         self._close_metasock(
@@ -437,11 +891,70 @@ class Engine(object):
             cb_pub_start=cb_pub_start,
             cb_pub_stop=cb_pub_stop)
         return sid
+    def open_mcast_pub(self, addr, port, cb_pub_start, cb_pub_stop, ttl=1, b_loop=True, iface=None):
+        '''
+        Opens a pub that sends to the multicast group at addr. Close it with
+        close_pub. See metasock_create_mcast_pub for the options.
+        '''
+        sid = self.create_sid()
+        ms = metasock_create_mcast_pub(
+            engine=self,
+            mempool=self.mempool,
+            sid=sid,
+            addr=addr,
+            port=port,
+            ttl=ttl,
+            b_loop=b_loop,
+            iface=iface,
+            cb_pub_start=cb_pub_start,
+            cb_pub_stop=cb_pub_stop)
+        return sid
+    def open_pub_fanout(self, dests, cb_pub_start, cb_pub_stop):
+        '''
+        Opens a pub that sends each datagram to every (addr, port) in dests.
+        One engine.send reaches them all, and the payload is only queued
+        once. You can change the list later with add_pub_dest and
+        remove_pub_dest.
+
+        The addr and port in cs_pub_start are None for this kind of pub.
+        '''
+        sid = self.create_sid()
+        ms = metasock_create_pub_fanout(
+            engine=self,
+            mempool=self.mempool,
+            sid=sid,
+            dests=dests,
+            cb_pub_start=cb_pub_start,
+            cb_pub_stop=cb_pub_stop)
+        return sid
+    def _get_ms_for_pub_fanout(self, pub_sid):
+        ms = self._get_ms_for_sid(pub_sid)
+        if ms.pub_dests == None:
+            raise Exception("%s is not a fanout pub."%(pub_sid))
+        return ms
+    def add_pub_dest(self, pub_sid, addr, port):
+        ms = self._get_ms_for_pub_fanout(pub_sid)
+        ms.add_pub_dest(
+            addr=addr,
+            port=port)
+    def remove_pub_dest(self, pub_sid, addr, port):
+        '''
+        Queued datagrams that have not yet gone out to this destination will
+        not be sent to it.
+        '''
+        ms = self._get_ms_for_pub_fanout(pub_sid)
+        ms.remove_pub_dest(
+            addr=addr,
+            port=port)
+    def get_pub_dests(self, pub_sid):
+        'Returns a list of (ip, port).'
+        ms = self._get_ms_for_pub_fanout(pub_sid)
+        return list(ms.pub_dests)
     def close_pub(self, pub_sid):
         self._close_metasock(
             sid=pub_sid,
             reason='close_pub %s'%(pub_sid))
-    def register_tcp_accept(self, accept_sock, addr, port, parent_sid, cb_tcp_accept_connect, cb_tcp_accept_condrop, cb_tcp_accept_recv):
+    def register_tcp_accept(self, accept_sock, addr, port, parent_sid, cb_tcp_accept_connect, cb_tcp_accept_condrop, cb_tcp_accept_recv, cb_tcp_accept_pressure, cb_tcp_accept_drain):
         """When metasock has a tcp server, it will create a new socket
         whenever it does an accept. At this point, it passes that new
         sock here so that we can set up a new metasock to manage it.
@@ -457,13 +970,28 @@ class Engine(object):
             parent_sid=parent_sid,
             cb_tcp_accept_connect=cb_tcp_accept_connect,
             cb_tcp_accept_condrop=cb_tcp_accept_condrop,
-            cb_tcp_accept_recv=cb_tcp_accept_recv)
+            cb_tcp_accept_recv=cb_tcp_accept_recv,
+            cb_tcp_accept_pressure=cb_tcp_accept_pressure,
+            cb_tcp_accept_drain=cb_tcp_accept_drain)
         return accept_sid
     def close_tcp_accept(self, accept_sid):
         self._close_metasock(
             sid=accept_sid,
             reason='close_tcp_accept %s'%accept_sid)
-    def open_tcp_server(self, addr, port, cb_tcp_server_start, cb_tcp_server_stop, cb_tcp_accept_connect, cb_tcp_accept_condrop, cb_tcp_accept_recv):
+    def open_tcp_server(self, addr, port, cb_tcp_server_start, cb_tcp_server_stop, cb_tcp_accept_connect, cb_tcp_accept_condrop, cb_tcp_accept_recv, backlog=socket.SOMAXCONN, cb_tcp_accept_pressure=None, cb_tcp_accept_drain=None, reuseport=False):
+        '''
+        backlog: the depth of the kernel's queue of connections that have
+        not yet been accepted. Under a connect storm, a shallow queue causes
+        the kernel to drop connection attempts.
+
+        reuseport: sets SO_REUSEPORT on the listener. This allows several
+        processes to each bind their own listener to the same addr/port, and
+        the kernel spreads incoming connections between them. See
+        solent.eng.multi.
+
+        cb_tcp_accept_pressure, cb_tcp_accept_drain: optional. See
+        set_send_watermarks.
+        '''
         sid = self.create_sid()
         ms = metasock_create_tcp_server(
             engine=self,
@@ -471,17 +999,25 @@ class Engine(object):
             sid=sid,
             addr=addr,
             port=port,
+            backlog=backlog,
+            reuseport=reuseport,
             cb_tcp_server_start=cb_tcp_server_start,
             cb_tcp_server_stop=cb_tcp_server_stop,
             cb_tcp_accept_connect=cb_tcp_accept_connect,
             cb_tcp_accept_condrop=cb_tcp_accept_condrop,
-            cb_tcp_accept_recv=cb_tcp_accept_recv)
+            cb_tcp_accept_recv=cb_tcp_accept_recv,
+            cb_tcp_accept_pressure=cb_tcp_accept_pressure,
+            cb_tcp_accept_drain=cb_tcp_accept_drain)
         return sid
     def close_tcp_server(self, server_sid):
         self._close_metasock(
             sid=server_sid,
             reason='close_tcp_server %s'%server_sid)
-    def open_tcp_client(self, addr, port, cb_tcp_client_connect, cb_tcp_client_condrop, cb_tcp_client_recv):
+    def open_tcp_client(self, addr, port, cb_tcp_client_connect, cb_tcp_client_condrop, cb_tcp_client_recv, cb_tcp_client_pressure=None, cb_tcp_client_drain=None):
+        '''
+        cb_tcp_client_pressure, cb_tcp_client_drain: optional. See
+        set_send_watermarks.
+        '''
         sid = self.create_sid()
         ms = metasock_create_tcp_client(
             engine=self,
@@ -491,12 +1027,77 @@ class Engine(object):
             port=port,
             cb_tcp_client_connect=cb_tcp_client_connect,
             cb_tcp_client_condrop=cb_tcp_client_condrop,
-            cb_tcp_client_recv=cb_tcp_client_recv)
+            cb_tcp_client_recv=cb_tcp_client_recv,
+            cb_tcp_client_pressure=cb_tcp_client_pressure,
+            cb_tcp_client_drain=cb_tcp_client_drain)
         return sid
     def close_tcp_client(self, client_sid):
         self._close_metasock(
             sid=client_sid,
             reason='close_tcp_client %s'%client_sid)
+    #
+    # Unix domain sockets. These have the same callbacks as their tcp and
+    # udp equivalents, and you close them with close_tcp_server,
+    # close_tcp_client, close_pub and close_sub. In the cs structs, addr is
+    # the path and port is None.
+    def open_unix_server(self, path, cb_tcp_server_start, cb_tcp_server_stop, cb_tcp_accept_connect, cb_tcp_accept_condrop, cb_tcp_accept_recv, backlog=socket.SOMAXCONN, cb_tcp_accept_pressure=None, cb_tcp_accept_drain=None):
+        '''
+        Listens on the unix domain socket at path. A stale socket file at
+        path is removed, and the file is removed again when the server is
+        closed.
+        '''
+        sid = self.create_sid()
+        ms = metasock_create_unix_server(
+            engine=self,
+            mempool=self.mempool,
+            sid=sid,
+            path=path,
+            backlog=backlog,
+            cb_tcp_server_start=cb_tcp_server_start,
+            cb_tcp_server_stop=cb_tcp_server_stop,
+            cb_tcp_accept_connect=cb_tcp_accept_connect,
+            cb_tcp_accept_condrop=cb_tcp_accept_condrop,
+            cb_tcp_accept_recv=cb_tcp_accept_recv,
+            cb_tcp_accept_pressure=cb_tcp_accept_pressure,
+            cb_tcp_accept_drain=cb_tcp_accept_drain)
+        return sid
+    def open_unix_client(self, path, cb_tcp_client_connect, cb_tcp_client_condrop, cb_tcp_client_recv, cb_tcp_client_pressure=None, cb_tcp_client_drain=None):
+        sid = self.create_sid()
+        ms = metasock_create_unix_client(
+            engine=self,
+            mempool=self.mempool,
+            sid=sid,
+            path=path,
+            cb_tcp_client_connect=cb_tcp_client_connect,
+            cb_tcp_client_condrop=cb_tcp_client_condrop,
+            cb_tcp_client_recv=cb_tcp_client_recv,
+            cb_tcp_client_pressure=cb_tcp_client_pressure,
+            cb_tcp_client_drain=cb_tcp_client_drain)
+        return sid
+    def open_unix_pub(self, path, cb_pub_start, cb_pub_stop):
+        sid = self.create_sid()
+        ms = metasock_create_unix_pub(
+            engine=self,
+            mempool=self.mempool,
+            sid=sid,
+            path=path,
+            cb_pub_start=cb_pub_start,
+            cb_pub_stop=cb_pub_stop)
+        return sid
+    def open_unix_sub(self, path, cb_sub_start, cb_sub_stop, cb_sub_recv, cb_sub_recv_batch=None):
+        if cb_sub_recv == None and cb_sub_recv_batch == None:
+            raise Exception("Need cb_sub_recv or cb_sub_recv_batch.")
+        sid = self.create_sid()
+        ms = metasock_create_unix_sub(
+            engine=self,
+            mempool=self.mempool,
+            sid=sid,
+            path=path,
+            cb_sub_start=cb_sub_start,
+            cb_sub_stop=cb_sub_stop,
+            cb_sub_recv=cb_sub_recv,
+            cb_sub_recv_batch=cb_sub_recv_batch)
+        return sid
     def _call_eng_custom_fd_read(self, cfd_h, fd, cb_eng_custom_fd_read):
         self.cs_eng_custom_fd_read.cfd_h = cfd_h
         self.cs_eng_custom_fd_read.fd = fd
@@ -509,15 +1110,33 @@ class Engine(object):
         called against the metasock. That way if any of those sockets try to
         send as part of their initialisation callbacks, the sid will be
         waiting in this map already.
+
+        This is also where the socket gets registered with the selector.
         '''
+        ms.fd = ms.sock.fileno()
+        ms.interest = ms.calculate_interest()
         self.sid_to_metasock[sid] = ms
+        self.fd_to_metasock[ms.fd] = ms
+        self.selector.register(
+            fd=ms.fd,
+            mask=ms.interest)
+        if self.metrics != None:
+            self.metric_ms_opened.inc()
     def _get_ms_for_sid(self, sid):
         return self.sid_to_metasock[sid]
     def _close_metasock(self, sid, reason):
         ms = self._get_ms_for_sid(
             sid=sid)
+        #
+        # The selector must let go of the fd before the socket is closed.
+        self.selector.unregister(
+            fd=ms.fd)
+        del self.fd_to_metasock[ms.fd]
         ms.eng_close(reason)
+        ms.release_buffers()
         del self.sid_to_metasock[sid]
+        if self.metrics != None:
+            self.metric_ms_closed.inc()
         #
         # If we are in the middle of a select loop, there is a mechanism
         # that avoids us from (example) tripping over our laces by trying to
@@ -529,6 +1148,5 @@ class Engine(object):
             self.cb_ms_close(
                 cs_ms_close=self.cs_ms_close)
         #
-        log('metasock %s closed [reason: %s]'%(
-            ms.sid, reason))
+        log('metasock %s closed [reason: %s]', ms.sid, reason)
 
@@ -53,23 +53,42 @@ from .cs import CsPubStop
 from .cs import CsSubStart
 from .cs import CsSubStop
 from .cs import CsSubRecv
+from .cs import CsSubRecvBatch
 from .cs import CsTcpClientCondrop
 from .cs import CsTcpClientConnect
+from .cs import CsTcpClientDrain
+from .cs import CsTcpClientPressure
 from .cs import CsTcpClientRecv
 from .cs import CsTcpAcceptCondrop
 from .cs import CsTcpAcceptConnect
+from .cs import CsTcpAcceptDrain
+from .cs import CsTcpAcceptPressure
 from .cs import CsTcpAcceptRecv
 from .cs import CsTcpServerStart
 from .cs import CsTcpServerStop
 
+from .selector import SELECTOR_READ
+from .selector import SELECTOR_WRITE
+
 from solent import hexdump
 from solent import log
 
 from collections import deque
 import errno
+import ipaddress
+import os
 import socket
+import stat
+import struct
 import traceback
 
+# On Windows, sockets have no sendmsg.
+B_HAVE_SENDMSG = hasattr(socket.socket, 'sendmsg')
+
+# The most buffers we will offer to a single sendmsg. (Linux will not take
+# more than 1024.)
+SEND_IOV_MAX = 64
+
 def l_cb_error(cb_struct):
     def fn(**args):
         raise Exception(cb_struct)
@@ -98,9 +117,9 @@ class Metasock(object):
     information separately.
     
     An instance of this class tracks whether you want for it to be read from
-    or written to. This information will be used for contructing a select call
-    on the fly, and for appropriately managing a socket when it is market as
-    ready-for-action by the return from select().
+    or written to. This information is pushed to the engine's selector
+    whenever it changes (see refresh_interest), and is used for appropriately
+    managing a socket when it is marked as ready-for-action by the selector.
 
     // Anything else?
 
@@ -120,15 +139,55 @@ class Metasock(object):
         self.port = port
         #
         self.sock = None
+        self.fd = None
+        self.interest = 0
         self.parent_sid = None
         #
         self.can_it_recv = False
-        self.recv_len = engine.mtu
+        #
+        # View mode. See Engine.recv_view_on.
+        self.b_recv_view = False
+        self.b_recv_view_live = False
+        self.recv_sip = None
+        self.recv_mv = None
         #
         self.can_it_send = False
-        self.send_buf = deque() # buffers sips
+        # Buffers waiting to be sent. These are bytes-like objects.
+        self.send_buf = deque()
+        # Runs parallel to send_buf. For each buffer, the sip that owns its
+        # memory (and which we return to the mempool once it is sent), or
+        # None where the buffer was handed to us by the caller.
+        self.send_sips = deque()
+        # How far into the buffer at the head of send_buf we have sent.
+        self.send_offset = 0
+        # Fan-out pubs. The list of (ip, port) that each datagram goes to,
+        # and how far through that list we have got with the datagram at the
+        # head of send_buf. For ordinary (connected) pubs, pub_dests is None.
+        self.pub_dests = None
+        self.pub_dest_idx = 0
+        # Total length of the buffers in send_buf. (Subtract send_offset to
+        # get the number of bytes that are still to go.)
+        self.send_buf_bytes = 0
+        #
+        # Backpressure. See Engine.set_send_watermarks.
+        self.send_high_water = engine.default_send_high_water
+        self.send_low_water = engine.default_send_low_water
+        self.b_send_pressure = False
+        #
+        # These are cheap to keep, and are reported by the engine's metrics.
+        self.count_recv_bytes = 0
+        self.count_recv_calls = 0
+        self.count_send_bytes = 0
+        self.count_send_calls = 0
         #
         self.b_tcp_client_connecting = False
+        # Unix domain sockets can fail to connect straight away, rather than
+        # via SO_ERROR. We hold the errno here until the socket is writable.
+        self.connect_ec = 0
+        # For unix domain servers and subs, the path that we bound to, and
+        # which we remove when we close.
+        self.unix_path = None
+        self.b_closed = False
         #
         self.cb_pub_start = l_cb_error('cb_pub_start not set')
         self.cs_pub_start = CsPubStart()
@@ -140,12 +199,26 @@ class Metasock(object):
         self.cs_sub_stop = CsSubStop()
         self.cb_sub_recv = l_cb_error('cb_sub_recv not set')
         self.cs_sub_recv = CsSubRecv()
+        # Optional. When set, subs deliver datagrams in batches. See
+        # _recv_datagram_batch.
+        self.cb_sub_recv_batch = None
+        self.cs_sub_recv_batch = CsSubRecvBatch()
+        self.sub_batch_entries = []
         self.cb_tcp_accept_recv = l_cb_error('cb_tcp_accept_recv not set')
         self.cs_tcp_accept_recv = CsTcpAcceptRecv()
         self.cb_tcp_accept_connect = l_cb_error('cb_tcp_accept_connect not set')
         self.cs_tcp_accept_connect = CsTcpAcceptConnect()
         self.cb_tcp_accept_condrop = l_cb_error('cb_tcp_accept_condrop not set')
         self.cs_tcp_accept_condrop = CsTcpAcceptCondrop()
+        # The pressure and drain callbacks are optional.
+        self.cb_tcp_accept_pressure = None
+        self.cs_tcp_accept_pressure = CsTcpAcceptPressure()
+        self.cb_tcp_accept_drain = None
+        self.cs_tcp_accept_drain = CsTcpAcceptDrain()
+        self.cb_tcp_client_pressure = None
+        self.cs_tcp_client_pressure = CsTcpClientPressure()
+        self.cb_tcp_client_drain = None
+        self.cs_tcp_client_drain = CsTcpClientDrain()
         self.cb_tcp_client_connect = l_cb_error('cb_tcp_client_connect not set')
         self.cs_tcp_client_connect = CsTcpClientConnect()
         self.cb_tcp_client_condrop = l_cb_error('cb_tcp_client_condrop not set')
@@ -219,6 +292,9 @@ class Metasock(object):
             self.sock.close()
         except:
             pass
+        if self.unix_path != None:
+            unlink_unix_path(self.unix_path)
+        self.b_closed = True
         #
         if self.ms_type == MS_TYPE_PUB:
             self.cs_pub_stop.engine = self.engine
@@ -269,9 +345,112 @@ class Metasock(object):
         if self.can_it_send and self.send_buf:
             return True
         return False
-    def copy_to_send_queue(self, sip):
-        self.send_buf.append(
-            self.mempool.clone(sip))
+    def calculate_interest(self):
+        '''
+        Returns the selector mask that corresponds to what this metasock
+        wants from the select loop at the moment.
+        '''
+        mask = 0
+        if self.desire_for_readable_select_list():
+            mask |= SELECTOR_READ
+        if self.desire_for_writable_select_list():
+            mask |= SELECTOR_WRITE
+        return mask
+    def refresh_interest(self):
+        '''
+        Call this whenever something has happened that could change the
+        answers from the desire_for_* methods. Engine holds a registration
+        table for the selector, and we tell it when we have changed. This is
+        much cheaper than having the engine interrogate every metasock on
+        every turn.
+        '''
+        interest = self.calculate_interest()
+        if interest == self.interest:
+            return
+        self.interest = interest
+        self.engine._metasock_interest_changed(self)
+    def add_to_send_queue(self, bb, sip):
+        '''
+        Takes ownership of bb. If sip is not None, it is the mempool sip
+        behind bb, and will be freed once bb has been sent.
+        '''
+        b_was_empty = not self.send_buf
+        self.send_buf.append(bb)
+        self.send_sips.append(sip)
+        self.send_buf_bytes += len(bb)
+        self.engine.send_queue_bytes += len(bb)
+        if b_was_empty:
+            self.refresh_interest()
+        if not self.b_send_pressure and self.get_send_queue_depth() > self.send_high_water:
+            self.b_send_pressure = True
+            self._call_send_pressure()
+    def get_send_queue_depth(self):
+        'Returns the number of bytes that are queued but not yet sent.'
+        return self.send_buf_bytes - self.send_offset
+    def _check_send_drain(self):
+        if not self.b_send_pressure:
+            return
+        if self.get_send_queue_depth() > self.send_low_water:
+            return
+        self.b_send_pressure = False
+        self._call_send_drain()
+    def _call_send_pressure(self):
+        queued_bytes = self.get_send_queue_depth()
+        if self.ms_type == MS_TYPE_TCP_ACCEPT:
+            if self.cb_tcp_accept_pressure == None:
+                return
+            self.cs_tcp_accept_pressure.engine = self.engine
+            self.cs_tcp_accept_pressure.accept_sid = self.sid
+            self.cs_tcp_accept_pressure.queued_bytes = queued_bytes
+            self.cb_tcp_accept_pressure(
+                cs_tcp_accept_pressure=self.cs_tcp_accept_pressure)
+        elif self.ms_type == MS_TYPE_TCP_CLIENT:
+            if self.cb_tcp_client_pressure == None:
+                return
+            self.cs_tcp_client_pressure.engine = self.engine
+            self.cs_tcp_client_pressure.client_sid = self.sid
+            self.cs_tcp_client_pressure.queued_bytes = queued_bytes
+            self.cb_tcp_client_pressure(
+                cs_tcp_client_pressure=self.cs_tcp_client_pressure)
+    def _call_send_drain(self):
+        queued_bytes = self.get_send_queue_depth()
+        if self.ms_type == MS_TYPE_TCP_ACCEPT:
+            if self.cb_tcp_accept_drain == None:
+                return
+            self.cs_tcp_accept_drain.engine = self.engine
+            self.cs_tcp_accept_drain.accept_sid = self.sid
+            self.cs_tcp_accept_drain.queued_bytes = queued_bytes
+            self.cb_tcp_accept_drain(
+                cs_tcp_accept_drain=self.cs_tcp_accept_drain)
+        elif self.ms_type == MS_TYPE_TCP_CLIENT:
+            if self.cb_tcp_client_drain == None:
+                return
+            self.cs_tcp_client_drain.engine = self.engine
+            self.cs_tcp_client_drain.client_sid = self.sid
+            self.cs_tcp_client_drain.queued_bytes = queued_bytes
+            self.cb_tcp_client_drain(
+                cs_tcp_client_drain=self.cs_tcp_client_drain)
+    def _retire_head_of_send_queue(self):
+        bb = self.send_buf.popleft()
+        self.send_buf_bytes -= len(bb)
+        self.engine.send_queue_bytes -= len(bb)
+        self.send_offset = 0
+        sip = self.send_sips.popleft()
+        if sip != None:
+            self.mempool.free(
+                sip=sip)
+    def release_buffers(self):
+        '''
+        Returns any sips we hold to the mempool. Engine calls this once the
+        metasock has been closed.
+        '''
+        while self.send_buf:
+            self._retire_head_of_send_queue()
+        if self.recv_sip != None:
+            self.mempool.free(
+                sip=self.recv_sip)
+            self.recv_sip = None
+            self.recv_mv = None
     def manage_exceptionable(self):
         '''
         Managed socket has appeared in xlist in the select. At some point we
@@ -295,7 +474,192 @@ class Metasock(object):
         #
         # // server socket codepath
         if self.ms_type == MS_TYPE_TCP_SERVER:
-            (accept_sock, (addr, port)) = self.sock.accept()
+            self._accept_pending_connections()
+            return
+        #
+        # // non-server socket codepath
+        #
+        if self.cb_sub_recv_batch != None:
+            self._recv_datagram_batch()
+            return
+        #
+        # Select told us there is something to read. Rather than take one
+        # bite and then wait for a whole turn of the event loop to come
+        # around again, we keep reading until the socket runs dry (EAGAIN)
+        # or we have used up this socket's budget for the turn. The budget
+        # is what stops a fast sender from starving every other socket.
+        recv_size = self.engine.recv_size
+        max_bytes = self.engine.read_budget_bytes
+        max_reads = self.engine.read_budget_reads
+        total = 0
+        reads = 0
+        while reads < max_reads and total < max_bytes:
+            b_recv_view = self.b_recv_view
+            try:
+                if b_recv_view:
+                    bb = self._recv_view(recv_size)
+                else:
+                    bb = self.sock.recv(recv_size)
+            except (BlockingIOError, InterruptedError):
+                # Drained.
+                return
+            except Exception as e:
+                # If you're going to disappear errors here, do it with an
+                # exception that is specific to a real read_fail. Note,
+                # * You can't count on e.message existing
+                # * Ugly string comparison might be the only way to do it
+                log('recv exception [sid %s] [%s]'%(self.sid, str(e)))
+                raise MetasockCloseCondition('read_fail')
+            if self.ms_type == MS_TYPE_SUB and bb != None:
+                # For datagrams, empty is a valid message rather than a
+                # sign that the other side has gone away.
+                pass
+            elif bb in (None,) or 0 == len(bb):
+                # In this case, it's presumed that select told you that it
+                # was good to read from this, and yet when you went to read
+                # there wasn't anything empty. This indicates that it's time
+                # to close the socket, which we'll now do.
+                #
+                # Note that we're telling the network engine that we're done
+                # here, and not calling our own close method directly. This
+                # is so that cleanup happens properly.
+                self.engine._close_metasock(self.sid, 'empty_recv')
+                return
+            reads += 1
+            total += len(bb)
+            self.count_recv_calls += 1
+            self.count_recv_bytes += len(bb)
+            if b_recv_view:
+                self.b_recv_view_live = True
+                self._dispatch_recv(bb)
+                self.b_recv_view_live = False
+                if self.recv_sip != None:
+                    # The consumer did not retain the sip, and we are about
+                    # to reuse its memory. Releasing the view means that
+                    # anything that has hung onto it gets an error rather
+                    # than silently reading the next message.
+                    try:
+                        bb.release()
+                    except BufferError:
+                        pass
+            else:
+                self._dispatch_recv(bb)
+            #
+            # The callback may have closed us.
+            if self.b_closed:
+                return
+    def _recv_datagram_batch(self):
+        '''
+        Drains datagrams into one preallocated buffer, and then hands them to
+        the consumer together as a list of (memoryview, addr).
+
+        Datagrams are packed end to end. We only read while there is at least
+        recv_size of room left, so nothing is ever truncated. The buffer
+        comes from the mempool once, and is reused for every batch.
+        '''
+        engine = self.engine
+        recv_size = engine.recv_size
+        max_bytes = engine.read_budget_bytes
+        max_reads = engine.read_budget_reads
+        size = max_bytes + recv_size
+        sip = self.recv_sip
+        if sip == None or sip.size != size:
+            if sip != None:
+                self.mempool.free(
+                    sip=sip)
+            sip = self.mempool.alloc(
+                size=size)
+            self.recv_sip = sip
+            self.recv_mv = memoryview(sip.arr)
+        mv = self.recv_mv
+        recvfrom_into = self.sock.recvfrom_into
+        entries = self.sub_batch_entries
+        offset = 0
+        try:
+            while len(entries) < max_reads and offset <= max_bytes:
+                try:
+                    (n, addr) = recvfrom_into(mv[offset:], recv_size)
+                except (BlockingIOError, InterruptedError):
+                    # Drained.
+                    break
+                except Exception as e:
+                    log('recv exception [sid %s] [%s]', self.sid, str(e))
+                    raise MetasockCloseCondition('read_fail')
+                entries.append( (mv[offset:offset+n], addr) )
+                offset += n
+            if not entries:
+                return
+            self.count_recv_calls += len(entries)
+            self.count_recv_bytes += offset
+            self.cs_sub_recv_batch.engine = engine
+            self.cs_sub_recv_batch.sub_sid = self.sid
+            self.cs_sub_recv_batch.entries = entries
+            self.cb_sub_recv_batch(
+                cs_sub_recv_batch=self.cs_sub_recv_batch)
+        finally:
+            # The buffer gets reused for the next batch. Releasing the views
+            # means that anything that has hung on to one gets an error,
+            # rather than silently reading a later datagram.
+            for (view, addr) in entries:
+                try:
+                    view.release()
+                except BufferError:
+                    pass
+            entries.clear()
+    def _recv_view(self, recv_size):
+        '''
+        Reads into our pooled sip, and returns a memoryview of what arrived.
+        In steady state, this allocates no buffers.
+        '''
+        sip = self.recv_sip
+        if sip == None or sip.size != recv_size:
+            if sip != None:
+                self.mempool.free(
+                    sip=sip)
+            sip = self.mempool.alloc(
+                size=recv_size)
+            self.recv_sip = sip
+            self.recv_mv = memoryview(sip.arr)
+        n = self.sock.recv_into(sip.arr, recv_size)
+        return self.recv_mv[:n]
+    def retain_recv_sip(self):
+        '''
+        Hands the sip behind the current view-mode recv to the caller. See
+        Engine.retain_recv.
+        '''
+        if not self.b_recv_view_live:
+            raise Exception("retain is only valid in a view-mode recv callback.")
+        sip = self.recv_sip
+        self.recv_sip = None
+        self.recv_mv = None
+        return sip
+    def _accept_pending_connections(self):
+        '''
+        A readable server socket can have many connections queued behind it.
+        We accept until the queue is empty, or until we reach the engine's
+        accept budget for a turn.
+        '''
+        for i in range(self.engine.accept_budget):
+            try:
+                (accept_sock, sockaddr) = self.sock.accept()
+            except (BlockingIOError, InterruptedError):
+                # Queue is empty.
+                return
+            except ConnectionAbortedError:
+                # The client gave up before we got to it.
+                continue
+            except OSError as e:
+                # For example, we have run out of file descriptors. This is
+                # not a reason to take down the server. The connections will
+                # wait in the backlog until the next turn.
+                log('accept exception [sid %s] [%s]'%(self.sid, str(e)))
+                return
+            if self.unix_path != None:
+                # Unix domain clients are usually unnamed. We report the
+                # path of the server they came in on.
+                (addr, port) = (self.unix_path, None)
+            else:
+                (addr, port) = sockaddr[:2]
             self.engine.register_tcp_accept(
                 accept_sock=accept_sock,
                 addr=addr,
@@ -303,32 +667,15 @@ class Metasock(object):
                 parent_sid=self.sid,
                 cb_tcp_accept_connect=self.cb_tcp_accept_connect,
                 cb_tcp_accept_condrop=self.cb_tcp_accept_condrop,
-                cb_tcp_accept_recv=self.cb_tcp_accept_recv)
-            return
-        #
-        # // non-server socket codepath
-        try:
-            bb = self.sock.recv(self.recv_len)
-        except Exception as e:
-            # If you're going to disappear errors here, do it with an
-            # exception that is specific to a real read_fail. Note,
-            # * You can't count on e.message existing
-            # * Ugly string comparison might be the only way to do it
-            log('recv exception [sid %s] [%s]'%(self.sid, str(e)))
-            raise MetasockCloseCondition('read_fail')
-            return
-        if bb in (None,) or 0 == len(bb):
-            # In this case, it's presumed that select told you that it
-            # was good to read from this, and yet when you went to read
-            # there wasn't anything empty. This indicates that it's time
-            # to close the socket, which we'll now do.
+                cb_tcp_accept_recv=self.cb_tcp_accept_recv,
+                cb_tcp_accept_pressure=self.cb_tcp_accept_pressure,
+                cb_tcp_accept_drain=self.cb_tcp_accept_drain)
             #
-            # Note that we're telling the network engine that we're done
-            # here, and not calling our own close method directly. This
-            # is so that cleanup happens properly.
-            self.engine._close_metasock(self.sid, 'empty_recv')
-            return
-        #
+            # The connect callback may have closed the server. (Line console
+            # does this, for example.)
+            if self.b_closed:
+                return
+    def _dispatch_recv(self, bb):
         if self.ms_type == MS_TYPE_PUB:
             raise Exception("This port should never recv.")
         elif self.ms_type == MS_TYPE_SUB:
@@ -370,11 +717,12 @@ class Metasock(object):
         if not self.can_it_send:
             raise Exception("%s is not a send sock."%self.sid)
         if self.b_tcp_client_connecting:
-            ec = self.sock.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
-            log('b_tcp_client_connecting %s'%ec)
+            ec = self.connect_ec or self.sock.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
+            log('b_tcp_client_connecting %s', ec)
             if 0 == ec:
                 # :ms_successful_connection_as_tcp_client
                 self.b_tcp_client_connecting = False
+                self.refresh_interest()
                 self.cs_tcp_client_connect.engine = self.engine
                 self.cs_tcp_client_connect.client_sid = self.sid
                 self.cs_tcp_client_connect.addr = self.addr
@@ -391,38 +739,138 @@ class Metasock(object):
                               ] )
                 raise MetasockCloseCondition(r)
             return
+        if not self.send_buf:
+            return
         try:
-            if self.send_buf:
-                sip = self.send_buf.popleft()
-                bb = sip.get()
-                send_size = self.sock.send(bb)
-                if send_size == len(bb):
-                    # Ideal situation: our send was successful
-                    self.mempool.free(
-                        sip=sip)
-                elif 0 == send_size:
-                    # Network conjestion or slow throughput by the reader
-                    # is causing things to back up. This will happen from
-                    # time to time in normal operation.
-                    self.send_buf.appendleft(sip)
-                else:
-                    # This is weird. Since our bb must be smaller than
-                    # the MTU size, this should never happen.
-                    raise Algorithm("Weird: partial payload send. %s of %s"%(
-                        send_size, len(bb)))
+            if self.pub_dests != None:
+                self._send_datagrams_fanout()
+            elif self.ms_type == MS_TYPE_PUB:
+                self._send_datagrams()
+            else:
+                self._send_stream()
+        except (BlockingIOError, InterruptedError):
+            # Network conjestion or slow throughput by the reader is causing
+            # things to back up. This will happen from time to time in normal
+            # operation. What we have not sent stays queued, and we will be
+            # back when select says there is room.
+            pass
         except:
             # When you try to do a send to a BSD socket that is in the
             # process of going down, you can get an exception. This caterss
             # for that scenario.
             raise MetasockCloseCondition('send_fail')
-            return
+        if not self.send_buf:
+            self.refresh_interest()
+        self._check_send_drain()
+    def _send_stream(self):
+        '''
+        For stream sockets, message boundaries mean nothing to the kernel. So
+        we hand it as many queued buffers as we can in a single sendmsg, and
+        keep going until the queue is empty or the kernel pushes back.
+
+        The kernel may take only part of what we offer. send_offset records
+        how far we have got through the buffer at the head of the queue.
+        '''
+        send_buf = self.send_buf
+        while send_buf:
+            if B_HAVE_SENDMSG:
+                iov = [memoryview(send_buf[0])[self.send_offset:]]
+                offered = len(iov[0])
+                for (idx, bb) in enumerate(send_buf):
+                    if idx == 0:
+                        continue
+                    if idx == SEND_IOV_MAX:
+                        break
+                    iov.append(bb)
+                    offered += len(bb)
+                sent = self.sock.sendmsg(iov)
+            else:
+                # Windows has no sendmsg
+                bb = memoryview(send_buf[0])[self.send_offset:]
+                offered = len(bb)
+                sent = self.sock.send(bb)
+            self.count_send_calls += 1
+            self.count_send_bytes += sent
+            #
+            # Retire everything that went out in full
+            remaining = sent
+            while send_buf:
+                left_in_head = len(send_buf[0]) - self.send_offset
+                if remaining < left_in_head:
+                    self.send_offset += remaining
+                    break
+                remaining -= left_in_head
+                self._retire_head_of_send_queue()
+            #
+            if sent < offered:
+                # The kernel buffer is full. Trying again now would only
+                # earn us an EAGAIN.
+                return
+    def _send_datagrams(self):
+        '''
+        Each queued buffer is its own datagram. We cannot merge them, but we
+        can send as many as the kernel will take in one visit.
+        '''
+        send_buf = self.send_buf
+        while send_buf:
+            sent = self.sock.send(send_buf[0])
+            self.count_send_calls += 1
+            self.count_send_bytes += sent
+            self._retire_head_of_send_queue()
+    def _send_datagrams_fanout(self):
+        '''
+        As for _send_datagrams, but each queued buffer goes to every
+        destination. If the kernel pushes back part way through the list,
+        pub_dest_idx records where to pick up.
+
+        A failure to reach one destination must not stop the others from
+        getting their copy, so we log it and move on.
+        '''
+        send_buf = self.send_buf
+        dests = self.pub_dests
+        sendto = self.sock.sendto
+        while send_buf:
+            bb = send_buf[0]
+            while self.pub_dest_idx < len(dests):
+                dest = dests[self.pub_dest_idx]
+                try:
+                    sent = sendto(bb, dest)
+                    self.count_send_calls += 1
+                    self.count_send_bytes += sent
+                except (BlockingIOError, InterruptedError):
+                    raise
+                except OSError as e:
+                    log('pub %s: send to %s:%s failed [%s]',
+                        self.sid, dest[0], dest[1], e)
+                self.pub_dest_idx += 1
+            self.pub_dest_idx = 0
+            self._retire_head_of_send_queue()
+    def add_pub_dest(self, addr, port):
+        dest = (socket.gethostbyname(addr), port)
+        if dest in self.pub_dests:
+            raise Exception("pub %s already sends to %s:%s"%(
+                self.sid, addr, port))
+        self.pub_dests.append(dest)
+    def remove_pub_dest(self, addr, port):
+        dest = (socket.gethostbyname(addr), port)
+        if dest not in self.pub_dests:
+            raise Exception("pub %s does not send to %s:%s"%(
+                self.sid, addr, port))
+        idx = self.pub_dests.index(dest)
+        del self.pub_dests[idx]
+        # Keep our place in the datagram that is part-way out.
+        if idx < self.pub_dest_idx:
+            self.pub_dest_idx -= 1
 
 def sock_nodelay_condition(engine, sock):
+    if sock.family not in (socket.AF_INET, socket.AF_INET6):
+        # Not meaningful for unix domain sockets.
+        return
     if engine.b_nodelay:
         sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
 
 def metasock_create_pub(engine, mempool, sid, addr, port, cb_pub_start, cb_pub_stop):
-    log('metasock_create_pub %s (%s:%s)'%(sid, addr, port))
+    log('metasock_create_pub %s (%s:%s)', sid, addr, port)
     sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)  
     sock_nodelay_condition(
         engine=engine,
@@ -430,6 +878,7 @@ def metasock_create_pub(engine, mempool, sid, addr, port, cb_pub_start, cb_pub_s
     sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)  
     sock.setsockopt(socket.SOL_SOCKET, socket.SO_BROADCAST, 1)  
     sock.connect((addr, port))
+    sock.setblocking(0)
     #
     ms = Metasock(
         engine=engine,
@@ -451,8 +900,142 @@ def metasock_create_pub(engine, mempool, sid, addr, port, cb_pub_start, cb_pub_s
     #
     return ms
 
-def metasock_create_sub(engine, mempool, sid, addr, port, cb_sub_start, cb_sub_stop, cb_sub_recv):
-    log('metasock_create_sub %s (%s:%s)'%(sid, addr, port))
+def metasock_create_pub_fanout(engine, mempool, sid, dests, cb_pub_start, cb_pub_stop):
+    '''
+    A pub that is not connected to any one address. Each datagram it sends
+    goes to every (addr, port) in dests.
+    '''
+    log('metasock_create_pub_fanout %s (%s dests)', sid, len(dests))
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_BROADCAST, 1)
+    sock.setblocking(0)
+    #
+    ms = Metasock(
+        engine=engine,
+        mempool=mempool,
+        sid=sid,
+        ms_type=MS_TYPE_PUB,
+        addr=None,
+        port=None)
+    ms.sock = sock
+    ms.can_it_recv = False
+    ms.can_it_send = True
+    ms.cb_pub_start = cb_pub_start
+    ms.cb_pub_stop = cb_pub_stop
+    ms.pub_dests = []
+    for (addr, port) in dests:
+        ms.add_pub_dest(
+            addr=addr,
+            port=port)
+    #
+    engine._map_sid_to_metasock(
+        sid=sid,
+        ms=ms)
+    ms.after_init()
+    #
+    return ms
+
+def check_mcast_group(addr):
+    if not ipaddress.ip_address(addr).is_multicast:
+        raise Exception("%s is not a multicast group address."%(addr))
+
+def metasock_create_mcast_pub(engine, mempool, sid, addr, port, ttl, b_loop, iface, cb_pub_start, cb_pub_stop):
+    '''
+    A pub that sends to the multicast group addr. The kernel copies each
+    datagram to every subscriber that has joined the group.
+
+    ttl: 1 keeps traffic on the local network.
+    b_loop: whether subscribers on this host hear what we send.
+    iface: ip of the interface to send from. None lets the kernel choose by
+    its routing table.
+    '''
+    check_mcast_group(addr)
+    log('metasock_create_mcast_pub %s (%s:%s ttl %s)', sid, addr, port, ttl)
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    sock.setsockopt(socket.IPPROTO_IP, socket.IP_MULTICAST_TTL, ttl)
+    sock.setsockopt(socket.IPPROTO_IP, socket.IP_MULTICAST_LOOP, int(b_loop))
+    if iface != None:
+        sock.setsockopt(
+            socket.IPPROTO_IP,
+            socket.IP_MULTICAST_IF,
+            socket.inet_aton(iface))
+    sock.connect((addr, port))
+    sock.setblocking(0)
+    #
+    ms = Metasock(
+        engine=engine,
+        mempool=mempool,
+        sid=sid,
+        ms_type=MS_TYPE_PUB,
+        addr=addr,
+        port=port)
+    ms.sock = sock
+    ms.can_it_recv = False
+    ms.can_it_send = True
+    ms.cb_pub_start = cb_pub_start
+    ms.cb_pub_stop = cb_pub_stop
+    #
+    engine._map_sid_to_metasock(
+        sid=sid,
+        ms=ms)
+    ms.after_init()
+    #
+    return ms
+
+def metasock_create_mcast_sub(engine, mempool, sid, addr, port, iface, cb_sub_start, cb_sub_stop, cb_sub_recv, cb_sub_recv_batch):
+    '''
+    A sub that joins the multicast group addr on the interface with ip
+    iface ('0.0.0.0' lets the kernel choose). Several subs on the one host
+    can join the same group and port, and each gets its own copy.
+
+    Membership ends when the socket is closed.
+    '''
+    check_mcast_group(addr)
+    log('metasock_create_mcast_sub %s (%s:%s on %s)', sid, addr, port, iface)
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    if hasattr(socket, 'SO_REUSEPORT'):
+        # The BSDs need this as well as SO_REUSEADDR before they will let
+        # two sockets share a multicast port.
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+    try:
+        # Binding to the group means we only hear traffic for the group,
+        # rather than everything that arrives at the port.
+        sock.bind((addr, port))
+    except OSError:
+        # Windows will not bind to a group address.
+        sock.bind(('', port))
+    mreq = struct.pack(
+        '4s4s',
+        socket.inet_aton(addr),
+        socket.inet_aton(iface))
+    sock.setsockopt(socket.IPPROTO_IP, socket.IP_ADD_MEMBERSHIP, mreq)
+    sock.setblocking(0)
+    #
+    ms = Metasock(
+        engine=engine,
+        mempool=mempool,
+        sid=sid,
+        ms_type=MS_TYPE_SUB,
+        addr=addr,
+        port=port)
+    ms.sock = sock
+    ms.can_it_recv = True
+    ms.can_it_send = False
+    ms.cb_sub_start = cb_sub_start
+    ms.cb_sub_stop = cb_sub_stop
+    ms.cb_sub_recv = cb_sub_recv
+    ms.cb_sub_recv_batch = cb_sub_recv_batch
+    #
+    engine._map_sid_to_metasock(
+        sid=sid,
+        ms=ms)
+    ms.after_init()
+    #
+    return ms
+
+def metasock_create_sub(engine, mempool, sid, addr, port, cb_sub_start, cb_sub_stop, cb_sub_recv, cb_sub_recv_batch):
+    log('metasock_create_sub %s (%s:%s)', sid, addr, port)
     sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
     sock_nodelay_condition(
         engine=engine,
@@ -474,6 +1057,7 @@ def metasock_create_sub(engine, mempool, sid, addr, port, cb_sub_start, cb_sub_s
     ms.cb_sub_start = cb_sub_start
     ms.cb_sub_stop = cb_sub_stop
     ms.cb_sub_recv = cb_sub_recv
+    ms.cb_sub_recv_batch = cb_sub_recv_batch
     #
     engine._map_sid_to_metasock(
         sid=sid,
@@ -482,15 +1066,19 @@ def metasock_create_sub(engine, mempool, sid, addr, port, cb_sub_start, cb_sub_s
     #
     return ms
 
-def metasock_create_tcp_accept(engine, mempool, sid, accept_sock, addr, port, parent_sid, cb_tcp_accept_connect, cb_tcp_accept_condrop, cb_tcp_accept_recv):
+def metasock_create_tcp_accept(engine, mempool, sid, accept_sock, addr, port, parent_sid, cb_tcp_accept_connect, cb_tcp_accept_condrop, cb_tcp_accept_recv, cb_tcp_accept_pressure, cb_tcp_accept_drain):
     """This is in the chain of functions that get called after a tcp server
     accepts a connection. In BSD sockets language, this is considered to be a
     'client' socket. But in our language, we call this an 'accept' socket.
     That is, we distinguish between server, client and accept."""
-    log('metasock_create_tcp_accept %s (%s:%s)'%(sid, addr, port))
+    log('metasock_create_tcp_accept %s (%s:%s)', sid, addr, port)
     sock_nodelay_condition(
         engine=engine,
         sock=accept_sock)
+    # Whether an accepted socket inherits non-blocking mode from its server
+    # is platform-dependent. We need it, because reads keep going until the
+    # socket tells us it would block.
+    accept_sock.setblocking(0)
     #
     ms = Metasock(
         engine=engine,
@@ -506,6 +1094,8 @@ def metasock_create_tcp_accept(engine, mempool, sid, accept_sock, addr, port, pa
     ms.cb_tcp_accept_connect = cb_tcp_accept_connect
     ms.cb_tcp_accept_condrop = cb_tcp_accept_condrop
     ms.cb_tcp_accept_recv = cb_tcp_accept_recv
+    ms.cb_tcp_accept_pressure = cb_tcp_accept_pressure
+    ms.cb_tcp_accept_drain = cb_tcp_accept_drain
     #
     engine._map_sid_to_metasock(
         sid=sid,
@@ -514,8 +1104,8 @@ def metasock_create_tcp_accept(engine, mempool, sid, accept_sock, addr, port, pa
     #
     return ms
 
-def metasock_create_tcp_client(engine, mempool, sid, addr, port, cb_tcp_client_connect, cb_tcp_client_condrop, cb_tcp_client_recv):
-    log('metasock_create_tcp_client %s (%s:%s)'%(sid, addr, port))
+def metasock_create_tcp_client(engine, mempool, sid, addr, port, cb_tcp_client_connect, cb_tcp_client_condrop, cb_tcp_client_recv, cb_tcp_client_pressure, cb_tcp_client_drain):
+    log('metasock_create_tcp_client %s (%s:%s)', sid, addr, port)
     sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
     sock_nodelay_condition(
         engine=engine,
@@ -537,6 +1127,8 @@ def metasock_create_tcp_client(engine, mempool, sid, addr, port, cb_tcp_client_c
     ms.cb_tcp_client_connect = cb_tcp_client_connect
     ms.cb_tcp_client_condrop = cb_tcp_client_condrop
     ms.cb_tcp_client_recv = cb_tcp_client_recv
+    ms.cb_tcp_client_pressure = cb_tcp_client_pressure
+    ms.cb_tcp_client_drain = cb_tcp_client_drain
     #
     engine._map_sid_to_metasock(
         sid=sid,
@@ -545,16 +1137,21 @@ def metasock_create_tcp_client(engine, mempool, sid, addr, port, cb_tcp_client_c
     #
     return ms
 
-def metasock_create_tcp_server(engine, mempool, sid, addr, port, cb_tcp_server_start, cb_tcp_server_stop, cb_tcp_accept_connect, cb_tcp_accept_condrop, cb_tcp_accept_recv):
-    log('metasock_create_tcp_server %s (%s:%s)'%(sid, addr, port))
+def metasock_create_tcp_server(engine, mempool, sid, addr, port, backlog, reuseport, cb_tcp_server_start, cb_tcp_server_stop, cb_tcp_accept_connect, cb_tcp_accept_condrop, cb_tcp_accept_recv, cb_tcp_accept_pressure, cb_tcp_accept_drain):
+    log('metasock_create_tcp_server %s (%s:%s)', sid, addr, port)
     sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
     sock_nodelay_condition(
         engine=engine,
         sock=sock)
     sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    if reuseport:
+        if not hasattr(socket, 'SO_REUSEPORT'):
+            sock.close()
+            raise Exception("SO_REUSEPORT is not available on this platform.")
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
     sock.bind((addr, port))
     sock.setblocking(0)
-    sock.listen(0)
+    sock.listen(backlog)
     #
     ms = Metasock(
         engine=engine,
@@ -569,6 +1166,8 @@ def metasock_create_tcp_server(engine, mempool, sid, addr, port, cb_tcp_server_s
     ms.cb_tcp_accept_condrop = cb_tcp_accept_condrop
     ms.cb_tcp_accept_connect = cb_tcp_accept_connect
     ms.cb_tcp_accept_recv = cb_tcp_accept_recv
+    ms.cb_tcp_accept_pressure = cb_tcp_accept_pressure
+    ms.cb_tcp_accept_drain = cb_tcp_accept_drain
     ms.cb_tcp_server_start = cb_tcp_server_start
     ms.cb_tcp_server_stop = cb_tcp_server_stop
     #
@@ -579,3 +1178,178 @@ def metasock_create_tcp_server(engine, mempool, sid, addr, port, cb_tcp_server_s
     #
     return ms
 
+
+# --------------------------------------------------------
+#   unix domain sockets
+# --------------------------------------------------------
+# These reuse the tcp and pub/sub metasock types, so they have the same
+# callbacks, and cogs can move between transports by changing how they open
+# the socket. Where a cs struct has addr and port, addr is the path and port
+# is None.
+
+def check_unix_available():
+    if not hasattr(socket, 'AF_UNIX'):
+        raise Exception("Unix domain sockets are not available here.")
+
+def unlink_unix_path(path):
+    try:
+        os.unlink(path)
+    except FileNotFoundError:
+        pass
+
+def clear_stale_unix_path(path, sock_type):
+    '''
+    A process that dies without closing its server leaves the socket file
+    behind, and bind will then fail. If nothing is listening on path, we
+    remove it. If something is, we leave it alone and raise.
+    '''
+    try:
+        st = os.stat(path)
+    except FileNotFoundError:
+        return
+    if not stat.S_ISSOCK(st.st_mode):
+        raise Exception("%s exists, and is not a socket."%(path))
+    probe = socket.socket(socket.AF_UNIX, sock_type)
+    try:
+        ec = probe.connect_ex(path)
+    finally:
+        probe.close()
+    if ec != errno.ECONNREFUSED:
+        raise Exception("%s is in use."%(path))
+    unlink_unix_path(path)
+
+def metasock_create_unix_server(engine, mempool, sid, path, backlog, cb_tcp_server_start, cb_tcp_server_stop, cb_tcp_accept_connect, cb_tcp_accept_condrop, cb_tcp_accept_recv, cb_tcp_accept_pressure, cb_tcp_accept_drain):
+    check_unix_available()
+    log('metasock_create_unix_server %s (%s)', sid, path)
+    clear_stale_unix_path(
+        path=path,
+        sock_type=socket.SOCK_STREAM)
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    sock.bind(path)
+    sock.setblocking(0)
+    sock.listen(backlog)
+    #
+    ms = Metasock(
+        engine=engine,
+        mempool=mempool,
+        sid=sid,
+        ms_type=MS_TYPE_TCP_SERVER,
+        addr=path,
+        port=None)
+    ms.sock = sock
+    ms.unix_path = path
+    ms.can_it_recv = True
+    ms.can_it_send = True
+    ms.cb_tcp_accept_condrop = cb_tcp_accept_condrop
+    ms.cb_tcp_accept_connect = cb_tcp_accept_connect
+    ms.cb_tcp_accept_recv = cb_tcp_accept_recv
+    ms.cb_tcp_accept_pressure = cb_tcp_accept_pressure
+    ms.cb_tcp_accept_drain = cb_tcp_accept_drain
+    ms.cb_tcp_server_start = cb_tcp_server_start
+    ms.cb_tcp_server_stop = cb_tcp_server_stop
+    #
+    engine._map_sid_to_metasock(
+        sid=sid,
+        ms=ms)
+    ms.after_init()
+    #
+    return ms
+
+def metasock_create_unix_client(engine, mempool, sid, path, cb_tcp_client_connect, cb_tcp_client_condrop, cb_tcp_client_recv, cb_tcp_client_pressure, cb_tcp_client_drain):
+    check_unix_available()
+    log('metasock_create_unix_client %s (%s)', sid, path)
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    sock.setblocking(0)
+    # Unlike tcp, this usually completes (or fails) straight away. Either
+    # way, we report the outcome from manage_writable, as for tcp.
+    ec = sock.connect_ex(path)
+    #
+    ms = Metasock(
+        engine=engine,
+        mempool=mempool,
+        sid=sid,
+        ms_type=MS_TYPE_TCP_CLIENT,
+        addr=path,
+        port=None)
+    ms.sock = sock
+    ms.can_it_recv = True
+    ms.can_it_send = True
+    ms.b_tcp_client_connecting = True
+    if ec != errno.EINPROGRESS:
+        ms.connect_ec = ec
+    ms.cb_tcp_client_connect = cb_tcp_client_connect
+    ms.cb_tcp_client_condrop = cb_tcp_client_condrop
+    ms.cb_tcp_client_recv = cb_tcp_client_recv
+    ms.cb_tcp_client_pressure = cb_tcp_client_pressure
+    ms.cb_tcp_client_drain = cb_tcp_client_drain
+    #
+    engine._map_sid_to_metasock(
+        sid=sid,
+        ms=ms)
+    ms.after_init()
+    #
+    return ms
+
+def metasock_create_unix_pub(engine, mempool, sid, path, cb_pub_start, cb_pub_stop):
+    '''
+    Sends datagrams to the unix sub bound at path. The sub must exist
+    before the pub is opened.
+    '''
+    check_unix_available()
+    log('metasock_create_unix_pub %s (%s)', sid, path)
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+    sock.connect(path)
+    sock.setblocking(0)
+    #
+    ms = Metasock(
+        engine=engine,
+        mempool=mempool,
+        sid=sid,
+        ms_type=MS_TYPE_PUB,
+        addr=path,
+        port=None)
+    ms.sock = sock
+    ms.can_it_recv = False
+    ms.can_it_send = True
+    ms.cb_pub_start = cb_pub_start
+    ms.cb_pub_stop = cb_pub_stop
+    #
+    engine._map_sid_to_metasock(
+        sid=sid,
+        ms=ms)
+    ms.after_init()
+    #
+    return ms
+
+def metasock_create_unix_sub(engine, mempool, sid, path, cb_sub_start, cb_sub_stop, cb_sub_recv, cb_sub_recv_batch):
+    check_unix_available()
+    log('metasock_create_unix_sub %s (%s)', sid, path)
+    clear_stale_unix_path(
+        path=path,
+        sock_type=socket.SOCK_DGRAM)
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+    sock.bind(path)
+    sock.setblocking(0)
+    #
+    ms = Metasock(
+        engine=engine,
+        mempool=mempool,
+        sid=sid,
+        ms_type=MS_TYPE_SUB,
+        addr=path,
+        port=None)
+    ms.sock = sock
+    ms.unix_path = path
+    ms.can_it_recv = True
+    ms.can_it_send = False
+    ms.cb_sub_start = cb_sub_start
+    ms.cb_sub_stop = cb_sub_stop
+    ms.cb_sub_recv = cb_sub_recv
+    ms.cb_sub_recv_batch = cb_sub_recv_batch
+    #
+    engine._map_sid_to_metasock(
+        sid=sid,
+        ms=ms)
+    ms.after_init()
+    #
+    return ms
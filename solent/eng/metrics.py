@@ -0,0 +1,162 @@
+#
+# metrics
+#
+# // overview
+# Registry of counters, gauges and latency histograms, so that you can see
+# what a running engine is doing without attaching a profiler.
+#
+# Metrics are opt-in. Call engine.enable_metrics() to get the registry. Once
+# it is enabled, the engine records how long its turns take and how long it
+# spends waiting in select, and the registry reports on metasocks (bytes and
+# calls in each direction, send-queue depth, counts by type), the mempool,
+# timers and spins.
+#
+# Some values are cheap to keep all the time (metasock byte counts, mempool
+# counts), and live on the objects that own them. Rather than copy them into
+# the registry as they change, the registry asks for them when someone takes
+# a snapshot. These are 'collectors'.
+#
+# You can register your own metrics against the same registry,
+#
+#     metrics = engine.enable_metrics()
+#     self.counter_orders = metrics.counter('app.orders')
+#     ...
+#     self.counter_orders.inc()
+#
+# To read them, call metrics.snapshot() for a dict, or metrics.render_text()
+# for lines of 'name value'. SpinMetricsConsole (solent.util) serves the
+# text form over tcp.
+#
+# // license
+# Copyright 2016, Free Software Foundation.
+#
+# This file is part of Solent.
+#
+# Solent is free software: you can redistribute it and/or modify it under the
+# terms of the GNU Lesser General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option)
+# any later version.
+#
+# Solent is distributed in the hope that it will be useful, but WITHOUT ANY
+# WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE. See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along with
+# Solent. If not, see <http://www.gnu.org/licenses/>.
+
+# Histogram buckets are powers of two, in microseconds. Bucket n holds values
+# below 2**n us. The last bucket catches everything from about 35 minutes up.
+HISTOGRAM_BUCKETS = 32
+
+class MetricCounter:
+    def __init__(self, name):
+        self.name = name
+        self.value = 0
+    def inc(self, n=1):
+        self.value += n
+    def collect(self, acc):
+        acc.append( (self.name, self.value) )
+
+class MetricGauge:
+    '''
+    Either set it, or supply fn and it will be called for the value when a
+    snapshot is taken.
+    '''
+    def __init__(self, name, fn=None):
+        self.name = name
+        self.fn = fn
+        self.value = 0
+    def set(self, value):
+        self.value = value
+    def collect(self, acc):
+        if self.fn != None:
+            acc.append( (self.name, self.fn()) )
+        else:
+            acc.append( (self.name, self.value) )
+
+class MetricHistogram:
+    '''
+    Latency histogram. Values are in seconds. We keep log2 buckets rather
+    than samples, so that recording is cheap and memory is fixed. Percentiles
+    are reported as the upper bound of the bucket they fall into.
+    '''
+    def __init__(self, name):
+        self.name = name
+        self.buckets = [0] * HISTOGRAM_BUCKETS
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+    def record(self, value):
+        idx = int(value * 1000000).bit_length()
+        if idx >= HISTOGRAM_BUCKETS:
+            idx = HISTOGRAM_BUCKETS - 1
+        self.buckets[idx] += 1
+        self.count += 1
+        self.total += value
+        if value > self.max:
+            self.max = value
+    def percentile(self, p):
+        'p is between 0 and 100. Returns seconds.'
+        if self.count == 0:
+            return 0.0
+        threshold = self.count * p / 100.0
+        running = 0
+        for (idx, n) in enumerate(self.buckets):
+            running += n
+            if running >= threshold:
+                return min(self.max, (2 ** idx) / 1000000.0)
+        return self.max
+    def collect(self, acc):
+        acc.append( ('%s.count'%(self.name), self.count) )
+        acc.append( ('%s.sum'%(self.name), self.total) )
+        acc.append( ('%s.max'%(self.name), self.max) )
+        acc.append( ('%s.p50'%(self.name), self.percentile(50)) )
+        acc.append( ('%s.p99'%(self.name), self.percentile(99)) )
+
+class Metrics:
+    def __init__(self):
+        # name vs metric
+        self.d_metric = {}
+        # Each of these is a fn(acc) that appends (name, value) pairs.
+        self.collectors = []
+    def _add(self, metric):
+        if metric.name in self.d_metric:
+            raise Exception("Metric %s already exists."%(metric.name))
+        self.d_metric[metric.name] = metric
+        return metric
+    def counter(self, name):
+        return self._add(MetricCounter(name))
+    def gauge(self, name, fn=None):
+        return self._add(MetricGauge(name, fn))
+    def histogram(self, name):
+        return self._add(MetricHistogram(name))
+    def get(self, name):
+        return self.d_metric[name]
+    def add_collector(self, fn):
+        self.collectors.append(fn)
+    def remove_collector(self, fn):
+        self.collectors.remove(fn)
+    def collect(self):
+        'Returns a sorted list of (name, value).'
+        acc = []
+        for metric in self.d_metric.values():
+            metric.collect(acc)
+        for fn in self.collectors:
+            fn(acc)
+        acc.sort()
+        return acc
+    def snapshot(self):
+        return dict(self.collect())
+    def render_text(self, prefix=''):
+        'prefix: if you supply this, you only get metrics whose name has it.'
+        lines = []
+        for (name, value) in self.collect():
+            if not name.startswith(prefix):
+                continue
+            if isinstance(value, float):
+                lines.append('%s %.6f'%(name, value))
+            else:
+                lines.append('%s %s'%(name, value))
+        lines.append('')
+        return '\n'.join(lines)
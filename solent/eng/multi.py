@@ -0,0 +1,256 @@
+#
+# multi
+#
+# // overview
+# Engine is single-threaded, so a busy server saturates one core. This module
+# lets you run several engines side by side, one per process, each with the
+# same orb setup.
+#
+# The supervisor forks shard_count children. Each child creates its own
+# Engine and calls your cb_multi_init to set it up. If that setup opens its
+# tcp servers with reuseport=True, every child holds its own listener on the
+# same addr/port, and the kernel spreads incoming connections across them.
+# There is no shared state between the children, so this suits workloads
+# where connections are independent of one another.
+#
+# Shutdown is coordinated from the supervisor. When it receives SIGINT or
+# SIGTERM, or when any child exits, it sends SIGTERM to the children that
+# remain. Children leave their event loop when they see the signal, and close
+# their engine in the usual way.
+#
+# Example,
+#
+#     def cb_multi_init(engine, shard_n):
+#         orb = engine.init_orb(i_nearcast=I_NEARCAST)
+#         orb.init_cog(CogServer)
+#         bridge = orb.init_autobridge()
+#         bridge.nc_init()
+#
+#     multi_event_loop(
+#         shard_count=4,
+#         mtu=MTU,
+#         cb_multi_init=cb_multi_init,
+#         b_cpu_pinning=True)
+#
+# // license
+# Copyright 2016, Free Software Foundation.
+#
+# This file is part of Solent.
+#
+# Solent is free software: you can redistribute it and/or modify it under the
+# terms of the GNU Lesser General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option)
+# any later version.
+#
+# Solent is distributed in the hope that it will be useful, but WITHOUT ANY
+# WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE. See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along with
+# Solent. If not, see <http://www.gnu.org/licenses/>.
+
+from .engine import Engine
+
+from solent import log
+from solent import SolentQuitException
+
+import os
+import signal
+import traceback
+
+def multi_cpu_list():
+    '''
+    The cpus this process is allowed to run on. Where the platform cannot
+    tell us, we fall back to a range over cpu_count.
+    '''
+    if hasattr(os, 'sched_getaffinity'):
+        return sorted(os.sched_getaffinity(0))
+    return list(range(os.cpu_count() or 1))
+
+def multi_shard_count():
+    'A reasonable default for shard_count: one shard per available cpu.'
+    return len(multi_cpu_list())
+
+class ShardQuit:
+    '''
+    Signal handling for a child. The handler only sets a flag. Raising from
+    it would be fragile, because the engine catches exceptions around some
+    of its socket calls. The wakeup fd makes sure that the select loop
+    notices the signal promptly rather than at its next timeout.
+    '''
+    def __init__(self, engine):
+        self.engine = engine
+        #
+        self.b_quit = False
+        (self.rfd, self.wfd) = os.pipe()
+        os.set_blocking(self.rfd, False)
+        os.set_blocking(self.wfd, False)
+        signal.set_wakeup_fd(self.wfd)
+        signal.signal(signal.SIGTERM, self.on_signal)
+        signal.signal(signal.SIGINT, self.on_signal)
+        engine.add_custom_fd_read(
+            cfd_h='multi/quit',
+            fd=self.rfd,
+            cb_eng_custom_fd_read=self.cb_eng_custom_fd_read)
+    def on_signal(self, signum, frame):
+        self.b_quit = True
+    def cb_eng_custom_fd_read(self, cs_eng_custom_fd_read):
+        while True:
+            try:
+                os.read(self.rfd, 4096)
+            except BlockingIOError:
+                return
+    def close(self):
+        signal.set_wakeup_fd(-1)
+        self.engine.remove_custom_fd_read(
+            fd=self.rfd)
+        os.close(self.rfd)
+        os.close(self.wfd)
+
+def _shard_main(shard_n, mtu, selector, cb_multi_init, cpu):
+    '''
+    Runs in the child. Does not return.
+    '''
+    # Until we are ready to look after it ourselves, a signal should end
+    # the process.
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+    signal.signal(signal.SIGINT, signal.SIG_DFL)
+    if cpu != None and hasattr(os, 'sched_setaffinity'):
+        os.sched_setaffinity(0, [cpu])
+    #
+    exit_code = 0
+    engine = None
+    try:
+        engine = Engine(
+            mtu=mtu,
+            selector=selector)
+        shard_quit = ShardQuit(
+            engine=engine)
+        cb_multi_init(
+            engine=engine,
+            shard_n=shard_n)
+        # As for Engine.event_loop, but we watch for the quit flag.
+        timeout = 0
+        while not shard_quit.b_quit:
+            timeout = engine.turn(
+                timeout=timeout)
+        shard_quit.close()
+    except SolentQuitException:
+        pass
+    except:
+        traceback.print_exc()
+        exit_code = 1
+    finally:
+        if engine != None:
+            try:
+                engine.close()
+            except:
+                traceback.print_exc()
+                exit_code = 1
+    # We must not fall back into the supervisor's stack.
+    os._exit(exit_code)
+
+class MultiSupervisor:
+    '''
+    Forks and watches a set of engine processes. Most users will want
+    multi_event_loop rather than this class.
+    '''
+    def __init__(self, shard_count, mtu, cb_multi_init, b_cpu_pinning=False, selector=None):
+        if shard_count < 1:
+            raise Exception("shard_count must be at least 1 (got %s)"%(
+                shard_count))
+        if not hasattr(os, 'fork'):
+            raise Exception("multi needs os.fork, which this platform lacks.")
+        self.shard_count = shard_count
+        self.mtu = mtu
+        self.cb_multi_init = cb_multi_init
+        self.b_cpu_pinning = b_cpu_pinning
+        self.selector = selector
+        #
+        # pid vs shard_n
+        self.d_pid = {}
+        # shard_n vs exit code
+        self.d_exit = {}
+        self.b_stopping = False
+    def start(self):
+        cpus = multi_cpu_list()
+        for shard_n in range(self.shard_count):
+            cpu = None
+            if self.b_cpu_pinning:
+                cpu = cpus[shard_n % len(cpus)]
+            pid = os.fork()
+            if pid == 0:
+                _shard_main(
+                    shard_n=shard_n,
+                    mtu=self.mtu,
+                    selector=self.selector,
+                    cb_multi_init=self.cb_multi_init,
+                    cpu=cpu)
+            log('multi: shard %s is pid %s'%(shard_n, pid))
+            self.d_pid[pid] = shard_n
+    def stop(self):
+        '''
+        Asks every child that is still running to shut down. Safe to call
+        more than once.
+        '''
+        self.b_stopping = True
+        for pid in list(self.d_pid.keys()):
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+    def wait(self):
+        '''
+        Blocks until every child has exited. If any child exits while the
+        others are still running, we stop the others. Returns a list of exit
+        codes, indexed by shard_n.
+        '''
+        while self.d_pid:
+            try:
+                (pid, status) = os.waitpid(-1, 0)
+            except ChildProcessError:
+                break
+            except KeyboardInterrupt:
+                self.stop()
+                continue
+            if pid not in self.d_pid:
+                continue
+            shard_n = self.d_pid.pop(pid)
+            if os.WIFEXITED(status):
+                exit_code = os.WEXITSTATUS(status)
+            else:
+                exit_code = -os.WTERMSIG(status)
+            self.d_exit[shard_n] = exit_code
+            log('multi: shard %s exited [%s]'%(shard_n, exit_code))
+            if not self.b_stopping:
+                self.stop()
+        return [self.d_exit.get(shard_n) for shard_n in range(self.shard_count)]
+
+def multi_event_loop(shard_count, mtu, cb_multi_init, b_cpu_pinning=False, selector=None):
+    '''
+    Forks shard_count engine processes and supervises them until they have
+    all exited. Returns their exit codes, indexed by shard_n.
+
+    cb_multi_init(engine, shard_n): called in each child to set up its
+    engine. Open tcp servers with reuseport=True so that each child gets its
+    own listener.
+
+    b_cpu_pinning: pin each child to its own cpu (where the platform allows
+    it). When there are more shards than cpus, they wrap around.
+    '''
+    supervisor = MultiSupervisor(
+        shard_count=shard_count,
+        mtu=mtu,
+        cb_multi_init=cb_multi_init,
+        b_cpu_pinning=b_cpu_pinning,
+        selector=selector)
+    prev_sigterm = signal.getsignal(signal.SIGTERM)
+    def on_sigterm(signum, frame):
+        supervisor.stop()
+    signal.signal(signal.SIGTERM, on_sigterm)
+    try:
+        supervisor.start()
+        return supervisor.wait()
+    finally:
+        signal.signal(signal.SIGTERM, prev_sigterm)
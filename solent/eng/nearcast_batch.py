@@ -0,0 +1,162 @@
+#
+# nearcast batch
+#
+# // overview
+# Some cogs produce a stream of small messages of one type: ticks from a
+# counter, prices from a market feed. Sent one at a time, each row pays the
+# full cost of a nearcast. A batch lets the producer collect many rows of one
+# message, held by column, and nearcast them all at once.
+#
+# The producer asks the orb for a NearcastBatch, and keeps it,
+#
+#     self.batch_tick = orb.init_batch(
+#         cog=self,
+#         message_h='tick',
+#         typecodes={'n': 'q'})
+#     ...
+#     self.batch_tick.append(n)                     # one row, or
+#     self.batch_tick.column('n').extend(values)    # many at once
+#     ...
+#     self.batch_tick.send()
+#
+# typecodes maps field names to array module typecodes. Those fields are
+# stored in an array.array. Other fields are stored in a list.
+#
+# On send, the columns are queued on the nearcast as a NearcastBatchRecord,
+# and the batch takes a fresh set of columns. A consumer can take the whole
+# record in one call by offering a batch handler,
+#
+#     def on_tick__batch(self, batch):
+#         total = sum(batch.column('n'))
+#
+# Consumers that only offer the usual on_tick(self, n) get the rows one at a
+# time, in order. Snoops also see one message per row. Once a record has been
+# sent, nothing changes its columns, so a batch handler can keep a column
+# rather than copy it.
+#
+# Array columns support the buffer protocol. If you have numpy, then
+# numpy.frombuffer(batch.column('n'), dtype='int64') gives you a view without
+# a copy. The view stays valid after the handler returns. (An array cannot be
+# resized while a view of it exists. This is why each send takes new columns
+# rather than emptying and reusing old ones.)
+#
+# // license
+# Copyright 2016, Free Software Foundation.
+#
+# This file is part of Solent.
+#
+# Solent is free software: you can redistribute it and/or modify it under the
+# terms of the GNU Lesser General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option)
+# any later version.
+#
+# Solent is distributed in the hope that it will be useful, but WITHOUT ANY
+# WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE. See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along with
+# Solent. If not, see <http://www.gnu.org/licenses/>.
+
+from array import array
+
+# A consumer's batch handler for message m is called on_m__batch.
+BATCH_SUFFIX = '__batch'
+
+class NearcastBatchRecord:
+    '''
+    What a batch handler receives. Also what sits on the orb's queue, and so
+    it offers the same dispatch_h, invoke, snoop and release as the records
+    generated by the nearcast schema.
+    '''
+    __slots__ = ('batch', 'cog_h', 'message_h', 'dispatch_h', 'fields',
+        'columns')
+    def __init__(self, batch, columns):
+        self.batch = batch
+        self.cog_h = batch.cog_h
+        self.message_h = batch.message_h
+        self.dispatch_h = batch.dispatch_h
+        self.fields = batch.fields
+        self.columns = columns
+    def __len__(self):
+        return len(self.columns[0])
+    def column(self, field):
+        return self.columns[self.batch.d_idx[field]]
+    def rows(self):
+        'Iterates over the rows, as tuples in schema order.'
+        return zip(*self.columns)
+    def invoke(self, fn):
+        for row in zip(*self.columns):
+            fn(*row)
+    def snoop(self, fn):
+        fields = self.fields
+        for row in zip(*self.columns):
+            fn(cog_h=self.cog_h,
+               message_h=self.message_h,
+               d_fields=dict(zip(fields, row)))
+    def release(self):
+        # The columns are not emptied. A handler may still hold a view of
+        # them, and resizing would raise BufferError.
+        self.columns = None
+
+class NearcastBatch:
+    '''
+    Collects rows of one nearcast message for a producer. Get one from
+    orb.init_batch.
+    '''
+    def __init__(self, orb, cog_h, message_h, fields, typecodes):
+        self.orb = orb
+        self.cog_h = cog_h
+        self.message_h = message_h
+        self.fields = tuple(fields)
+        self.typecodes = typecodes
+        #
+        self.dispatch_h = '%s%s'%(message_h, BATCH_SUFFIX)
+        # field vs column index
+        self.d_idx = dict([(f, idx) for (idx, f) in enumerate(self.fields)])
+        self.columns = self._new_columns()
+    def __len__(self):
+        return len(self.columns[0])
+    def column(self, field):
+        '''
+        The column that rows are currently being added to. You can extend it
+        directly, as long as every column ends up the same length before you
+        send.
+        '''
+        return self.columns[self.d_idx[field]]
+    def append(self, *values):
+        'Adds one row. Values are in schema order.'
+        if len(values) != len(self.fields):
+            raise Exception("Message %s has fields %s. Got %s values."%(
+                self.message_h, str(self.fields), len(values)))
+        for (col, value) in zip(self.columns, values):
+            col.append(value)
+    def send(self):
+        '''
+        Queues the rows that have been added on the nearcast, and starts a
+        fresh set of columns. Does nothing if there are no rows.
+        '''
+        columns = self.columns
+        count = len(columns[0])
+        for col in columns:
+            if len(col) != count:
+                raise Exception("Columns of batch %s have different lengths."%(
+                    self.message_h))
+        if count == 0:
+            return
+        self.columns = self._new_columns()
+        self.orb.ready_to_nearcast.append(
+            NearcastBatchRecord(
+                batch=self,
+                columns=columns))
+        self.orb._wake()
+    #
+    def _new_columns(self):
+        columns = []
+        for field in self.fields:
+            typecode = self.typecodes.get(field)
+            if typecode == None:
+                columns.append([])
+            else:
+                columns.append(array(typecode))
+        return columns
@@ -0,0 +1,539 @@
+#
+# nearcast bridge
+#
+# // overview
+# A nearcast lives inside one orb, in one process. The nearcast bridge joins
+# two orbs in different processes (or on different hosts). Each side chooses
+# which of its messages to send across. Messages that arrive from the peer
+# are nearcast on the local orb as though a local cog had sent them.
+#
+#     # process one
+#     bridge = orb.init_nearcast_bridge(
+#         message_hs=['tick'])
+#     bridge.open_unix_server(
+#         path='/tmp/app.bridge')
+#
+#     # process two
+#     bridge = orb.init_nearcast_bridge(
+#         message_hs=['order'])
+#     bridge.open_unix_client(
+#         path='/tmp/app.bridge')
+#
+# There are tcp equivalents, open_tcp_server and open_tcp_client. A bridge
+# has one peer. The server stops listening once it has accepted it, and
+# listens again if the peer goes away. The client does not reconnect.
+#
+# Both orbs must have the same nearcast schema. Each side opens with a hello
+# frame that carries a digest of its schema, and the connection is dropped
+# if they differ.
+#
+# Messages are sent in the order in which the local orb distributed them.
+# Rather than write each one to the socket, the bridge collects what it sees
+# during a turn, and sends it all at the end of the turn. Until there is a
+# peer, messages are held, up to max_backlog bytes. The same goes while the
+# peer is slow to read: once the engine reports pressure on the connection,
+# the bridge stops sending and holds messages until it drains. Beyond
+# max_backlog, messages are dropped, and a line is logged.
+#
+# The bridge does not send back a message that it received from the peer.
+# Batches (see nearcast_batch.py) go across as separate rows.
+#
+# // wire format
+# A frame is,
+#
+#     u32 size of the rest of the frame
+#     u16 message index, in schema order. HELLO_IDX for the hello frame.
+#     the fields, in schema order, as encoded values
+#
+# An encoded value is a tag byte, followed by its payload. See the TAG_
+# constants. Integers are little-endian. Fields can hold None, bool, int,
+# float, str, bytes, and lists, tuples and dicts of those.
+#
+# // license
+# Copyright 2016, Free Software Foundation.
+#
+# This file is part of Solent.
+#
+# Solent is free software: you can redistribute it and/or modify it under the
+# terms of the GNU Lesser General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option)
+# any later version.
+#
+# Solent is distributed in the hope that it will be useful, but WITHOUT ANY
+# WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE. See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along with
+# Solent. If not, see <http://www.gnu.org/licenses/>.
+
+from solent import log
+
+import hashlib
+import struct
+
+TAG_NONE = 0
+TAG_TRUE = 1
+TAG_FALSE = 2
+TAG_I32 = 3
+TAG_I64 = 4
+TAG_BIGINT = 5     # u32 length, then the decimal digits
+TAG_F64 = 6
+TAG_STR = 7        # u32 length, then utf8
+TAG_BYTES = 8      # u32 length, then the bytes
+TAG_LIST = 9       # u32 count, then the values
+TAG_TUPLE = 10     # u32 count, then the values
+TAG_DICT = 11      # u32 count, then key and value for each
+
+HELLO_IDX = 0xffff
+
+# u32 size, u16 message index
+FRAME_HEADER = struct.Struct('<IH')
+FRAME_HEADER_BLANK = bytes(FRAME_HEADER.size)
+
+S_I32 = struct.Struct('<Bi')
+S_I64 = struct.Struct('<Bq')
+S_F64 = struct.Struct('<Bd')
+S_SIZED = struct.Struct('<BI')
+S_U32 = struct.Struct('<I')
+
+I32_MIN = -2**31
+I32_MAX = 2**31 - 1
+I64_MIN = -2**63
+I64_MAX = 2**63 - 1
+
+def schema_digest(nearcast_schema):
+    '''
+    Eight bytes that change if the messages, their fields or their order
+    change.
+    '''
+    sb = []
+    for (message_h, fields) in nearcast_schema.get_messages().items():
+        sb.append('%s(%s)'%(message_h, ','.join(fields)))
+    return hashlib.sha1(';'.join(sb).encode('utf8')).digest()[:8]
+
+# --------------------------------------------------------
+#   encoding
+# --------------------------------------------------------
+def _encode_none(out, value):
+    out.append(TAG_NONE)
+
+def _encode_bool(out, value):
+    if value:
+        out.append(TAG_TRUE)
+    else:
+        out.append(TAG_FALSE)
+
+def _encode_int(out, value):
+    if I32_MIN <= value <= I32_MAX:
+        out += S_I32.pack(TAG_I32, value)
+    elif I64_MIN <= value <= I64_MAX:
+        out += S_I64.pack(TAG_I64, value)
+    else:
+        bb = str(int(value)).encode('ascii')
+        out += S_SIZED.pack(TAG_BIGINT, len(bb))
+        out += bb
+
+def _encode_float(out, value):
+    out += S_F64.pack(TAG_F64, value)
+
+def _encode_str(out, value):
+    bb = value.encode('utf8')
+    out += S_SIZED.pack(TAG_STR, len(bb))
+    out += bb
+
+def _encode_bytes(out, value):
+    out += S_SIZED.pack(TAG_BYTES, len(value))
+    out += value
+
+def _encode_list(out, value):
+    out += S_SIZED.pack(TAG_LIST, len(value))
+    for item in value:
+        encode_value(out, item)
+
+def _encode_tuple(out, value):
+    out += S_SIZED.pack(TAG_TUPLE, len(value))
+    for item in value:
+        encode_value(out, item)
+
+def _encode_dict(out, value):
+    out += S_SIZED.pack(TAG_DICT, len(value))
+    for (k, v) in value.items():
+        encode_value(out, k)
+        encode_value(out, v)
+
+# type vs encoder
+ENCODERS = {
+    type(None): _encode_none,
+    bool: _encode_bool,
+    int: _encode_int,
+    float: _encode_float,
+    str: _encode_str,
+    bytes: _encode_bytes,
+    bytearray: _encode_bytes,
+    list: _encode_list,
+    tuple: _encode_tuple,
+    dict: _encode_dict,
+}
+
+def encode_value(out, value):
+    'Appends the encoding of value to the bytearray out.'
+    encoder = ENCODERS.get(type(value))
+    if encoder == None:
+        # Subclasses, such as IntEnum, are encoded as their base type.
+        for (t, fn) in ENCODERS.items():
+            if isinstance(value, t):
+                encoder = fn
+                break
+        else:
+            raise Exception("Cannot send a %s over a nearcast bridge."%(
+                type(value).__name__))
+    encoder(out, value)
+
+def encode_frame(out, idx, values):
+    'Appends a frame to the bytearray out.'
+    start = len(out)
+    out += FRAME_HEADER_BLANK
+    for value in values:
+        encode_value(out, value)
+    FRAME_HEADER.pack_into(out, start, len(out) - start - 4, idx)
+
+# --------------------------------------------------------
+#   decoding
+# --------------------------------------------------------
+def decode_value(bb, offset):
+    'Returns (value, offset after it).'
+    tag = bb[offset]
+    offset += 1
+    if tag == TAG_I32:
+        return (S_I32.unpack_from(bb, offset - 1)[1], offset + 4)
+    elif tag == TAG_STR:
+        size = S_U32.unpack_from(bb, offset)[0]
+        offset += 4
+        return (str(bb[offset:offset+size], 'utf8'), offset + size)
+    elif tag == TAG_NONE:
+        return (None, offset)
+    elif tag == TAG_TRUE:
+        return (True, offset)
+    elif tag == TAG_FALSE:
+        return (False, offset)
+    elif tag == TAG_F64:
+        return (S_F64.unpack_from(bb, offset - 1)[1], offset + 8)
+    elif tag == TAG_I64:
+        return (S_I64.unpack_from(bb, offset - 1)[1], offset + 8)
+    elif tag == TAG_BYTES:
+        size = S_U32.unpack_from(bb, offset)[0]
+        offset += 4
+        return (bytes(bb[offset:offset+size]), offset + size)
+    elif tag == TAG_BIGINT:
+        size = S_U32.unpack_from(bb, offset)[0]
+        offset += 4
+        return (int(bytes(bb[offset:offset+size])), offset + size)
+    elif tag in (TAG_LIST, TAG_TUPLE):
+        count = S_U32.unpack_from(bb, offset)[0]
+        offset += 4
+        lst = []
+        for i in range(count):
+            (item, offset) = decode_value(bb, offset)
+            lst.append(item)
+        if tag == TAG_TUPLE:
+            return (tuple(lst), offset)
+        return (lst, offset)
+    elif tag == TAG_DICT:
+        count = S_U32.unpack_from(bb, offset)[0]
+        offset += 4
+        d = {}
+        for i in range(count):
+            (k, offset) = decode_value(bb, offset)
+            (v, offset) = decode_value(bb, offset)
+            d[k] = v
+        return (d, offset)
+    raise Exception("Unknown tag %s in nearcast bridge frame."%(tag))
+
+def decode_values(bb, offset, end):
+    'Returns the list of values between offset and end.'
+    values = []
+    while offset < end:
+        (value, offset) = decode_value(bb, offset)
+        values.append(value)
+    if offset != end:
+        raise Exception("Value overruns its nearcast bridge frame.")
+    return values
+
+# --------------------------------------------------------
+#   bridge
+# --------------------------------------------------------
+class NearcastBridge:
+    '''
+    A cog that carries nearcast messages to and from a peer orb. Get one
+    from orb.init_nearcast_bridge.
+    '''
+    def __init__(self, cog_h, orb, engine, message_hs, max_backlog):
+        self.cog_h = cog_h
+        self.orb = orb
+        self.engine = engine
+        self.message_hs = message_hs
+        self.max_backlog = max_backlog
+        #
+        # Frames waiting for the end of the turn, or for a peer.
+        self.out_buf = bytearray()
+        self.b_dropping = False
+        # Bytes from the peer that do not yet make a whole frame.
+        self.in_buf = bytearray()
+        #
+        nearcast_schema = orb.nearcast_schema
+        self.digest = schema_digest(nearcast_schema)
+        # message index vs record class, for what arrives
+        self.record_classes = []
+        # message_h vs fn(*fields) that encodes the message into out_buf
+        self.d_encoder = {}
+        for (idx, message_h) in enumerate(nearcast_schema.get_messages()):
+            self.record_classes.append(
+                nearcast_schema.get_record_class(message_h))
+            self.d_encoder[message_h] = self._make_encoder(idx)
+        #
+        self.wakeup = None
+        #
+        self.b_active = False
+        # fn that opens the server, so that we can listen again
+        self.fn_open_server = None
+        self.server_sid = None
+        self.peer_sid = None
+        self.b_peer_is_accept = False
+        self.b_hello_sent = False
+        self.b_hello_seen = False
+        # The engine has told us that the peer's send queue is full.
+        self.b_pressure = False
+    def orb_bind_wakeup(self, wakeup):
+        self.wakeup = wakeup
+    def orb_turn(self, activity):
+        if not self.out_buf:
+            return
+        if self.peer_sid == None or not self.b_hello_sent:
+            return
+        if self.b_pressure:
+            return
+        activity.mark(
+            l=self,
+            s='nearcast bridge send')
+        self._send_out_buf()
+    def orb_close(self):
+        self.close()
+    #
+    def open_tcp_server(self, addr, port):
+        self._open_server(
+            fn_open_server=lambda: self.engine.open_tcp_server(
+                addr=addr,
+                port=port,
+                cb_tcp_server_start=self.cb_tcp_server_start,
+                cb_tcp_server_stop=self.cb_tcp_server_stop,
+                cb_tcp_accept_connect=self.cb_tcp_accept_connect,
+                cb_tcp_accept_condrop=self.cb_tcp_accept_condrop,
+                cb_tcp_accept_recv=self.cb_tcp_accept_recv,
+                cb_tcp_accept_pressure=self.cb_tcp_accept_pressure,
+                cb_tcp_accept_drain=self.cb_tcp_accept_drain))
+    def open_unix_server(self, path):
+        self._open_server(
+            fn_open_server=lambda: self.engine.open_unix_server(
+                path=path,
+                cb_tcp_server_start=self.cb_tcp_server_start,
+                cb_tcp_server_stop=self.cb_tcp_server_stop,
+                cb_tcp_accept_connect=self.cb_tcp_accept_connect,
+                cb_tcp_accept_condrop=self.cb_tcp_accept_condrop,
+                cb_tcp_accept_recv=self.cb_tcp_accept_recv,
+                cb_tcp_accept_pressure=self.cb_tcp_accept_pressure,
+                cb_tcp_accept_drain=self.cb_tcp_accept_drain))
+    def open_tcp_client(self, addr, port):
+        self._check_idle()
+        self.b_active = True
+        self.engine.open_tcp_client(
+            addr=addr,
+            port=port,
+            cb_tcp_client_connect=self.cb_tcp_client_connect,
+            cb_tcp_client_condrop=self.cb_tcp_client_condrop,
+            cb_tcp_client_recv=self.cb_tcp_client_recv,
+            cb_tcp_client_pressure=self.cb_tcp_client_pressure,
+            cb_tcp_client_drain=self.cb_tcp_client_drain)
+    def open_unix_client(self, path):
+        self._check_idle()
+        self.b_active = True
+        self.engine.open_unix_client(
+            path=path,
+            cb_tcp_client_connect=self.cb_tcp_client_connect,
+            cb_tcp_client_condrop=self.cb_tcp_client_condrop,
+            cb_tcp_client_recv=self.cb_tcp_client_recv,
+            cb_tcp_client_pressure=self.cb_tcp_client_pressure,
+            cb_tcp_client_drain=self.cb_tcp_client_drain)
+    def close(self):
+        'Closes the server and the peer connection, if they are open.'
+        self.b_active = False
+        self.fn_open_server = None
+        if self.server_sid != None:
+            self.engine.close_tcp_server(
+                server_sid=self.server_sid)
+        self._close_peer()
+    def is_connected(self):
+        'True once we have the peer, and it has the same schema as us.'
+        return self.peer_sid != None and self.b_hello_seen
+    def get_backlog(self):
+        'Bytes waiting to be sent.'
+        return len(self.out_buf)
+    #
+    def bridge_record(self, record):
+        # Don't send the peer its own messages back.
+        if record.cog_h == self.cog_h:
+            return
+        if len(self.out_buf) >= self.max_backlog:
+            if not self.b_dropping:
+                log('nearcast bridge %s: backlog over %s bytes, dropping'%(
+                    self.cog_h, self.max_backlog))
+                self.b_dropping = True
+            return
+        # This calls the encoder once for a message, or once per row for a
+        # batch.
+        record.invoke(self.d_encoder[record.message_h])
+        self.wakeup.wake()
+    #
+    def cb_tcp_server_start(self, cs_tcp_server_start):
+        self.server_sid = cs_tcp_server_start.server_sid
+    def cb_tcp_server_stop(self, cs_tcp_server_stop):
+        self.server_sid = None
+    def cb_tcp_accept_connect(self, cs_tcp_accept_connect):
+        # One peer at a time.
+        if self.server_sid != None:
+            self.engine.close_tcp_server(
+                server_sid=self.server_sid)
+        self.b_peer_is_accept = True
+        self._peer_connected(
+            sid=cs_tcp_accept_connect.accept_sid)
+    def cb_tcp_accept_condrop(self, cs_tcp_accept_condrop):
+        self._peer_gone(
+            message=cs_tcp_accept_condrop.message)
+        if self.b_active and self.fn_open_server != None:
+            self.fn_open_server()
+    def cb_tcp_accept_recv(self, cs_tcp_accept_recv):
+        self._recv(
+            bb=cs_tcp_accept_recv.bb)
+    def cb_tcp_accept_pressure(self, cs_tcp_accept_pressure):
+        self.b_pressure = True
+    def cb_tcp_accept_drain(self, cs_tcp_accept_drain):
+        self._drained()
+    def cb_tcp_client_connect(self, cs_tcp_client_connect):
+        self.b_peer_is_accept = False
+        self._peer_connected(
+            sid=cs_tcp_client_connect.client_sid)
+    def cb_tcp_client_condrop(self, cs_tcp_client_condrop):
+        self.b_active = False
+        self._peer_gone(
+            message=cs_tcp_client_condrop.message)
+    def cb_tcp_client_recv(self, cs_tcp_client_recv):
+        self._recv(
+            bb=cs_tcp_client_recv.bb)
+    def cb_tcp_client_pressure(self, cs_tcp_client_pressure):
+        self.b_pressure = True
+    def cb_tcp_client_drain(self, cs_tcp_client_drain):
+        self._drained()
+    #
+    def _check_idle(self):
+        if self.b_active:
+            raise Exception("Nearcast bridge %s is already open."%(
+                self.cog_h))
+    def _open_server(self, fn_open_server):
+        self._check_idle()
+        self.b_active = True
+        self.fn_open_server = fn_open_server
+        fn_open_server()
+    def _make_encoder(self, idx):
+        out = self.out_buf
+        def encode(*values):
+            encode_frame(out, idx, values)
+        return encode
+    def _peer_connected(self, sid):
+        self.peer_sid = sid
+        self.in_buf.clear()
+        self.b_hello_seen = False
+        self.b_pressure = False
+        # The hello must go ahead of anything that is already waiting.
+        hello = bytearray()
+        encode_frame(hello, HELLO_IDX, [self.digest])
+        self.engine.send(
+            sid=self.peer_sid,
+            bb=hello)
+        self.b_hello_sent = True
+        self.wakeup.wake()
+    def _drained(self):
+        self.b_pressure = False
+        if self.out_buf:
+            self.wakeup.wake()
+    def _peer_gone(self, message):
+        log('nearcast bridge %s: peer gone (%s)'%(self.cog_h, message))
+        self.peer_sid = None
+        self.b_hello_sent = False
+        self.b_hello_seen = False
+        self.b_pressure = False
+        self.in_buf.clear()
+    def _close_peer(self):
+        if self.peer_sid == None:
+            return
+        if self.b_peer_is_accept:
+            self.engine.close_tcp_accept(
+                accept_sid=self.peer_sid)
+        else:
+            self.engine.close_tcp_client(
+                client_sid=self.peer_sid)
+    def _send_out_buf(self):
+        out_buf = self.out_buf
+        mtu = self.engine.get_mtu()
+        view = memoryview(out_buf)
+        offset = 0
+        size = len(out_buf)
+        # The engine calls our pressure callback from within send, so we
+        # stop as soon as the peer's queue is full, and keep the rest.
+        while offset < size and not self.b_pressure:
+            self.engine.send(
+                sid=self.peer_sid,
+                bb=view[offset:offset+mtu])
+            offset += mtu
+        view.release()
+        # The encoders hold on to out_buf, so we trim it rather than replace
+        # it.
+        del out_buf[:offset]
+        if len(out_buf) < self.max_backlog:
+            self.b_dropping = False
+    def _recv(self, bb):
+        in_buf = self.in_buf
+        in_buf += bb
+        ready_to_nearcast = self.orb.ready_to_nearcast
+        record_classes = self.record_classes
+        cog_h = self.cog_h
+        offset = 0
+        size_in_buf = len(in_buf)
+        b_got_messages = False
+        try:
+            while size_in_buf - offset >= FRAME_HEADER.size:
+                (size, idx) = FRAME_HEADER.unpack_from(in_buf, offset)
+                end = offset + 4 + size
+                if end > size_in_buf:
+                    break
+                values = decode_values(
+                    bb=in_buf,
+                    offset=offset + FRAME_HEADER.size,
+                    end=end)
+                offset = end
+                if idx == HELLO_IDX:
+                    if values != [self.digest]:
+                        raise Exception("peer has a different nearcast schema")
+                    self.b_hello_seen = True
+                    continue
+                if not self.b_hello_seen:
+                    raise Exception("peer sent a message before its hello")
+                record = record_classes[idx].acquire(cog_h, *values)
+                ready_to_nearcast.append(record)
+                b_got_messages = True
+        except Exception as e:
+            log('nearcast bridge %s: dropping peer. %s'%(self.cog_h, e))
+            self._close_peer()
+            return
+        del in_buf[:offset]
+        if b_got_messages:
+            self.orb._wake()
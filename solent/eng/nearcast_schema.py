@@ -27,6 +27,7 @@
 # You should have received a copy of the GNU General Public License along with
 # Solent. If not, see <http://www.gnu.org/licenses/>.
 
+from .nearcast_batch import BATCH_SUFFIX
 from .testbridge import init_testbridge_class
 
 from solent import Ns
@@ -35,6 +36,7 @@ from solent import init_interface_script_parser
 from solent import SignalConsumer
 
 from collections import OrderedDict as od
+import keyword
 
 I_NEARCAST_EXAMPLE = '''
     i message h
@@ -55,6 +57,20 @@ I_NEARCAST_EXAMPLE = '''
         field organisation_h
 '''
 
+# Released records are kept for reuse, up to this many per message. Beyond
+# that, they are left to the garbage collector, so that a burst does not pin
+# its memory for the life of the orb.
+NEARCAST_RECORD_POOL_MAX = 1024
+
+# Members of a generated record class. A field cannot have any of these names.
+RECORD_RESERVED_NAMES = ('cog_h', 'message_h', 'dispatch_h', 'fields', 'pool',
+    'acquire', 'invoke', 'snoop', 'to_dict', 'release')
+
+# Globals, locals and dispatcher members in the generated code start with
+# this, so that they cannot shadow a field or a message. Neither a field nor a
+# message can start with it.
+GENERATED_PREFIX = '_nc_'
+
 class NearcastSignalConsumer(SignalConsumer):
     '''
     User for converting interface script into a nearcast schema.
@@ -97,6 +113,13 @@ class NearcastSchema:
     def __init__(self, schema_h, d_messages):
         self.schema_h = schema_h
         self.messages = d_messages
+        #
+        # (fast, strict) dispatcher classes. Built on first use. See
+        # attach_nearcast_dispatcher_on_cog.
+        self.dispatcher_classes = None
+        # message_h vs record class. Built alongside the dispatchers. See
+        # get_record_class.
+        self.record_classes = None
     def has_message(self, name):
         return name in self.messages
     def get_args_for_message(self, message_h):
@@ -124,36 +147,178 @@ class NearcastSchema:
         The mechanism here is ugly. Unimportant. When we move to a typed
         language, there's several ways we could handle this: inheritance, use
         of macros.
+
+        Sending is on the hot path of chatty orbs, so the generated methods
+        fill a pooled record (see get_record_class) and put it straight onto
+        the orb's queue. Python's own argument
+        checking means that the fields are right, and everything else is
+        checked here, once. If the orb is in strict mode, the cog gets a
+        dispatcher that goes through orb.nearcast instead, which checks
+        every message.
         '''
-        if 'nearcast' in dir(cog):
+        if hasattr(cog, 'nearcast'):
             raise Exception("Cog %s already has a member 'nearcast'."%(
                 cog.cog_h))
+        if not hasattr(cog, 'cog_h'):
+            raise Exception("Looks like an invalid cog. Has no cog_h. %s"%(
+                str(cog)))
+        (fast_class, strict_class) = self.get_dispatcher_classes()
+        if orb.b_strict:
+            construct = strict_class
+        else:
+            construct = fast_class
+        nearcast_dispatcher = construct(
+            orb=orb,
+            cog=cog)
+        setattr(cog, 'nearcast', nearcast_dispatcher)
+    def get_dispatcher_classes(self):
+        '''
+        Returns (fast, strict) dispatcher classes for this schema. Each has a
+        method per message. They share a constructor, so that an orb can
+        move a dispatcher between them by changing its __class__.
+        '''
+        if self.dispatcher_classes == None:
+            self._generate()
+        return self.dispatcher_classes
+    def get_record_class(self, message_h):
+        '''
+        Messages travel through the orb as records. There is a record class
+        for each message, generated from the schema. It has __slots__ for
+        cog_h and for each field, and these members,
+
+            message_h       name of the message
+            dispatch_h      key into the orb's dispatch table
+            fields          tuple of field names, in schema order
+            invoke(fn)      calls fn with the fields, positionally
+            snoop(fn)       calls a snoop's on_nearcast_message
+            to_dict()       the fields as a new dict
+            release()       clears the fields and returns it to its pool
+
+        Records are recycled. Each class keeps a pool of released records,
+        and the nearcast dispatchers take from it before allocating a new
+        one. Do not keep a reference to a record after you have handed it to
+        the orb.
+        '''
+        if self.record_classes == None:
+            self._generate()
+        if message_h not in self.record_classes:
+            raise Exception("Unknown message type, [%s]"%(message_h))
+        return self.record_classes[message_h]
+    def new_record(self, cog_h, message_h, d_fields):
+        '''
+        Returns a record for message_h, filled from d_fields. This is the
+        slow path, for callers that have the fields as keywords.
+        '''
+        record_class = self.get_record_class(message_h)
+        return record_class.acquire(cog_h, **d_fields)
+    def _generate(self):
+        for (message_h, fields) in self.messages.items():
+            names = [message_h] + fields
+            for name in names:
+                if not name.isidentifier() or keyword.iskeyword(name):
+                    raise Exception("[%s] cannot be a nearcast name."%(name))
+            if len(set(fields)) != len(fields):
+                raise Exception("Message %s repeats a field."%(message_h))
+            if message_h.startswith(GENERATED_PREFIX):
+                raise Exception("Message %s cannot start with %s."%(
+                    message_h, GENERATED_PREFIX))
+            if message_h.endswith(BATCH_SUFFIX):
+                raise Exception("Message %s cannot end with %s."%(
+                    message_h, BATCH_SUFFIX))
+            for field in fields:
+                b_reserved = field in RECORD_RESERVED_NAMES
+                if b_reserved or field.startswith(GENERATED_PREFIX):
+                    raise Exception("Message %s has field [%s], which is reserved."%(
+                        message_h, field))
+        # Names in the generated code that sit alongside the fields.
+        rvar = '%srecord'%(GENERATED_PREFIX)
         sb = []
-        sb.append('class DynamicNearcastDispatcher:')
+        for (message_h, fields) in self.messages.items():
+            rname = '%sRecord_%s'%(GENERATED_PREFIX, message_h)
+            pname = '%spool_%s'%(GENERATED_PREFIX, message_h)
+            sb.append('%s = []'%(pname))
+            sb.append('class %s:'%(rname))
+            sb.append('    __slots__ = %s'%(repr(tuple(['cog_h'] + fields))))
+            sb.append("    message_h = '%s'"%(message_h))
+            sb.append("    dispatch_h = '%s'"%(message_h))
+            sb.append('    fields = %s'%(repr(tuple(fields))))
+            sb.append('    pool = %s'%(pname))
+            sb.append('    @staticmethod')
+            sb.append('    def acquire(cog_h%s):'%(
+                ''.join([', %s'%f for f in fields])))
+            sb.append('        if %s:'%(pname))
+            sb.append('            %s = %s.pop()'%(rvar, pname))
+            sb.append('        else:')
+            sb.append('            %s = %s()'%(rvar, rname))
+            sb.append('        %s.cog_h = cog_h'%(rvar))
+            for field in fields:
+                sb.append('        %s.%s = %s'%(rvar, field, field))
+            sb.append('        return %s'%(rvar))
+            sb.append('    def invoke(self, fn):')
+            sb.append('        return fn(%s)'%(
+                ', '.join(['self.%s'%f for f in fields])))
+            sb.append('    def snoop(self, fn):')
+            sb.append('        fn(cog_h=self.cog_h,')
+            sb.append('           message_h=self.message_h,')
+            sb.append('           d_fields=self.to_dict())')
+            sb.append('    def to_dict(self):')
+            sb.append('        return {%s}'%(
+                ', '.join(["'%s': self.%s"%(f, f) for f in fields])))
+            sb.append('    def release(self):')
+            for field in fields:
+                sb.append('        self.%s = None'%(field))
+            sb.append('        if len(%s) < NEARCAST_RECORD_POOL_MAX:'%(pname))
+            sb.append('            %s.append(self)'%(pname))
+            sb.append('')
+        sb.append('class NearcastDispatcher:')
         sb.append('    def __init__(self, orb, cog):')
-        sb.append('        self.orb = orb')
-        sb.append('        self.cog = cog')
+        # The dispatcher has a method per message, so its own members take
+        # the prefix.
+        sb.append('        self.%sorb = orb'%(GENERATED_PREFIX))
+        sb.append('        self.%scog = cog'%(GENERATED_PREFIX))
+        sb.append('        self.%scog_h = cog.cog_h'%(GENERATED_PREFIX))
+        sb.append('        self.%sappend = orb.ready_to_nearcast.append'%(
+            GENERATED_PREFIX))
+        sb.append('        self.%swake = orb._wake'%(GENERATED_PREFIX))
         for (message_h, fields) in self.messages.items():
-            if fields:
-                args = ', '.join(fields)
-                sb.append('    def %s(self, %s):'%(message_h, args))
-            else:
-                sb.append('    def %s(self):'%(message_h))
-            sb.append('        self.orb.nearcast(')
-            sb.append('            cog=self.cog,')
+            # This is acquire, inlined.
+            pname = '%spool_%s'%(GENERATED_PREFIX, message_h)
+            sb.append('    def %s(self%s):'%(
+                message_h, ''.join([', %s'%f for f in fields])))
+            sb.append('        if %s:'%(pname))
+            sb.append('            %s = %s.pop()'%(rvar, pname))
+            sb.append('        else:')
+            sb.append('            %s = %s%s()'%(
+                rvar, GENERATED_PREFIX, 'Record_%s'%(message_h)))
+            sb.append('        %s.cog_h = self.%scog_h'%(rvar, GENERATED_PREFIX))
+            for field in fields:
+                sb.append('        %s.%s = %s'%(rvar, field, field))
+            sb.append('        self.%sappend(%s)'%(GENERATED_PREFIX, rvar))
+            sb.append('        self.%swake()'%(GENERATED_PREFIX))
+        sb.append('')
+        sb.append('class StrictNearcastDispatcher(NearcastDispatcher):')
+        if not self.messages:
+            sb.append('    pass')
+        for (message_h, fields) in self.messages.items():
+            sb.append('    def %s(self%s):'%(
+                message_h, ''.join([', %s'%f for f in fields])))
+            sb.append('        self.%sorb.nearcast('%(GENERATED_PREFIX))
+            sb.append('            cog=self.%scog,'%(GENERATED_PREFIX))
             sb.append("            message_h='%s',"%message_h)
             for field in fields:
                 sb.append('            %s=%s,'%(field, field))
             sb.append('            )')
         sb.append('')
-        sb.append('''globals()['DynamicNearcastDispatcher'] = DynamicNearcastDispatcher''')
-        sb.append('')
         code = '\n'.join(sb)
-        exec(code)
-        nearcast_dispatcher = DynamicNearcastDispatcher(
-            orb=orb,
-            cog=cog)
-        setattr(cog, 'nearcast', nearcast_dispatcher)
+        ns = {'NEARCAST_RECORD_POOL_MAX': NEARCAST_RECORD_POOL_MAX}
+        exec(code, ns)
+        self.record_classes = {}
+        for message_h in self.messages.keys():
+            rname = '%sRecord_%s'%(GENERATED_PREFIX, message_h)
+            self.record_classes[message_h] = ns[rname]
+        self.dispatcher_classes = (
+            ns['NearcastDispatcher'],
+            ns['StrictNearcastDispatcher'])
     def init_testbridge(self, cog_h, orb, engine):
         test_class = init_testbridge_class(
             nearcast_schema=self)
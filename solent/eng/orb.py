@@ -12,10 +12,16 @@
 # An orb satisfies these needs:
 # 1) It provides a nearcast. That is, a mechanism by which cogs can talk to
 # one another without requiring knowlede of each other's internal state.
-# 2) It bridges power from the engine to groups of cogs. On each pass of its
-# event loop, an engine will run through its list of registered orbs and call
-# orb.eng_turn. The orb will then call the eng_turn method for any cog that
-# offers it.
+# 2) It bridges power from the engine to groups of cogs. The engine calls
+# orb.eng_turn whenever the orb has work to do. The orb will then call the
+# orb_turn method for any cog that offers it.
+#
+# Cogs that offer orb_turn are polled on every pass of the event loop. That
+# is convenient, but expensive once you have many of them. A cog that also
+# offers orb_bind_wakeup(wakeup) is instead given a CogWakeup, and is only
+# turned after it has called wakeup.wake(). The orb itself works the same way
+# against the engine: it asks for a turn when a nearcast message is queued or
+# a cog has woken, and is polled only while it hosts legacy orb_turn cogs.
 #
 # If you've made it this far, you might appreciate this feature of an orb:
 # It's possible for multiple logical applications to run in a single process
@@ -47,10 +53,15 @@
 #
 
 from .activity import activity_new
+from .nearcast_batch import BATCH_SUFFIX
+from .nearcast_batch import NearcastBatch
+from .nearcast_bridge import NearcastBridge
 from .nearcast_schema import init_nearcast_schema
 
 from solent import uniq
 from solent import log
+from solent import log_enabled
+from solent import LOG_INFO
 from solent import SolentQuitException
 
 from collections import deque
@@ -95,6 +106,8 @@ class LogSnoop:
         pass
     #
     def on_nearcast_message(self, cog_h, message_h, d_fields):
+        if not log_enabled(LOG_INFO):
+            return
         def format_message():
             sb = []
             sb.append('[%s/%s/%s] '%(self.orb.schema_h, cog_h, message_h))
@@ -141,10 +154,19 @@ def attach_bridge_nc_method_to_cog(cog, mname, fnames):
 
 ORB_METADATA_H = '_orb_metadata_ns'
 
+# Kinds of entry in the orb's dispatch table. See Orb._rebuild_dispatch.
+DISPATCH_SNOOP = 'snoop'
+DISPATCH_TRACK = 'track'
+DISPATCH_COG = 'cog'
+# Handlers that take the record itself: batch handlers (see
+# nearcast_batch.py) and record consumers (see Orb.add_record_consumer).
+DISPATCH_RECORD = 'record'
+
 class OrbMetadata:
     def __init__(self):
         self.has_orb_turn = False
         self.has_orb_close = False
+        self.has_orb_bind_wakeup = False
         self.consumes = []
 
 def install_orb_metadata(ob):
@@ -155,6 +177,8 @@ def install_orb_metadata(ob):
         orb_md.has_orb_turn = True
     if 'orb_close' in d:
         orb_md.has_orb_close = True
+    if 'orb_bind_wakeup' in d:
+        orb_md.has_orb_bind_wakeup = True
     for mname in d:
         if not mname.startswith('on_'):
             continue
@@ -163,6 +187,35 @@ def install_orb_metadata(ob):
     #
     setattr(ob, ORB_METADATA_H, orb_md)
 
+class CogWakeup:
+    '''
+    Handle that the orb gives to cogs that opt in to wakeup scheduling. See
+    the overview at the top of this file.
+    '''
+    def __init__(self, orb, cog):
+        self.orb = orb
+        self.cog = cog
+        #
+        self.b_runnable = False
+    def wake(self):
+        if self.b_runnable:
+            return
+        self.b_runnable = True
+        self.orb.runnable_cogs.append(self)
+        self.orb._wake()
+    def wake_in(self, delay):
+        '''
+        Arranges for the cog to be woken once delay seconds have passed.
+        Returns the timer_h, which you can pass to engine.close_timer.
+        '''
+        return self.orb.engine.open_timer(
+            delay=delay,
+            b_recurring=False,
+            cb_eng_timer=self.cb_eng_timer)
+    #
+    def cb_eng_timer(self, cs_eng_timer):
+        self.wake()
+
 class Orb:
     def __init__(self, spin_h, engine, i_nearcast):
         self.spin_h = spin_h
@@ -181,7 +234,34 @@ class Orb:
         self.snoops = []
         self.tracks = {} # construct vs instance
         self.cogs = []
+        # (ob, fn, message_hs). See add_record_consumer.
+        self.record_consumers = []
+        # Records, in the order they were sent. See
+        # NearcastSchema.get_record_class.
         self.ready_to_nearcast = deque()
+        #
+        # In strict mode, every message sent is checked against the schema.
+        # Otherwise we rely on the checks made when the cog's dispatcher was
+        # generated. See strict_on.
+        self.b_strict = False
+        #
+        # message_h vs list of (kind, ob, fn). This is the order in which
+        # distribute calls handlers: snoops, then tracks, then cogs, each in
+        # the order they were added. fn is the bound handler. We rebuild it
+        # whenever a snoop, track or cog is added.
+        self.d_dispatch = {}
+        #
+        # The engine hands us this via eng_bind_wakeup. If we are hosted by
+        # something that does not do that, we simply get polled.
+        self.wakeup = None
+        # cogs with orb_turn that have not opted in to wakeups
+        self.polled_cogs = []
+        # CogWakeup instances that have asked for a turn
+        self.runnable_cogs = []
+    def eng_bind_wakeup(self, wakeup):
+        self.wakeup = wakeup
+        if self.polled_cogs:
+            self.wakeup.set_polled(True)
     def eng_turn(self, activity):
         #
         if self.ready_to_nearcast:
@@ -190,10 +270,15 @@ class Orb:
                 s='orb messages')
             self.distribute()
         #
-        for cog in self.cogs:
-            orb_md = getattr(cog, ORB_METADATA_H)
-            if orb_md.has_orb_turn:
-                cog.orb_turn(
+        for cog in self.polled_cogs:
+            cog.orb_turn(
+                activity=activity)
+        if self.runnable_cogs:
+            runnable_cogs = self.runnable_cogs
+            self.runnable_cogs = []
+            for cog_wakeup in runnable_cogs:
+                cog_wakeup.b_runnable = False
+                cog_wakeup.cog.orb_turn(
                     activity=activity)
     def eng_close(self):
         for snoop in self.snoops:
@@ -203,6 +288,23 @@ class Orb:
             if orb_md.has_orb_close:
                 cog.orb_close()
     #
+    def strict_on(self):
+        '''
+        Checks every nearcast message against the schema as it is sent. This
+        is useful while developing, but costs several times as much per
+        message.
+        '''
+        self._set_strict(True)
+    def strict_off(self):
+        self._set_strict(False)
+    def _set_strict(self, b_strict):
+        self.b_strict = b_strict
+        (fast_class, strict_class) = self.nearcast_schema.get_dispatcher_classes()
+        for cog in self.cogs:
+            if b_strict:
+                cog.nearcast.__class__ = strict_class
+            else:
+                cog.nearcast.__class__ = fast_class
     def set_spin_h(self, spin_h):
         self.spin_h = spin_h
     def add_file_snoop(self, filename):
@@ -211,11 +313,13 @@ class Orb:
             nearcast_schema=self.nearcast_schema,
             filename=filename)
         self.snoops.append(snoop)
+        self._rebuild_dispatch()
     def add_log_snoop(self):
         snoop = LogSnoop(
             orb=self,
             nearcast_schema=self.nearcast_schema)
         self.snoops.append(snoop)
+        self._rebuild_dispatch()
     def init_cog(self, construct):
         cog = construct(
             cog_h=construct.__name__,
@@ -243,6 +347,70 @@ class Orb:
             orb=self,
             engine=self.engine)
         return cog
+    def init_nearcast_bridge(self, message_hs, max_backlog=16*1024*1024):
+        '''
+        Returns a NearcastBridge, a cog that sends the messages named in
+        message_hs to a peer orb in another process, and nearcasts what the
+        peer sends. See nearcast_bridge.py.
+
+        max_backlog: bytes of messages to hold while there is no peer, or
+        while the peer is slow to read.
+        '''
+        for message_h in message_hs:
+            if not self.nearcast_schema.has_message(message_h):
+                raise Exception("Unknown message type, [%s]"%(message_h))
+        cog = NearcastBridge(
+            cog_h='nearcast_bridge/%s'%(uniq()),
+            orb=self,
+            engine=self.engine,
+            message_hs=list(message_hs),
+            max_backlog=max_backlog)
+        self._add_cog(
+            cog=cog)
+        self.add_record_consumer(
+            ob=cog,
+            fn=cog.bridge_record,
+            message_hs=message_hs)
+        return cog
+    def add_record_consumer(self, ob, fn, message_hs):
+        '''
+        fn(record) is called with the record of each message_hs message, after
+        the tracks and cogs have seen it. For a batch, it gets the batch
+        record. This is for plumbing, such as the nearcast bridge, that wants
+        the record rather than its fields. The record is only valid for the
+        duration of the call.
+        '''
+        for message_h in message_hs:
+            if not self.nearcast_schema.has_message(message_h):
+                raise Exception("Unknown message type, [%s]"%(message_h))
+        self.record_consumers.append( (ob, fn, list(message_hs)) )
+        self._rebuild_dispatch()
+    def init_batch(self, cog, message_h, typecodes=None):
+        '''
+        Returns a NearcastBatch, which cog can use to nearcast many
+        message_h rows at once. See nearcast_batch.py.
+
+        typecodes: dict of field name vs array module typecode. Fields that
+        are not in it are kept in lists.
+        '''
+        if not self.nearcast_schema.has_message(message_h):
+            raise Exception("Unknown message type, [%s]"%(message_h))
+        fields = self.nearcast_schema.get_args_for_message(
+            message_h=message_h)
+        if not fields:
+            raise Exception("Message %s has no fields to batch."%(message_h))
+        if typecodes == None:
+            typecodes = {}
+        for field in typecodes.keys():
+            if field not in fields:
+                raise Exception("Message %s has no field %s."%(
+                    message_h, field))
+        return NearcastBatch(
+            orb=self,
+            cog_h=cog.cog_h,
+            message_h=message_h,
+            fields=fields,
+            typecodes=typecodes)
     def track(self, tclass):
         '''
         Construct must have no arguments, and will typically be class
@@ -280,6 +448,12 @@ class Orb:
                     om_name))
             args = args[1:]
             message_h = om_name[3:]
+            if message_h.endswith(BATCH_SUFFIX):
+                self._check_batch_handler(
+                    name=track_inst.__class__.__name__,
+                    om_name=om_name,
+                    args=args)
+                continue
             if not self.nearcast_schema.has_message(message_h):
                 m = "Cog has %s but there is no message %s in schema."%(
                     om_name, message_h)
@@ -305,73 +479,85 @@ class Orb:
         install_orb_metadata(track_inst)
         #
         self.tracks[tclass] = track_inst
+        self._rebuild_dispatch()
         return track_inst
     def nearcast(self, cog, message_h, **d_fields):
         '''
         You probably don't need to call this directly. When cogs are
         initiatlised, they have a nearcast sender injected into them.
         Use that. (self.nearcast.MESSAGE_NAME(args))
+
+        Arguments are only checked in strict mode. (See strict_on.)
         '''
-        if 'cog_h' not in dir(cog):
+        if self.b_strict:
+            self._check_nearcast(cog, message_h, d_fields)
+        record = self.nearcast_schema.new_record(
+            cog_h=cog.cog_h,
+            message_h=message_h,
+            d_fields=d_fields)
+        #
+        # It is important that we buffer all the messages to be sequenced, and
+        # then actually send them out later on in distribute. Otherwise we can
+        # end up in a situation where actors have hijacked activity away from
+        # the event loop, and a starvation scenario.
+        self.ready_to_nearcast.append(record)
+        self._wake()
+    def _check_nearcast(self, cog, message_h, d_fields):
+        if not hasattr(cog, 'cog_h'):
             raise Exception("Looks like an invalid cog arg. Has no cog_h. %s"%(
                 str(cog)))
-        elif None == cog:
-            cog_h = 'None'
-        else:
-            cog_h = cog.cog_h
         if message_h not in self.nearcast_schema:
             raise Exception("Unknown message type, [%s]"%(message_h))
         mfields = self.nearcast_schema[message_h]
         if sorted(d_fields.keys()) != sorted(mfields):
             raise Exception('inconsistent fields. need %s. got %s'%(
                 str(mfields), str(d_fields.keys())))
-        #
-        # It is important that we buffer all the messages to be sequenced, and
-        # then actually send them out later on in distribute. Otherwise we can
-        # end up in a situation where actors have hijacked activity away from
-        # the event loop, and a starvation scenario.
-        self.ready_to_nearcast.append( (cog_h, message_h, d_fields) )
     def distribute(self):
         '''
         The engine event loop will call this. Messages which have been
         buffered to be nearcast are sent out to the cogs.
+
+        We only visit the handlers that consume each message. (See
+        _rebuild_dispatch.) Handlers get the fields positionally, from the
+        message's record. Snoops get a dict. Once every handler has seen it,
+        the record goes back to its pool.
+
+        A batch record goes whole to batch handlers, and a row at a time to
+        everyone else.
         '''
-        while self.ready_to_nearcast:
-            (cog_h, message_h, d_fields) = self.ready_to_nearcast.popleft()
-            rname = 'on_%s'%message_h
-            for snoop in self.snoops:
-                snoop.on_nearcast_message(
-                    cog_h=cog_h,
-                    message_h=message_h,
-                    d_fields=d_fields)
-            for (construct, track) in self.tracks.items():
-                orb_md = getattr(track, ORB_METADATA_H)
-                if message_h in orb_md.consumes:
-                    fn = getattr(track, rname)
-                    try:
-                        fn(**d_fields)
-                    except SolentQuitException:
-                        raise
-                    except:
-                        log('')
+        ready_to_nearcast = self.ready_to_nearcast
+        while ready_to_nearcast:
+            record = ready_to_nearcast.popleft()
+            # A handler can add a cog, which replaces the table. The new cog
+            # hears from the next message on.
+            for (kind, ob, fn) in self.d_dispatch.get(record.dispatch_h, ()):
+                try:
+                    if kind is DISPATCH_SNOOP:
+                        record.snoop(fn)
+                    elif kind is DISPATCH_RECORD:
+                        fn(record)
+                    else:
+                        record.invoke(fn)
+                except SolentQuitException:
+                    raise
+                except:
+                    rname = 'on_%s'%record.message_h
+                    log('')
+                    if kind is DISPATCH_TRACK:
                         log('!! breaking in orb [%s], track, %s:%s'%(
-                            self.spin_h, track.__class__.__name__, rname))
-                        log('')
-                        raise
-            for cog in self.cogs:
-                orb_md = getattr(cog, ORB_METADATA_H)
-                if message_h in orb_md.consumes:
-                    fn = getattr(cog, rname)
-                    try:
-                        fn(**d_fields)
-                    except SolentQuitException:
-                        raise
-                    except:
-                        log('')
+                            self.spin_h, ob.__class__.__name__, rname))
+                    elif kind is DISPATCH_COG:
                         log('!! breaking in orb[%s], cog, %s:%s'%(
-                            self.spin_h, cog.cog_h, rname))
-                        log('')
-                        raise
+                            self.spin_h, ob.cog_h, rname))
+                    elif kind is DISPATCH_RECORD:
+                        log('!! breaking in orb[%s], %s:%s'%(
+                            self.spin_h, ob.__class__.__name__, fn.__name__))
+                    else:
+                        log('!! breaking in orb[%s], snoop, %s'%(
+                            self.spin_h, ob.__class__.__name__))
+                    log('')
+                    raise
+            record.release()
     def cycle(self, max_turns=20):
         '''
         This is useful for testing. It keeps calling orb_turn until there
@@ -396,6 +582,58 @@ class Orb:
                 break
             turn_counter += 1
     #
+    def _wake(self):
+        if self.wakeup != None:
+            self.wakeup.wake()
+    def _rebuild_dispatch(self):
+        '''
+        Works out, for each message, which handlers consume it, so that
+        distribute does not have to ask every track and cog on every message.
+
+        We build a fresh table rather than editing the current one, because
+        distribute may be part-way through a list when a cog is added.
+        '''
+        d_dispatch = {}
+        for message_h in self.nearcast_schema.messages.keys():
+            d_dispatch[message_h] = []
+            d_dispatch[message_h + BATCH_SUFFIX] = []
+        for snoop in self.snoops:
+            fn = snoop.on_nearcast_message
+            for handlers in d_dispatch.values():
+                handlers.append( (DISPATCH_SNOOP, snoop, fn) )
+        obs = [(DISPATCH_TRACK, track) for track in self.tracks.values()]
+        obs.extend([(DISPATCH_COG, cog) for cog in self.cogs])
+        for (kind, ob) in obs:
+            orb_md = getattr(ob, ORB_METADATA_H)
+            for message_h in orb_md.consumes:
+                if message_h.endswith(BATCH_SUFFIX):
+                    continue
+                fn = getattr(ob, 'on_%s'%message_h)
+                d_dispatch[message_h].append( (kind, ob, fn) )
+                # Unless it has a batch handler, it gets batches by row.
+                batch_h = message_h + BATCH_SUFFIX
+                if batch_h not in orb_md.consumes:
+                    d_dispatch[batch_h].append( (kind, ob, fn) )
+            for batch_h in orb_md.consumes:
+                if not batch_h.endswith(BATCH_SUFFIX):
+                    continue
+                fn = getattr(ob, 'on_%s'%batch_h)
+                d_dispatch[batch_h].append( (DISPATCH_RECORD, ob, fn) )
+        for (ob, fn, message_hs) in self.record_consumers:
+            for message_h in message_hs:
+                d_dispatch[message_h].append( (DISPATCH_RECORD, ob, fn) )
+                d_dispatch[message_h + BATCH_SUFFIX].append(
+                    (DISPATCH_RECORD, ob, fn) )
+        self.d_dispatch = d_dispatch
+    def _check_batch_handler(self, name, om_name, args):
+        message_h = om_name[3:-len(BATCH_SUFFIX)]
+        if not self.nearcast_schema.has_message(message_h):
+            m = "%s has %s but there is no message %s in schema."%(
+                name, om_name, message_h)
+            raise Exception(m)
+        if len(args) != 1:
+            raise Exception("%s:%s should take one arg, the batch."%(
+                name, om_name))
     def _add_cog(self, cog):
         if cog in self.cogs:
             try:
@@ -415,6 +653,12 @@ class Orb:
                     om_name))
             args = args[1:]
             message_h = om_name[3:]
+            if message_h.endswith(BATCH_SUFFIX):
+                self._check_batch_handler(
+                    name=cog_h,
+                    om_name=om_name,
+                    args=args)
+                continue
             if not self.nearcast_schema.has_message(message_h):
                 m = "Cog has %s but there is no message %s in schema."%(
                     om_name, message_h)
@@ -438,9 +682,27 @@ class Orb:
                 str(cog)))
         #
         install_orb_metadata(cog)
+        orb_md = getattr(cog, ORB_METADATA_H)
+        if orb_md.has_orb_bind_wakeup and not orb_md.has_orb_turn:
+            raise Exception("Cog %s has orb_bind_wakeup but no orb_turn."%(
+                cog_h))
         #
         self.nearcast_schema.attach_nearcast_dispatcher_on_cog(
             orb=self,
             cog=cog)
         self.cogs.append(cog)
+        self._rebuild_dispatch()
+        #
+        if orb_md.has_orb_bind_wakeup:
+            cog_wakeup = CogWakeup(
+                orb=self,
+                cog=cog)
+            cog.orb_bind_wakeup(
+                wakeup=cog_wakeup)
+            # Everyone gets a first turn.
+            cog_wakeup.wake()
+        elif orb_md.has_orb_turn:
+            self.polled_cogs.append(cog)
+            if self.wakeup != None:
+                self.wakeup.set_polled(True)
 
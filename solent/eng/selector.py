@@ -0,0 +1,245 @@
+#
+# selector
+#
+# // overview
+# Facade around the different readiness-notification mechanisms that the
+# operating system offers us. Engine talks to one of these rather than
+# calling select.select directly.
+#
+# There are three implementations,
+#   * epoll. Linux. Interest is held by the kernel, and the cost of a wait is
+#     proportional to the number of sockets that are ready, rather than to
+#     the number of sockets we hold.
+#   * poll. Most unix. No FD_SETSIZE limit, but we pay for every registered
+#     fd on each wait.
+#   * select. Everywhere, including Windows. This is the behaviour the engine
+#     has always had, and is retained for portability.
+#
+# All three present the same interface. You register an fd with a mask of
+# SELECTOR_READ/SELECTOR_WRITE, modify that mask as your interest changes,
+# and unregister it before you close the socket. A call to select returns a
+# list of (fd, mask) pairs for the fds that need attention.
+#
+# When the kernel reports an error or hangup against an fd, we translate that
+# into readiness for whatever the caller had registered an interest in. That
+# way the error surfaces through the normal recv/send/SO_ERROR codepaths in
+# metasock, which already know how to deal with it. Where the caller had no
+# interest registered, we report SELECTOR_EXCEPT.
+#
+# // license
+# Copyright 2016, Free Software Foundation.
+#
+# This file is part of Solent.
+#
+# Solent is free software: you can redistribute it and/or modify it under the
+# terms of the GNU Lesser General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option)
+# any later version.
+#
+# Solent is distributed in the hope that it will be useful, but WITHOUT ANY
+# WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE. See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along with
+# Solent. If not, see <http://www.gnu.org/licenses/>.
+
+import select
+
+SELECTOR_READ = 1
+SELECTOR_WRITE = 2
+SELECTOR_EXCEPT = 4
+
+SELECTOR_EPOLL = 'epoll'
+SELECTOR_POLL = 'poll'
+SELECTOR_SELECT = 'select'
+
+def fd_to_fileno(fd):
+    '''
+    Engine allows users to register things like sys.stdin as custom fds. The
+    kernel interfaces want an int.
+    '''
+    if isinstance(fd, int):
+        return fd
+    return fd.fileno()
+
+def translate_error_mask(mask):
+    if mask & (SELECTOR_READ|SELECTOR_WRITE):
+        return mask & (SELECTOR_READ|SELECTOR_WRITE)
+    return SELECTOR_EXCEPT
+
+class SelectorEpoll:
+    def __init__(self):
+        self.selector_h = SELECTOR_EPOLL
+        #
+        self.epoll = select.epoll()
+        # fileno vs mask
+        self.d_mask = {}
+        self.events = []
+    def _kernel_mask(self, mask):
+        kmask = select.EPOLLPRI
+        if mask & SELECTOR_READ:
+            kmask |= select.EPOLLIN
+        if mask & SELECTOR_WRITE:
+            kmask |= select.EPOLLOUT
+        return kmask
+    def register(self, fd, mask):
+        self.d_mask[fd] = mask
+        self.epoll.register(fd, self._kernel_mask(mask))
+    def modify(self, fd, mask):
+        if self.d_mask[fd] == mask:
+            return
+        self.d_mask[fd] = mask
+        self.epoll.modify(fd, self._kernel_mask(mask))
+    def unregister(self, fd):
+        del self.d_mask[fd]
+        try:
+            self.epoll.unregister(fd)
+        except (OSError, ValueError):
+            # The socket may already have been closed underneath us, in
+            # which case the kernel has dropped it from the set already.
+            pass
+    def count(self):
+        return len(self.d_mask)
+    def select(self, timeout):
+        events = self.events
+        events.clear()
+        for (fd, kmask) in self.epoll.poll(timeout):
+            mask = 0
+            if kmask & select.EPOLLIN:
+                mask |= SELECTOR_READ
+            if kmask & select.EPOLLOUT:
+                mask |= SELECTOR_WRITE
+            if kmask & select.EPOLLPRI:
+                mask |= SELECTOR_EXCEPT
+            if kmask & (select.EPOLLERR|select.EPOLLHUP):
+                mask |= translate_error_mask(self.d_mask.get(fd, 0))
+            events.append( (fd, mask) )
+        return events
+    def close(self):
+        self.epoll.close()
+
+class SelectorPoll:
+    def __init__(self):
+        self.selector_h = SELECTOR_POLL
+        #
+        self.poll = select.poll()
+        # fileno vs mask
+        self.d_mask = {}
+        self.events = []
+    def _kernel_mask(self, mask):
+        kmask = select.POLLPRI
+        if mask & SELECTOR_READ:
+            kmask |= select.POLLIN
+        if mask & SELECTOR_WRITE:
+            kmask |= select.POLLOUT
+        return kmask
+    def register(self, fd, mask):
+        self.d_mask[fd] = mask
+        self.poll.register(fd, self._kernel_mask(mask))
+    def modify(self, fd, mask):
+        if self.d_mask[fd] == mask:
+            return
+        self.d_mask[fd] = mask
+        self.poll.modify(fd, self._kernel_mask(mask))
+    def unregister(self, fd):
+        del self.d_mask[fd]
+        try:
+            self.poll.unregister(fd)
+        except KeyError:
+            pass
+    def count(self):
+        return len(self.d_mask)
+    def select(self, timeout):
+        events = self.events
+        events.clear()
+        # poll wants milliseconds
+        for (fd, kmask) in self.poll.poll(timeout * 1000):
+            mask = 0
+            if kmask & select.POLLIN:
+                mask |= SELECTOR_READ
+            if kmask & select.POLLOUT:
+                mask |= SELECTOR_WRITE
+            if kmask & select.POLLPRI:
+                mask |= SELECTOR_EXCEPT
+            if kmask & (select.POLLERR|select.POLLHUP):
+                mask |= translate_error_mask(self.d_mask.get(fd, 0))
+            if kmask & select.POLLNVAL:
+                mask |= SELECTOR_EXCEPT
+            events.append( (fd, mask) )
+        return events
+    def close(self):
+        pass
+
+class SelectorSelect:
+    '''
+    Here we have to rebuild the lists for every wait, because that is how
+    select.select works. Every registered fd goes into xlist, which is the
+    behaviour engine had before selectors existed.
+    '''
+    def __init__(self):
+        self.selector_h = SELECTOR_SELECT
+        #
+        # fileno vs mask
+        self.d_mask = {}
+        self.events = []
+    def register(self, fd, mask):
+        self.d_mask[fd] = mask
+    def modify(self, fd, mask):
+        self.d_mask[fd] = mask
+    def unregister(self, fd):
+        del self.d_mask[fd]
+    def count(self):
+        return len(self.d_mask)
+    def select(self, timeout):
+        rlist = []
+        wlist = []
+        xlist = []
+        for (fd, mask) in self.d_mask.items():
+            if mask & SELECTOR_READ:
+                rlist.append(fd)
+            if mask & SELECTOR_WRITE:
+                wlist.append(fd)
+            xlist.append(fd)
+        rlist, wlist, xlist = select.select(rlist, wlist, xlist, timeout)
+        #
+        d_ready = {}
+        for fd in rlist:
+            d_ready[fd] = SELECTOR_READ
+        for fd in wlist:
+            d_ready[fd] = d_ready.get(fd, 0) | SELECTOR_WRITE
+        for fd in xlist:
+            d_ready[fd] = d_ready.get(fd, 0) | SELECTOR_EXCEPT
+        #
+        events = self.events
+        events.clear()
+        events.extend(d_ready.items())
+        return events
+    def close(self):
+        pass
+
+def init_selector(selector_h=None):
+    '''
+    selector_h: one of 'epoll', 'poll', 'select', or None. If you supply None,
+    you get the best mechanism that the platform offers.
+    '''
+    if selector_h == None:
+        if hasattr(select, 'epoll'):
+            selector_h = SELECTOR_EPOLL
+        elif hasattr(select, 'poll'):
+            selector_h = SELECTOR_POLL
+        else:
+            selector_h = SELECTOR_SELECT
+    #
+    if selector_h == SELECTOR_EPOLL:
+        if not hasattr(select, 'epoll'):
+            raise Exception("epoll is not available on this platform.")
+        return SelectorEpoll()
+    elif selector_h == SELECTOR_POLL:
+        if not hasattr(select, 'poll'):
+            raise Exception("poll is not available on this platform.")
+        return SelectorPoll()
+    elif selector_h == SELECTOR_SELECT:
+        return SelectorSelect()
+    else:
+        raise Exception("Unknown selector [%s]"%(selector_h))
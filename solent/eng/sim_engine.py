@@ -0,0 +1,509 @@
+#
+# sim_engine
+#
+# // overview
+# An Engine whose network and clock are simulated. Use it to run orb systems
+# through long stretches of traffic in tests or capacity models, much faster
+# than wall-clock time and with the same outcome every run.
+#
+# SimEngine has the API of Engine. Its timers, spins and orbs are Engine's
+# own. What changes is underneath,
+#
+#   * The clock is a SimClock. It does not move on its own. When a turn has
+#     nothing to do, rather than sleep, the engine jumps the clock forward to
+#     the next timer or network event.
+#
+#   * Sockets are SimMetasocks. They are Metasocks, so they make the same
+#     callbacks with the same cs structs, and they do the same watermark
+#     accounting. But a send goes onto the engine's in-memory network rather
+#     than to the kernel, and is delivered after the simulated latency (see
+#     set_sim_latency). Events that are due at the same time are delivered in
+#     the order they were sent.
+#
+# Example,
+#
+#     engine = SimEngine(
+#         mtu=1500)
+#     engine.set_sim_latency(0.001)
+#     orb = engine.init_orb(i_nearcast=I_NEARCAST)
+#     ...
+#     engine.run_for(3600)
+#
+# The simulation is of a single host. Things that are a matter for the
+# kernel (ttl, multicast loopback and interface, reuseport, backlog) are
+# accepted and ignored. Datagrams sent to an addr and port go to every sub
+# that is bound there. Tcp delivers each send as one recv on the other side.
+# Custom fd reads are not supported, since they need a real selector.
+#
+# // license
+# Copyright 2016, Free Software Foundation.
+#
+# This file is part of Solent.
+#
+# Solent is free software: you can redistribute it and/or modify it under the
+# terms of the GNU Lesser General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option)
+# any later version.
+#
+# Solent is distributed in the hope that it will be useful, but WITHOUT ANY
+# WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE. See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along with
+# Solent. If not, see <http://www.gnu.org/licenses/>.
+
+from .engine import Engine
+from .metasock import Metasock
+from .metasock import MS_TYPE_PUB
+from .metasock import MS_TYPE_SUB
+from .metasock import MS_TYPE_TCP_ACCEPT
+from .metasock import MS_TYPE_TCP_CLIENT
+from .metasock import MS_TYPE_TCP_SERVER
+
+from solent import get_net_logger
+from solent import log
+
+import heapq
+
+# Where the simulation needs an address for the other end of a connection
+# or the sender of a datagram, it uses this, with a port derived from the
+# sender's sid.
+SIM_PEER_ADDR = '127.0.0.1'
+
+def sim_peer_port(sid):
+    return 32768 + (sid % 28232)
+
+class SimClock:
+    def __init__(self, t=0.0):
+        self.t = t
+    def now(self):
+        return self.t
+    def set(self, t):
+        if t < self.t:
+            raise Exception("SimClock cannot go back (at %s, asked for %s)"%(
+                self.t, t))
+        self.t = t
+    def advance(self, delay):
+        self.set(self.t + delay)
+
+class SimMetasock(Metasock):
+    def __init__(self, engine, mempool, sid, ms_type, addr, port):
+        Metasock.__init__(
+            self,
+            engine=engine,
+            mempool=mempool,
+            sid=sid,
+            ms_type=ms_type,
+            addr=addr,
+            port=port)
+        # For tcp clients and accepts, the metasock at the other end.
+        self.sim_peer = None
+        # Sends made by a tcp client before it has connected.
+        self.sim_pending = []
+    def refresh_interest(self):
+        pass
+    def add_to_send_queue(self, bb, sip):
+        '''
+        As for Metasock, except that rather than queue bb for the kernel, we
+        hand it to the simulated network. Bytes count as queued until they
+        have been delivered.
+        '''
+        bb = bytes(bb)
+        if sip != None:
+            self.mempool.free(
+                sip=sip)
+        self.count_send_calls += 1
+        self.count_send_bytes += len(bb)
+        if self.ms_type == MS_TYPE_PUB:
+            # Datagrams do not queue. The kernel either takes them or drops
+            # them.
+            self.engine._sim_send_datagram(
+                ms=self,
+                bb=bb)
+            return
+        self.send_buf_bytes += len(bb)
+        self.engine.send_queue_bytes += len(bb)
+        if self.b_tcp_client_connecting:
+            self.sim_pending.append(bb)
+        else:
+            self.engine._sim_send_stream(
+                ms=self,
+                bb=bb)
+        if not self.b_send_pressure and self.get_send_queue_depth() > self.send_high_water:
+            self.b_send_pressure = True
+            self._call_send_pressure()
+    def sim_sent(self, size):
+        'Called by the network when size bytes of ours have been delivered.'
+        if self.b_closed:
+            return
+        self.send_buf_bytes -= size
+        self.engine.send_queue_bytes -= size
+        self._check_send_drain()
+    def sim_recv(self, bb, addr):
+        if self.b_closed:
+            return
+        self.count_recv_calls += 1
+        self.count_recv_bytes += len(bb)
+        if self.cb_sub_recv_batch != None:
+            self.cs_sub_recv_batch.engine = self.engine
+            self.cs_sub_recv_batch.sub_sid = self.sid
+            self.cs_sub_recv_batch.entries = [(memoryview(bb), addr)]
+            self.cb_sub_recv_batch(
+                cs_sub_recv_batch=self.cs_sub_recv_batch)
+        else:
+            self._dispatch_recv(bb)
+    def release_buffers(self):
+        self.engine.send_queue_bytes -= self.send_buf_bytes
+        self.send_buf_bytes = 0
+        self.sim_pending = []
+    def retain_recv_sip(self):
+        raise Exception("retain_recv is not supported by SimEngine.")
+    def add_pub_dest(self, addr, port):
+        # No name resolution in the simulation. Subs and dests must agree on
+        # how an address is written.
+        dest = (addr, port)
+        if dest in self.pub_dests:
+            raise Exception("pub %s already sends to %s:%s"%(
+                self.sid, addr, port))
+        self.pub_dests.append(dest)
+    def remove_pub_dest(self, addr, port):
+        dest = (addr, port)
+        if dest not in self.pub_dests:
+            raise Exception("pub %s does not send to %s:%s"%(
+                self.sid, addr, port))
+        self.pub_dests.remove(dest)
+
+class SimEngine(Engine):
+    def __init__(self, mtu, clock=None):
+        '''
+        clock: a SimClock. If you leave it as None, you get one that starts
+        at zero.
+        '''
+        # Seconds between a send and its delivery.
+        self.sim_latency = 0.0
+        # heap of (at_t, seq, fn, args)
+        self.sim_heap = []
+        self.sim_seq = 0
+        # (addr, port) vs tcp server metasock
+        self.sim_listeners = {}
+        # (addr, port) vs list of sub metasocks
+        self.sim_subs = {}
+        #
+        Engine.__init__(
+            self,
+            mtu=mtu)
+        if clock == None:
+            clock = SimClock()
+        self.clock = clock
+        #
+        # Engine will have moved the net logger onto one of our pubs, which
+        # would send its lines into the simulation.
+        net_logger = get_net_logger()
+        if net_logger != None and net_logger.engine == self:
+            net_logger.unbind_engine()
+    def set_sim_latency(self, latency):
+        if latency < 0:
+            raise Exception("Latency cannot be negative (got %s)"%(latency))
+        self.sim_latency = latency
+    def run_until(self, t):
+        '''
+        Turns the engine until the clock reaches t, including anything that
+        is due at t.
+        '''
+        while self.clock.now() < t:
+            self.turn(
+                timeout=t - self.clock.now())
+        self.turn(
+            timeout=0)
+    def run_for(self, duration):
+        self.run_until(self.clock.now() + duration)
+    def add_custom_fd_read(self, cfd_h, fd, cb_eng_custom_fd_read):
+        raise Exception("Custom fd reads are not supported by SimEngine.")
+    #
+    # --------------------------------------------------------
+    #   network
+    # --------------------------------------------------------
+    def _sim_schedule(self, fn, *args):
+        at_t = self.clock.now() + self.sim_latency
+        heapq.heappush(self.sim_heap, (at_t, self.sim_seq, fn, args))
+        self.sim_seq += 1
+    def _call_select(self, timeout=0):
+        '''
+        Stands in for the select. If nothing is due, we move the clock on by
+        up to timeout (Engine.turn has already bounded that by the timers),
+        stopping early for the next network event. Then we deliver what is
+        due.
+
+        Events scheduled while we deliver wait for the next turn, even with
+        zero latency. Otherwise two cogs could ping-pong inside one turn
+        forever.
+        '''
+        heap = self.sim_heap
+        now = self.clock.now()
+        if timeout > 0 and (not heap or heap[0][0] > now):
+            until = now + timeout
+            if heap and heap[0][0] < until:
+                until = heap[0][0]
+            self.clock.set(until)
+            now = until
+        limit = self.sim_seq
+        b_activity = False
+        while heap and heap[0][0] <= now and heap[0][1] < limit:
+            (at_t, seq, fn, args) = heapq.heappop(heap)
+            fn(*args)
+            b_activity = True
+        return b_activity
+    def _sim_send_stream(self, ms, bb):
+        self._sim_schedule(self._sim_deliver_stream, ms, ms.sim_peer, bb)
+    def _sim_deliver_stream(self, ms_from, ms_to, bb):
+        ms_from.sim_sent(len(bb))
+        if ms_to == None:
+            return
+        ms_to.sim_recv(bb, None)
+    def _sim_send_datagram(self, ms, bb):
+        if ms.pub_dests != None:
+            dests = list(ms.pub_dests)
+        else:
+            dests = [(ms.addr, ms.port)]
+        addr = (SIM_PEER_ADDR, sim_peer_port(ms.sid))
+        for dest in dests:
+            self._sim_schedule(self._sim_deliver_datagram, dest, bb, addr)
+    def _sim_deliver_datagram(self, dest, bb, addr):
+        for ms in list(self.sim_subs.get(dest, [])):
+            ms.sim_recv(bb, addr)
+    def _sim_connect(self, ms_client):
+        if ms_client.b_closed:
+            return
+        key = (ms_client.addr, ms_client.port)
+        if key not in self.sim_listeners:
+            self._close_metasock(
+                sid=ms_client.sid,
+                reason='Unable to connect to %s:%s [ECONNREFUSED]'%(key))
+            return
+        ms_server = self.sim_listeners[key]
+        accept_sid = self.create_sid()
+        ms_accept = self._sim_create(
+            sid=accept_sid,
+            ms_type=MS_TYPE_TCP_ACCEPT,
+            addr=SIM_PEER_ADDR,
+            port=sim_peer_port(ms_client.sid))
+        ms_accept.parent_sid = ms_server.sid
+        ms_accept.cb_tcp_accept_connect = ms_server.cb_tcp_accept_connect
+        ms_accept.cb_tcp_accept_condrop = ms_server.cb_tcp_accept_condrop
+        ms_accept.cb_tcp_accept_recv = ms_server.cb_tcp_accept_recv
+        ms_accept.cb_tcp_accept_pressure = ms_server.cb_tcp_accept_pressure
+        ms_accept.cb_tcp_accept_drain = ms_server.cb_tcp_accept_drain
+        ms_accept.sim_peer = ms_client
+        ms_client.sim_peer = ms_accept
+        self._map_sid_to_metasock(
+            sid=accept_sid,
+            ms=ms_accept)
+        ms_accept.after_init()
+        if ms_client.b_closed:
+            return
+        #
+        ms_client.b_tcp_client_connecting = False
+        ms_client.cs_tcp_client_connect.engine = self
+        ms_client.cs_tcp_client_connect.client_sid = ms_client.sid
+        ms_client.cs_tcp_client_connect.addr = ms_client.addr
+        ms_client.cs_tcp_client_connect.port = ms_client.port
+        ms_client.cb_tcp_client_connect(
+            cs_tcp_client_connect=ms_client.cs_tcp_client_connect)
+        for bb in ms_client.sim_pending:
+            self._sim_send_stream(
+                ms=ms_client,
+                bb=bb)
+        ms_client.sim_pending = []
+    def _sim_peer_closed(self, ms):
+        if ms.b_closed:
+            return
+        # This is the reason a real engine gives when the other side goes.
+        self._close_metasock(
+            sid=ms.sid,
+            reason='empty_recv')
+    #
+    # --------------------------------------------------------
+    #   metasocks
+    # --------------------------------------------------------
+    def _sim_create(self, sid, ms_type, addr, port):
+        log('sim_engine create %s %s (%s:%s)', ms_type, sid, addr, port)
+        ms = SimMetasock(
+            engine=self,
+            mempool=self.mempool,
+            sid=sid,
+            ms_type=ms_type,
+            addr=addr,
+            port=port)
+        ms.can_it_recv = ms_type != MS_TYPE_PUB
+        ms.can_it_send = ms_type != MS_TYPE_SUB
+        return ms
+    def _map_sid_to_metasock(self, sid, ms):
+        self.sid_to_metasock[sid] = ms
+        if self.metrics != None:
+            self.metric_ms_opened.inc()
+    def _close_metasock(self, sid, reason):
+        ms = self.sid_to_metasock.pop(sid)
+        if ms.ms_type == MS_TYPE_TCP_SERVER:
+            del self.sim_listeners[(ms.addr, ms.port)]
+        elif ms.ms_type == MS_TYPE_SUB:
+            key = (ms.addr, ms.port)
+            self.sim_subs[key].remove(ms)
+            if not self.sim_subs[key]:
+                del self.sim_subs[key]
+        ms.eng_close(reason)
+        ms.release_buffers()
+        if self.metrics != None:
+            self.metric_ms_closed.inc()
+        #
+        # The other end hears about it once anything we sent before the
+        # close has arrived.
+        peer = ms.sim_peer
+        if peer != None:
+            ms.sim_peer = None
+            peer.sim_peer = None
+            self._sim_schedule(self._sim_peer_closed, peer)
+        log('metasock %s closed [reason: %s]', sid, reason)
+    def _sim_open_pub(self, addr, port, cb_pub_start, cb_pub_stop, dests):
+        sid = self.create_sid()
+        ms = self._sim_create(
+            sid=sid,
+            ms_type=MS_TYPE_PUB,
+            addr=addr,
+            port=port)
+        ms.cb_pub_start = cb_pub_start
+        ms.cb_pub_stop = cb_pub_stop
+        if dests != None:
+            ms.pub_dests = []
+            for (dest_addr, dest_port) in dests:
+                ms.add_pub_dest(
+                    addr=dest_addr,
+                    port=dest_port)
+        self._map_sid_to_metasock(
+            sid=sid,
+            ms=ms)
+        ms.after_init()
+        return sid
+    def open_pub(self, addr, port, cb_pub_start, cb_pub_stop):
+        return self._sim_open_pub(
+            addr=addr,
+            port=port,
+            cb_pub_start=cb_pub_start,
+            cb_pub_stop=cb_pub_stop,
+            dests=None)
+    def open_mcast_pub(self, addr, port, cb_pub_start, cb_pub_stop, ttl=1, b_loop=True, iface=None):
+        return self.open_pub(
+            addr=addr,
+            port=port,
+            cb_pub_start=cb_pub_start,
+            cb_pub_stop=cb_pub_stop)
+    def open_unix_pub(self, path, cb_pub_start, cb_pub_stop):
+        return self.open_pub(
+            addr=path,
+            port=None,
+            cb_pub_start=cb_pub_start,
+            cb_pub_stop=cb_pub_stop)
+    def open_pub_fanout(self, dests, cb_pub_start, cb_pub_stop):
+        return self._sim_open_pub(
+            addr=None,
+            port=None,
+            cb_pub_start=cb_pub_start,
+            cb_pub_stop=cb_pub_stop,
+            dests=dests)
+    def open_sub(self, addr, port, cb_sub_start, cb_sub_stop, cb_sub_recv, cb_sub_recv_batch=None):
+        if cb_sub_recv == None and cb_sub_recv_batch == None:
+            raise Exception("Need cb_sub_recv or cb_sub_recv_batch.")
+        sid = self.create_sid()
+        ms = self._sim_create(
+            sid=sid,
+            ms_type=MS_TYPE_SUB,
+            addr=addr,
+            port=port)
+        ms.cb_sub_start = cb_sub_start
+        ms.cb_sub_stop = cb_sub_stop
+        ms.cb_sub_recv = cb_sub_recv
+        ms.cb_sub_recv_batch = cb_sub_recv_batch
+        self.sim_subs.setdefault((addr, port), []).append(ms)
+        self._map_sid_to_metasock(
+            sid=sid,
+            ms=ms)
+        ms.after_init()
+        return sid
+    def open_mcast_sub(self, addr, port, cb_sub_start, cb_sub_stop, cb_sub_recv, cb_sub_recv_batch=None, iface='0.0.0.0'):
+        return self.open_sub(
+            addr=addr,
+            port=port,
+            cb_sub_start=cb_sub_start,
+            cb_sub_stop=cb_sub_stop,
+            cb_sub_recv=cb_sub_recv,
+            cb_sub_recv_batch=cb_sub_recv_batch)
+    def open_unix_sub(self, path, cb_sub_start, cb_sub_stop, cb_sub_recv, cb_sub_recv_batch=None):
+        return self.open_sub(
+            addr=path,
+            port=None,
+            cb_sub_start=cb_sub_start,
+            cb_sub_stop=cb_sub_stop,
+            cb_sub_recv=cb_sub_recv,
+            cb_sub_recv_batch=cb_sub_recv_batch)
+    def open_tcp_server(self, addr, port, cb_tcp_server_start, cb_tcp_server_stop, cb_tcp_accept_connect, cb_tcp_accept_condrop, cb_tcp_accept_recv, backlog=None, cb_tcp_accept_pressure=None, cb_tcp_accept_drain=None, reuseport=False):
+        key = (addr, port)
+        if key in self.sim_listeners:
+            raise Exception("%s:%s is in use."%(addr, port))
+        sid = self.create_sid()
+        ms = self._sim_create(
+            sid=sid,
+            ms_type=MS_TYPE_TCP_SERVER,
+            addr=addr,
+            port=port)
+        ms.cb_tcp_server_start = cb_tcp_server_start
+        ms.cb_tcp_server_stop = cb_tcp_server_stop
+        ms.cb_tcp_accept_connect = cb_tcp_accept_connect
+        ms.cb_tcp_accept_condrop = cb_tcp_accept_condrop
+        ms.cb_tcp_accept_recv = cb_tcp_accept_recv
+        ms.cb_tcp_accept_pressure = cb_tcp_accept_pressure
+        ms.cb_tcp_accept_drain = cb_tcp_accept_drain
+        self.sim_listeners[key] = ms
+        self._map_sid_to_metasock(
+            sid=sid,
+            ms=ms)
+        ms.after_init()
+        return sid
+    def open_unix_server(self, path, cb_tcp_server_start, cb_tcp_server_stop, cb_tcp_accept_connect, cb_tcp_accept_condrop, cb_tcp_accept_recv, backlog=None, cb_tcp_accept_pressure=None, cb_tcp_accept_drain=None):
+        return self.open_tcp_server(
+            addr=path,
+            port=None,
+            cb_tcp_server_start=cb_tcp_server_start,
+            cb_tcp_server_stop=cb_tcp_server_stop,
+            cb_tcp_accept_connect=cb_tcp_accept_connect,
+            cb_tcp_accept_condrop=cb_tcp_accept_condrop,
+            cb_tcp_accept_recv=cb_tcp_accept_recv,
+            cb_tcp_accept_pressure=cb_tcp_accept_pressure,
+            cb_tcp_accept_drain=cb_tcp_accept_drain)
+    def open_tcp_client(self, addr, port, cb_tcp_client_connect, cb_tcp_client_condrop, cb_tcp_client_recv, cb_tcp_client_pressure=None, cb_tcp_client_drain=None):
+        sid = self.create_sid()
+        ms = self._sim_create(
+            sid=sid,
+            ms_type=MS_TYPE_TCP_CLIENT,
+            addr=addr,
+            port=port)
+        ms.b_tcp_client_connecting = True
+        ms.cb_tcp_client_connect = cb_tcp_client_connect
+        ms.cb_tcp_client_condrop = cb_tcp_client_condrop
+        ms.cb_tcp_client_recv = cb_tcp_client_recv
+        ms.cb_tcp_client_pressure = cb_tcp_client_pressure
+        ms.cb_tcp_client_drain = cb_tcp_client_drain
+        self._map_sid_to_metasock(
+            sid=sid,
+            ms=ms)
+        ms.after_init()
+        self._sim_schedule(self._sim_connect, ms)
+        return sid
+    def open_unix_client(self, path, cb_tcp_client_connect, cb_tcp_client_condrop, cb_tcp_client_recv, cb_tcp_client_pressure=None, cb_tcp_client_drain=None):
+        return self.open_tcp_client(
+            addr=path,
+            port=None,
+            cb_tcp_client_connect=cb_tcp_client_connect,
+            cb_tcp_client_condrop=cb_tcp_client_condrop,
+            cb_tcp_client_recv=cb_tcp_client_recv,
+            cb_tcp_client_pressure=cb_tcp_client_pressure,
+            cb_tcp_client_drain=cb_tcp_client_drain)
@@ -0,0 +1,220 @@
+#
+# worker_pool
+#
+# // overview
+# Spin that runs blocking calls on a pool of threads, and hands their results
+# back on the event loop thread.
+#
+# Everything in the engine runs on one thread. If a cog does something that
+# blocks (reading a large file, hashing, compression) then every socket waits
+# for it. Instead, submit the work here. The engine carries on with network
+# activity while the workers run, and you get a callback on the loop thread
+# once the work is done.
+#
+# Workers signal completion by writing to an eventfd (or to a self-pipe,
+# where eventfd is not available). The read end is registered with the
+# engine as a custom fd read, so a completion wakes the select loop like any
+# other socket activity would.
+#
+# Example,
+#
+#     self.spin_worker_pool = engine.init_spin(
+#         construct=SpinWorkerPool,
+#         worker_count=2)
+#     ...
+#     self.spin_worker_pool.submit(
+#         fn=read_file,
+#         cb_worker_done=self.cb_worker_done,
+#         filename=filename)
+#     ...
+#     def cb_worker_done(self, cs_worker_done):
+#         if cs_worker_done.exception != None:
+#             ...
+#         bb = cs_worker_done.result
+#
+# Your fn runs on a worker thread. It must not touch the engine, or any
+# other structure that the loop thread uses.
+#
+# // license
+# Copyright 2016, Free Software Foundation.
+#
+# This file is part of Solent.
+#
+# Solent is free software: you can redistribute it and/or modify it under the
+# terms of the GNU Lesser General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option)
+# any later version.
+#
+# Solent is distributed in the hope that it will be useful, but WITHOUT ANY
+# WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE. See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along with
+# Solent. If not, see <http://www.gnu.org/licenses/>.
+
+from collections import deque
+import os
+import queue
+import threading
+
+class CsWorkerDone:
+    def __init__(self):
+        self.engine = None
+        self.job_h = None
+        # Return value of fn. None if fn raised.
+        self.result = None
+        # The exception that fn raised, or None.
+        self.exception = None
+
+class WorkerWake:
+    '''
+    Cross-thread wakeup for the select loop. Uses eventfd where the platform
+    offers it, and a non-blocking pipe otherwise.
+    '''
+    def __init__(self):
+        if hasattr(os, 'eventfd'):
+            self.rfd = os.eventfd(0, os.EFD_NONBLOCK|os.EFD_CLOEXEC)
+            self.wfd = self.rfd
+            self.wake_bb = (1).to_bytes(8, 'little')
+        else:
+            (self.rfd, self.wfd) = os.pipe()
+            os.set_blocking(self.rfd, False)
+            os.set_blocking(self.wfd, False)
+            self.wake_bb = b'x'
+    def wake(self):
+        try:
+            os.write(self.wfd, self.wake_bb)
+        except BlockingIOError:
+            # The pipe is full, so the loop has plenty to wake it already.
+            pass
+    def drain(self):
+        while True:
+            try:
+                os.read(self.rfd, 4096)
+            except BlockingIOError:
+                return
+    def close(self):
+        os.close(self.rfd)
+        if self.wfd != self.rfd:
+            os.close(self.wfd)
+
+class SpinWorkerPool:
+    def __init__(self, spin_h, engine, worker_count=4):
+        if worker_count < 1:
+            raise Exception("worker_count must be at least 1 (got %s)"%(
+                worker_count))
+        self.spin_h = spin_h
+        self.engine = engine
+        #
+        self.cs_worker_done = CsWorkerDone()
+        #
+        # job_h vs cb_worker_done. Only the loop thread touches this.
+        self.d_job = {}
+        self.job_seq = 0
+        #
+        # Workers pull (job_h, fn, kwargs) from here. None tells a worker
+        # to stop.
+        self.q_todo = queue.SimpleQueue()
+        # Workers push (job_h, result, exception) here. deque append and
+        # popleft are atomic, so we do not need a lock.
+        self.q_done = deque()
+        #
+        self.worker_wake = WorkerWake()
+        self.engine.add_custom_fd_read(
+            cfd_h=self.spin_h,
+            fd=self.worker_wake.rfd,
+            cb_eng_custom_fd_read=self.cb_eng_custom_fd_read)
+        #
+        self.threads = []
+        for i in range(worker_count):
+            thread = threading.Thread(
+                name='%s/%s'%(spin_h, i),
+                target=self._worker_main,
+                daemon=True)
+            thread.start()
+            self.threads.append(thread)
+        self.b_closed = False
+    def eng_turn(self, activity):
+        pass
+    def eng_close(self):
+        '''
+        Jobs that have not started are dropped. Waits for jobs that are
+        already running to finish. No callbacks are called.
+        '''
+        if self.b_closed:
+            return
+        self.b_closed = True
+        # Otherwise the stop sentinels would queue behind the pending jobs,
+        # and we would wait for all of them to run.
+        while True:
+            try:
+                self.q_todo.get_nowait()
+            except queue.Empty:
+                break
+        for thread in self.threads:
+            self.q_todo.put(None)
+        for thread in self.threads:
+            thread.join()
+        self.engine.remove_custom_fd_read(
+            fd=self.worker_wake.rfd)
+        self.worker_wake.close()
+        self.d_job.clear()
+        self.q_done.clear()
+    def submit(self, fn, cb_worker_done, **kwargs):
+        '''
+        Runs fn(**kwargs) on a worker thread. When it is finished,
+        cb_worker_done(cs_worker_done) is called on the loop thread.
+
+        Returns a job_h.
+        '''
+        if self.b_closed:
+            raise Exception("Worker pool %s is closed."%(self.spin_h))
+        job_h = self.job_seq
+        self.job_seq += 1
+        self.d_job[job_h] = cb_worker_done
+        self.q_todo.put( (job_h, fn, kwargs) )
+        return job_h
+    def count_pending(self):
+        'Jobs that have been submitted, and whose callback has not yet run.'
+        return len(self.d_job)
+    #
+    def _worker_main(self):
+        q_todo = self.q_todo
+        q_done = self.q_done
+        while True:
+            item = q_todo.get()
+            if item == None:
+                return
+            (job_h, fn, kwargs) = item
+            try:
+                result = fn(**kwargs)
+                exception = None
+            except Exception as e:
+                result = None
+                exception = e
+            except BaseException as e:
+                # For example, SystemExit. This ends the thread, but the job
+                # still gets its callback, so that it is not left pending.
+                q_done.append( (job_h, None, e) )
+                self.worker_wake.wake()
+                raise
+            q_done.append( (job_h, result, exception) )
+            self.worker_wake.wake()
+    def cb_eng_custom_fd_read(self, cs_eng_custom_fd_read):
+        self.worker_wake.drain()
+        #
+        # Only deliver what is here now. Anything that arrives during the
+        # callbacks will have woken the fd again.
+        q_done = self.q_done
+        for i in range(len(q_done)):
+            (job_h, result, exception) = q_done.popleft()
+            cb_worker_done = self.d_job.pop(job_h)
+            self.cs_worker_done.engine = self.engine
+            self.cs_worker_done.job_h = job_h
+            self.cs_worker_done.result = result
+            self.cs_worker_done.exception = exception
+            cb_worker_done(
+                cs_worker_done=self.cs_worker_done)
+            if self.b_closed:
+                return
@@ -32,6 +32,7 @@
 from solent import Ns
 from solent import Engine
 from solent import log
+from solent import log_debug
 
 import os
 import struct
@@ -302,9 +303,9 @@ class CogNetwork:
         bb = cs_recv_bulk_protocol_data.bb
 
         self.doc_so_far += len(bb)
-        log(
-            'bulk data: %s, block length (%s of %s)'%(
-                zero_h, self.doc_so_far, self.doc_len))
+        log_debug(
+            'bulk data: %s, block length (%s of %s)',
+            zero_h, self.doc_so_far, self.doc_len)
 
         self.f_ptr.write(bb)
 
@@ -30,6 +30,7 @@
 
 from solent import Engine
 from solent import log
+from solent.eng import SpinWorkerPool
 from solent.util import RailLineConsole
 
 from collections import deque
@@ -65,6 +66,13 @@ I_NEARCAST = '''
 '''
 
 
+def read_file(filename):
+    f_ptr = open(filename, 'rb')
+    bb_file = f_ptr.read()
+    f_ptr.close()
+    return bb_file
+
+
 class TrackPrime:
 
     def __init__(self, orb):
@@ -159,12 +167,21 @@ class CogNetwork:
 
         self.track_prime = self.orb.track(TrackPrime)
 
+        self.spin_worker_pool = engine.init_spin(
+            construct=SpinWorkerPool,
+            worker_count=1)
+
         self.send_queue = deque()
 
         self.client_sid = None
         self.active_finished = False
         self.active_tpl = None
 
+        self.read_job_h = None
+        self.mv_file = None
+        self.file_offset = 0
+        self.b_send_paused = False
+
     def on_init(self):
         pass
 
@@ -198,7 +215,9 @@ class CogNetwork:
             port=self.track_prime.bulk_port,
             cb_tcp_client_connect=self.cb_tcp_client_connect,
             cb_tcp_client_condrop=self.cb_tcp_client_condrop,
-            cb_tcp_client_recv=self.cb_tcp_client_recv)
+            cb_tcp_client_recv=self.cb_tcp_client_recv,
+            cb_tcp_client_pressure=self.cb_tcp_client_pressure,
+            cb_tcp_client_drain=self.cb_tcp_client_drain)
 
     def cb_tcp_client_connect(self, cs_tcp_client_connect):
         engine = cs_tcp_client_connect.engine
@@ -210,11 +229,32 @@ class CogNetwork:
 
         (enqueue_h, filename) = self.active_tpl
 
-        # For large files, this will jam the event loop. But this process is
-        # not doing much else, so I figure that is fine.
-        f_ptr = open(filename, 'rb')
-        bb_file = f_ptr.read()
-        f_ptr.close()
+        # Reading a large file would jam the event loop, so we have a worker
+        # thread do it.
+        self.read_job_h = self.spin_worker_pool.submit(
+            fn=read_file,
+            cb_worker_done=self.cb_worker_done,
+            filename=filename)
+
+    def cb_worker_done(self, cs_worker_done):
+        engine = cs_worker_done.engine
+        job_h = cs_worker_done.job_h
+        result = cs_worker_done.result
+        exception = cs_worker_done.exception
+
+        if job_h != self.read_job_h:
+            # We lost the connection while the file was being read.
+            return
+        self.read_job_h = None
+
+        if exception != None:
+            log('failed to read file (%s)'%(exception))
+            self.engine.close_tcp_client(
+                client_sid=self.client_sid)
+            return
+
+        bb_file = result
+        client_sid = self.client_sid
 
         # In the protocol for this bulk transfer method, the first eight
         # bytes are a uint64 that tell the other side how much data we
@@ -225,22 +265,46 @@ class CogNetwork:
             sid=client_sid,
             bb=leading_uint64)
 
-        blen = len(bb_file)
-        offset = 0
-        while True:
-            nail = offset
-            peri = offset+engine.mtu
-            bb = bb_file[nail:peri]
-
-            self.engine.send(
-                sid=client_sid,
-                bb=bb)
-            offset = peri
-
-            if offset >= blen:
-                break
-
-        log("Content is queued engine.")
+        # bb_file is immutable and we are finished with it, so we can hand
+        # slices of it to the engine without copying them. We queue slices
+        # until the engine tells us the send queue is under pressure, and
+        # then wait for it to drain before we queue more.
+        self.mv_file = memoryview(bb_file)
+        self.file_offset = 0
+        self.b_send_paused = False
+        self.__queue_file_content()
+
+    def __queue_file_content(self):
+        mv_file = self.mv_file
+        blen = len(mv_file)
+        mtu = self.engine.mtu
+        while self.file_offset < blen and not self.b_send_paused:
+            nail = self.file_offset
+            peri = nail+mtu
+            self.file_offset = peri
+            self.engine.send_owned(
+                sid=self.client_sid,
+                bb=mv_file[nail:peri])
+
+        if self.file_offset >= blen:
+            self.mv_file = None
+            log("Content is queued engine.")
+
+    def cb_tcp_client_pressure(self, cs_tcp_client_pressure):
+        engine = cs_tcp_client_pressure.engine
+        client_sid = cs_tcp_client_pressure.client_sid
+        queued_bytes = cs_tcp_client_pressure.queued_bytes
+
+        self.b_send_paused = True
+
+    def cb_tcp_client_drain(self, cs_tcp_client_drain):
+        engine = cs_tcp_client_drain.engine
+        client_sid = cs_tcp_client_drain.client_sid
+        queued_bytes = cs_tcp_client_drain.queued_bytes
+
+        self.b_send_paused = False
+        if self.mv_file != None:
+            self.__queue_file_content()
 
     def cb_tcp_client_condrop(self, cs_tcp_client_condrop):
         engine = cs_tcp_client_condrop.engine
@@ -250,6 +314,8 @@ class CogNetwork:
         log('[tcp client condrop]')
 
         self.client_sid = None
+        self.read_job_h = None
+        self.mv_file = None
 
         self.__maybe_start_send()
 
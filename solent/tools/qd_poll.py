@@ -47,17 +47,11 @@ class CogUdpSender:
         self.engine = engine
         #
         self.pub_sid = None
-        self.t_last = None
-    def orb_turn(self, activity):
-        if self.pub_sid == None:
-            return
-        now = time.time()
-        if now - self.t_last > 2:
-            log('send!')
-            self.t_last = now
-            self.engine.send(
-                sid=self.pub_sid,
-                bb=bytes('message at [%s]\n'%now, 'utf8'))
+        self.timer_h = None
+    def orb_close(self):
+        if self.timer_h != None:
+            self.engine.close_timer(
+                timer_h=self.timer_h)
     #
     def on_init(self, addr, port):
         self.engine.open_pub(
@@ -65,8 +59,23 @@ class CogUdpSender:
             port=port,
             cb_pub_start=self.cb_pub_start,
             cb_pub_stop=self.cb_pub_stop)
-        self.t_last = 0
+        self.timer_h = self.engine.open_timer(
+            delay=2,
+            b_recurring=True,
+            cb_eng_timer=self.cb_eng_timer)
     #
+    def cb_eng_timer(self, cs_eng_timer):
+        engine = cs_eng_timer.engine
+        timer_h = cs_eng_timer.timer_h
+        at_t = cs_eng_timer.at_t
+        #
+        if self.pub_sid == None:
+            return
+        now = time.time()
+        log('send!')
+        self.engine.send(
+            sid=self.pub_sid,
+            bb=bytes('message at [%s]\n'%now, 'utf8'))
     def cb_pub_start(self, cs_pub_start):
         engine = cs_pub_start.engine
         pub_sid = cs_pub_start.pub_sid
@@ -20,6 +20,7 @@ from .rail_bytesetter import RailBytesetter
 from .rail_line_console import RailLineConsole
 from .rail_linetalk import RailLinetalk
 from .rail_wire_doc_unpack import RailWireDocUnpack
+from .spin_metrics_console import SpinMetricsConsole
 from .spin_selection_ui import SpinSelectionUi
 from .spin_rough_alarm import SpinRoughAlarm
 
@@ -91,9 +91,13 @@ class RailLineConsole:
         bb = bytes(
             source=msg,
             encoding='utf8')
-        self.engine.send(
-            sid=self.accept_sid,
-            bb=bb)
+        # The engine refuses sends larger than its mtu, and msg can be
+        # longer than that. (For example, a metrics dump.)
+        mtu = self.engine.get_mtu()
+        for offset in range(0, len(bb), mtu):
+            self.engine.send(
+                sid=self.accept_sid,
+                bb=bb[offset:offset+mtu])
     #
     def _boot_any_accept(self):
         if self.accept_sid != None:
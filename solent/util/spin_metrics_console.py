@@ -0,0 +1,85 @@
+# // license
+# Copyright 2016, Free Software Foundation.
+#
+# This file is part of Solent.
+#
+# Solent is free software: you can redistribute it and/or modify it under the
+# terms of the GNU Lesser General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option)
+# any later version.
+#
+# Solent is distributed in the hope that it will be useful, but WITHOUT ANY
+# WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE. See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along with
+# Solent. If not, see <http://www.gnu.org/licenses/>.
+#
+# // overview
+# Serves engine metrics over tcp. Telnet or netcat to the port, and type
+# 'metrics' (optionally followed by a name prefix, such as 'metrics sid.')
+# to get a text dump of the registry. See solent/eng/metrics.py.
+#
+# Creating this spin enables metrics on the engine.
+
+from .rail_line_console import RailLineConsole
+
+HELP = '''commands:
+  metrics [prefix]   dump metrics, or those whose names start with prefix
+  help               this message
+  quit               disconnect
+'''
+
+class SpinMetricsConsole:
+    def __init__(self, spin_h, engine):
+        self.spin_h = spin_h
+        self.engine = engine
+        #
+        self.metrics = engine.enable_metrics()
+        self.rail_line_console = RailLineConsole()
+        self.rail_line_console.zero(
+            rail_h='%s/line_console'%(spin_h),
+            cb_line_console_connect=self.cb_line_console_connect,
+            cb_line_console_condrop=self.cb_line_console_condrop,
+            cb_line_console_command=self.cb_line_console_command,
+            engine=engine)
+    def eng_turn(self, activity):
+        pass
+    def eng_close(self):
+        self.rail_line_console.eng_close()
+    #
+    def start(self, ip, port):
+        self.rail_line_console.start(
+            ip=ip,
+            port=port)
+    def stop(self):
+        self.rail_line_console.stop()
+    #
+    def cb_line_console_connect(self, cs_line_console_connect):
+        pass
+    def cb_line_console_condrop(self, cs_line_console_condrop):
+        pass
+    def cb_line_console_command(self, cs_line_console_command):
+        accept_sid = cs_line_console_command.accept_sid
+        tokens = cs_line_console_command.tokens
+        #
+        if not tokens:
+            return
+        cmd = tokens[0]
+        if cmd in ('metrics', 'm'):
+            prefix = ''
+            if len(tokens) > 1:
+                prefix = tokens[1]
+            self.rail_line_console.send(
+                msg=self.metrics.render_text(
+                    prefix=prefix))
+        elif cmd in ('help', '?'):
+            self.rail_line_console.send(
+                msg=HELP)
+        elif cmd in ('quit', 'q'):
+            self.engine.close_tcp_accept(
+                accept_sid=accept_sid)
+        else:
+            self.rail_line_console.send(
+                msg='error: unknown command %s\n'%(cmd))
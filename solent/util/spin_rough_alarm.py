@@ -27,47 +27,38 @@ class RailAlarmBooking:
         self.at_t = at_t
 
 class SpinRoughAlarm:
-    # In issues #119 and #121 we will be implementing various alarms in the
-    # engine. Here, I make no claim to do a good job of this. But I need an
-    # alarm
+    # Alarm bookings sit on top of the engine timers. This spin remains so
+    # that existing code can keep booking alarms at absolute times and
+    # receiving cs_alarm_event.
+    #
+    # The timers call us back directly, so we never need a turn. Taking a
+    # wakeup keeps us off the engine's polled list.
     def __init__(self, spin_h, engine):
         self.spin_h = spin_h
         self.engine = engine
         #
+        self.wakeup = None
+        #
         self.cs_alarm_event = Ns()
         #
         self.pool_alarm_booking = pool_rail_class(RailAlarmBooking)
-        self.work = []
-        self.buffer = []
+        # timer_h vs rail_alarm_booking
+        self.work = {}
     def call_alarm_event(self, cb_alarm_event, zero_h, value, at_t):
         self.cs_alarm_event.zero_h = zero_h
         self.cs_alarm_event.value = value
         self.cs_alarm_event.at_t = at_t
         cb_alarm_event(
             cs_alarm_event=self.cs_alarm_event)
+    def eng_bind_wakeup(self, wakeup):
+        self.wakeup = wakeup
     def eng_turn(self, activity):
-        now = self.engine.clock.now()
-        #
-        self.buffer.clear()
-        for (idx, rail_alarm_booking) in enumerate(self.work):
-            if rail_alarm_booking.at_t <= now:
-                self.buffer.append(idx)
-        #
-        idx_reduce = 0
-        for original_idx in self.buffer:
-            idx = original_idx - idx_reduce
-            idx_reduce += 1
-            #
-            rail_alarm_booking = self.work[idx]
-            self.call_alarm_event(
-                cb_alarm_event=rail_alarm_booking.cb_alarm_event,
-                zero_h=self.spin_h,
-                value=rail_alarm_booking.value,
-                at_t=rail_alarm_booking.at_t)
-            del self.work[idx]
-            self.pool_alarm_booking.put(rail_alarm_booking)
-    def eng_close(self):
         pass
+    def eng_close(self):
+        for timer_h in list(self.work.keys()):
+            self.engine.close_timer(
+                timer_h=timer_h)
+            self.pool_alarm_booking.put(self.work.pop(timer_h))
     def book_time(self, cb_alarm_event, value, at_t):
         rail_h = '%s/alarm_booking'%(self.spin_h)
         rail_alarm_booking = self.pool_alarm_booking.get(
@@ -75,5 +66,22 @@ class SpinRoughAlarm:
             cb_alarm_event=cb_alarm_event,
             value=value,
             at_t=at_t)
-        self.work.append(rail_alarm_booking)
-
+        delay = at_t - self.engine.clock.now()
+        if delay < 0:
+            delay = 0
+        timer_h = self.engine.open_timer(
+            delay=delay,
+            b_recurring=False,
+            cb_eng_timer=self.cb_eng_timer)
+        self.work[timer_h] = rail_alarm_booking
+    #
+    def cb_eng_timer(self, cs_eng_timer):
+        timer_h = cs_eng_timer.timer_h
+        #
+        rail_alarm_booking = self.work.pop(timer_h)
+        self.call_alarm_event(
+            cb_alarm_event=rail_alarm_booking.cb_alarm_event,
+            zero_h=self.spin_h,
+            value=rail_alarm_booking.value,
+            at_t=rail_alarm_booking.at_t)
+        self.pool_alarm_booking.put(rail_alarm_booking)
@@ -0,0 +1,111 @@
+#
+# liblog (testing)
+#
+# // license
+# Copyright 2016, Free Software Foundation.
+#
+# This file is part of Solent.
+#
+# Solent is free software: you can redistribute it and/or modify it under the
+# terms of the GNU Lesser General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option)
+# any later version.
+#
+# Solent is distributed in the hope that it will be useful, but WITHOUT ANY
+# WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE. See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along with
+# Solent. If not, see <http://www.gnu.org/licenses/>.
+
+
+from solent import run_tests
+from solent import test
+from solent.base import liblog
+from solent.base.liblog import NetLogger
+
+class SinkRecorder:
+    def __init__(self):
+        self.batches = []
+    def write_lines(self, lines):
+        self.batches.append(list(lines))
+
+class Unformattable:
+    def __str__(self):
+        raise Exception("should not have been formatted")
+
+def with_recorder(fn):
+    '''
+    Runs fn(recorder) with the logging globals pointed at a recorder, and
+    puts them back afterwards.
+    '''
+    saved = (liblog.LOGGER, liblog.LOG_LEVEL, liblog.LOG_RING, liblog.LOG_RING_USERS)
+    recorder = SinkRecorder()
+    liblog.LOGGER = recorder
+    liblog.LOG_RING = None
+    liblog.LOG_RING_USERS = 0
+    try:
+        fn(recorder)
+    finally:
+        (liblog.LOGGER, liblog.LOG_LEVEL, liblog.LOG_RING, liblog.LOG_RING_USERS) = saved
+
+@test
+def should_skip_formatting_below_the_log_level():
+    def fn(recorder):
+        liblog.set_log_level(liblog.LOG_WARN)
+        liblog.log('info %s', Unformattable())
+        liblog.log_debug('debug %s', Unformattable())
+        liblog.log_warn('warn %s', 1)
+        assert [['warn 1']] == recorder.batches
+    with_recorder(fn)
+    #
+    return True
+
+@test
+def should_batch_lines_through_the_ring():
+    def fn(recorder):
+        liblog.log_ring_on(
+            capacity=3)
+        for i in range(5):
+            liblog.log('line %s', i)
+        assert [] == recorder.batches
+        liblog.flush_log()
+        assert 1 == len(recorder.batches)
+        assert recorder.batches[0] == [
+            '[log ring dropped 2 lines]', 'line 2', 'line 3', 'line 4']
+        #
+        # Nothing to do on an empty ring.
+        liblog.flush_log()
+        assert 1 == len(recorder.batches)
+        #
+        # Once the ring is off, we write straight through.
+        liblog.log_ring_off()
+        liblog.log('direct')
+        assert ['direct'] == recorder.batches[-1]
+    with_recorder(fn)
+    #
+    return True
+
+@test
+def should_coalesce_net_log_lines_into_datagrams():
+    net_logger = NetLogger(
+        mtu=20,
+        addr='127.0.0.1',
+        port=5161,
+        label='t')
+    acc = []
+    net_logger._send = acc.append
+    net_logger.write_lines(['a', 'b', '', 'x'*30])
+    net_logger.sock.close()
+    #
+    # Short lines share a datagram. The long one is split at the mtu.
+    assert acc[0] == b'[t] a\n[t] b\n[t] \n'
+    assert acc[1] == bytes('[t] %s\n'%('x'*20), 'utf8')
+    assert acc[2] == bytes('[t] %s\n'%('x'*10), 'utf8')
+    assert 3 == len(acc)
+    #
+    return True
+
+if __name__ == '__main__':
+    run_tests()
@@ -0,0 +1,62 @@
+#
+# bench (testing)
+#
+# // license
+# Copyright 2016, Free Software Foundation.
+#
+# This file is part of Solent.
+#
+# Solent is free software: you can redistribute it and/or modify it under the
+# terms of the GNU Lesser General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option)
+# any later version.
+#
+# Solent is distributed in the hope that it will be useful, but WITHOUT ANY
+# WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE. See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along with
+# Solent. If not, see <http://www.gnu.org/licenses/>.
+
+
+from solent import run_tests
+from solent import test
+from solent.bench import compare_results
+from solent.bench import run_benchmarks
+from solent.bench.scenarios import percentiles
+
+@test
+def should_compute_nearest_rank_percentiles():
+    d = percentiles(list(range(1, 101)))
+    assert d['count'] == 100
+    assert d['min'] == 1
+    assert d['p50'] == 50
+    assert d['p99'] == 99
+    assert d['max'] == 100
+    assert {'count': 0} == percentiles([])
+    #
+    return True
+
+@test
+def should_run_a_short_benchmark_and_compare_it():
+    result = run_benchmarks(
+        names=['tcp_echo_latency'],
+        duration=0.2,
+        base_port=5350)
+    d = result['results']['tcp_echo_latency']
+    assert d['rtt_us']['count'] > 0
+    assert d['rtt_us']['p50'] <= d['rtt_us']['p99']
+    #
+    rows = compare_results(
+        baseline=result,
+        current=result)
+    names = [row[0] for row in rows]
+    assert 'tcp_echo_latency.rtt_us.p99' in names
+    for (name, base_value, curr_value, change) in rows:
+        assert change in (None, 0.0)
+    #
+    return True
+
+if __name__ == '__main__':
+    run_tests()
@@ -0,0 +1,960 @@
+#
+# engine (testing)
+#
+# // license
+# Copyright 2016, Free Software Foundation.
+#
+# This file is part of Solent.
+#
+# Solent is free software: you can redistribute it and/or modify it under the
+# terms of the GNU Lesser General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option)
+# any later version.
+#
+# Solent is distributed in the hope that it will be useful, but WITHOUT ANY
+# WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE. See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along with
+# Solent. If not, see <http://www.gnu.org/licenses/>.
+
+from fake import FakeClock
+
+from solent import Engine
+from solent import run_tests
+from solent import test
+from solent.eng.selector import SELECTOR_READ
+from solent.eng.selector import SELECTOR_WRITE
+
+import os
+import socket
+import struct
+import tempfile
+import time
+
+MTU = 1500
+
+class Receiver:
+    def __init__(self):
+        self.acc = []
+    def cb_eng_timer(self, cs_eng_timer):
+        engine = cs_eng_timer.engine
+        timer_h = cs_eng_timer.timer_h
+        at_t = cs_eng_timer.at_t
+        #
+        self.acc.append( (timer_h, at_t) )
+
+def create_engine_with_fake_clock():
+    engine = Engine(
+        mtu=MTU)
+    engine.clock = FakeClock()
+    return engine
+
+@test
+def should_fire_timers_in_deadline_order():
+    engine = create_engine_with_fake_clock()
+    receiver = Receiver()
+    #
+    late_h = engine.open_timer(
+        delay=5,
+        b_recurring=False,
+        cb_eng_timer=receiver.cb_eng_timer)
+    early_h = engine.open_timer(
+        delay=2,
+        b_recurring=False,
+        cb_eng_timer=receiver.cb_eng_timer)
+    #
+    engine.clock.set(1)
+    engine.turn()
+    assert receiver.acc == []
+    #
+    engine.clock.set(10)
+    engine.turn()
+    assert receiver.acc == [(early_h, 2), (late_h, 5)]
+    #
+    # Nothing is left scheduled.
+    engine.clock.set(20)
+    engine.turn()
+    assert 2 == len(receiver.acc)
+    #
+    return True
+
+@test
+def should_repeat_recurring_timers_until_closed():
+    engine = create_engine_with_fake_clock()
+    receiver = Receiver()
+    #
+    timer_h = engine.open_timer(
+        delay=3,
+        b_recurring=True,
+        cb_eng_timer=receiver.cb_eng_timer)
+    for t in range(1, 10):
+        engine.clock.set(t)
+        engine.turn()
+    assert receiver.acc == [(timer_h, 3), (timer_h, 6), (timer_h, 9)]
+    #
+    engine.close_timer(
+        timer_h=timer_h)
+    engine.clock.set(30)
+    engine.turn()
+    assert 3 == len(receiver.acc)
+    #
+    return True
+
+@test
+def should_bound_select_timeout_by_next_timer():
+    engine = create_engine_with_fake_clock()
+    receiver = Receiver()
+    engine.set_default_timeout(0.2)
+    #
+    engine.open_timer(
+        delay=0.05,
+        b_recurring=False,
+        cb_eng_timer=receiver.cb_eng_timer)
+    assert 0.05 == engine._bound_timeout_by_timers(0.2)
+    #
+    return True
+
+@test
+def should_return_from_turn_once_the_next_timer_is_due():
+    engine = Engine(
+        mtu=MTU)
+    receiver = Receiver()
+    # Something for the selector to wait on, which never becomes readable.
+    (rfd, wfd) = os.pipe()
+    def cb_eng_custom_fd_read(cs_eng_custom_fd_read):
+        pass
+    engine.add_custom_fd_read(
+        cfd_h='pipe',
+        fd=rfd,
+        cb_eng_custom_fd_read=cb_eng_custom_fd_read)
+    try:
+        timer_h = engine.open_timer(
+            delay=0.05,
+            b_recurring=False,
+            cb_eng_timer=receiver.cb_eng_timer)
+        t_start = time.time()
+        engine.turn(
+            timeout=5)
+        assert time.time() - t_start < 1
+        assert time.time() >= engine.d_timer[timer_h].at_t
+        # The timer fires at the start of the next turn.
+        engine.turn(
+            timeout=0)
+        assert [timer_h] == [h for (h, at_t) in receiver.acc]
+    finally:
+        engine.remove_custom_fd_read(
+            fd=rfd)
+        os.close(rfd)
+        os.close(wfd)
+    #
+    engine.close()
+    return True
+
+I_NEARCAST = '''
+    i message h
+    i field h
+
+    message poke
+'''
+
+class SpinCounter:
+    def __init__(self, spin_h, engine):
+        self.spin_h = spin_h
+        self.engine = engine
+        #
+        self.turns = 0
+    def eng_turn(self, activity):
+        self.turns += 1
+    def eng_close(self):
+        pass
+
+class SpinWakeupCounter(SpinCounter):
+    def eng_bind_wakeup(self, wakeup):
+        self.wakeup = wakeup
+
+class CogWakeupCounter:
+    def __init__(self, cog_h, orb, engine):
+        self.cog_h = cog_h
+        self.orb = orb
+        self.engine = engine
+        #
+        self.turns = 0
+    def orb_bind_wakeup(self, wakeup):
+        self.wakeup = wakeup
+    def orb_turn(self, activity):
+        self.turns += 1
+    def on_poke(self):
+        self.wakeup.wake()
+
+@test
+def should_poll_legacy_spins_and_wake_others_on_demand():
+    engine = create_engine_with_fake_clock()
+    spin_legacy = engine.init_spin(
+        construct=SpinCounter)
+    spin_wakeup = engine.init_spin(
+        construct=SpinWakeupCounter)
+    #
+    for i in range(3):
+        engine.turn()
+    assert 3 == spin_legacy.turns
+    # one free turn on being added, then nothing
+    assert 1 == spin_wakeup.turns
+    #
+    spin_wakeup.wakeup.wake()
+    spin_wakeup.wakeup.wake()
+    engine.turn()
+    engine.turn()
+    assert 5 == spin_legacy.turns
+    assert 2 == spin_wakeup.turns
+    #
+    return True
+
+@test
+def should_turn_wakeup_cogs_only_when_woken():
+    engine = create_engine_with_fake_clock()
+    orb = engine.init_orb(
+        i_nearcast=I_NEARCAST)
+    cog = orb.init_cog(
+        construct=CogWakeupCounter)
+    bridge = orb.init_autobridge()
+    #
+    for i in range(3):
+        engine.turn()
+    assert 1 == cog.turns
+    assert [] == engine.runnable_spins
+    assert [] == engine.polled_spins
+    #
+    # The nearcast wakes the orb, and the cog wakes itself in response.
+    bridge.nc_poke()
+    engine.cycle()
+    assert 2 == cog.turns
+    #
+    return True
+
+class BackpressureReceiver:
+    def __init__(self):
+        self.client_sid = None
+        self.acc_recv = 0
+        self.acc_pressure = []
+        self.acc_drain = []
+    def cb_tcp_server_start(self, cs_tcp_server_start):
+        pass
+    def cb_tcp_server_stop(self, cs_tcp_server_stop):
+        pass
+    def cb_tcp_accept_connect(self, cs_tcp_accept_connect):
+        pass
+    def cb_tcp_accept_condrop(self, cs_tcp_accept_condrop):
+        pass
+    def cb_tcp_accept_recv(self, cs_tcp_accept_recv):
+        self.acc_recv += len(cs_tcp_accept_recv.bb)
+    def cb_tcp_client_connect(self, cs_tcp_client_connect):
+        self.client_sid = cs_tcp_client_connect.client_sid
+    def cb_tcp_client_condrop(self, cs_tcp_client_condrop):
+        pass
+    def cb_tcp_client_recv(self, cs_tcp_client_recv):
+        pass
+    def cb_tcp_client_pressure(self, cs_tcp_client_pressure):
+        self.acc_pressure.append(cs_tcp_client_pressure.queued_bytes)
+    def cb_tcp_client_drain(self, cs_tcp_client_drain):
+        self.acc_drain.append(cs_tcp_client_drain.queued_bytes)
+
+@test
+def should_signal_pressure_and_drain_around_watermarks():
+    engine = Engine(
+        mtu=MTU)
+    receiver = BackpressureReceiver()
+    engine.open_tcp_server(
+        addr='127.0.0.1',
+        port=5139,
+        cb_tcp_server_start=receiver.cb_tcp_server_start,
+        cb_tcp_server_stop=receiver.cb_tcp_server_stop,
+        cb_tcp_accept_connect=receiver.cb_tcp_accept_connect,
+        cb_tcp_accept_condrop=receiver.cb_tcp_accept_condrop,
+        cb_tcp_accept_recv=receiver.cb_tcp_accept_recv)
+    engine.open_tcp_client(
+        addr='127.0.0.1',
+        port=5139,
+        cb_tcp_client_connect=receiver.cb_tcp_client_connect,
+        cb_tcp_client_condrop=receiver.cb_tcp_client_condrop,
+        cb_tcp_client_recv=receiver.cb_tcp_client_recv,
+        cb_tcp_client_pressure=receiver.cb_tcp_client_pressure,
+        cb_tcp_client_drain=receiver.cb_tcp_client_drain)
+    for i in range(20):
+        engine.turn(0.05)
+        if receiver.client_sid != None:
+            break
+    client_sid = receiver.client_sid
+    assert client_sid != None
+    engine.set_send_watermarks(
+        sid=client_sid,
+        high=6000,
+        low=2000)
+    #
+    # Pressure fires as soon as the queue passes the high watermark, and
+    # only once.
+    for i in range(10):
+        engine.send(
+            sid=client_sid,
+            bb=bytes(1000))
+    assert [7000] == receiver.acc_pressure
+    assert 10000 == engine.get_send_queue_depth(client_sid)
+    assert 10000 == engine.get_send_queue_bytes()
+    #
+    for i in range(40):
+        engine.turn(0.05)
+        if receiver.acc_recv == 10000:
+            break
+    assert 10000 == receiver.acc_recv
+    assert 1 == len(receiver.acc_drain)
+    assert receiver.acc_drain[0] <= 2000
+    assert 0 == engine.get_send_queue_bytes()
+    #
+    engine.close()
+    return True
+
+@test
+def should_deliver_sub_datagrams_in_batches():
+    engine = Engine(
+        mtu=MTU)
+    acc = []
+    batch_sizes = []
+    def cb_sub_recv_batch(cs_sub_recv_batch):
+        entries = cs_sub_recv_batch.entries
+        #
+        batch_sizes.append(len(entries))
+        for (view, addr) in entries:
+            acc.append(bytes(view))
+    def noop(**kwargs):
+        pass
+    engine.open_sub(
+        addr='127.0.0.1',
+        port=5144,
+        cb_sub_start=noop,
+        cb_sub_stop=noop,
+        cb_sub_recv=None,
+        cb_sub_recv_batch=cb_sub_recv_batch)
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    expect = [b'', b'abc', bytes(1400)] + [str(i).encode() for i in range(20)]
+    for bb in expect:
+        sock.sendto(bb, ('127.0.0.1', 5144))
+    for i in range(20):
+        engine.turn(0.05)
+        if len(acc) == len(expect):
+            break
+    #
+    # Everything arrives in order. The empty datagram is a message, and
+    # does not close the sub.
+    assert expect == acc
+    assert len(batch_sizes) < len(expect)
+    sock.sendto(b'after', ('127.0.0.1', 5144))
+    for i in range(20):
+        engine.turn(0.05)
+        if acc[-1] == b'after':
+            break
+    assert b'after' == acc[-1]
+    #
+    sock.close()
+    engine.close()
+    return True
+
+@test
+def should_send_one_payload_to_every_fanout_destination():
+    engine = Engine(
+        mtu=MTU)
+    # port vs payloads received
+    d_acc = {}
+    def noop(**kwargs):
+        pass
+    for port in (5145, 5146, 5147):
+        d_acc[port] = []
+        def cb_sub_recv(cs_sub_recv, port=port):
+            d_acc[port].append(bytes(cs_sub_recv.bb))
+        engine.open_sub(
+            addr='127.0.0.1',
+            port=port,
+            cb_sub_start=noop,
+            cb_sub_stop=noop,
+            cb_sub_recv=cb_sub_recv)
+    pub_sid = engine.open_pub_fanout(
+        dests=[('127.0.0.1', 5145), ('localhost', 5146)],
+        cb_pub_start=noop,
+        cb_pub_stop=noop)
+    engine.add_pub_dest(
+        pub_sid=pub_sid,
+        addr='127.0.0.1',
+        port=5147)
+    for i in range(50):
+        engine.send(
+            sid=pub_sid,
+            bb=str(i).encode())
+    #
+    # Each payload is queued once, however many destinations there are.
+    assert sum(len(str(i)) for i in range(50)) == engine.get_send_queue_depth(pub_sid)
+    expect = [str(i).encode() for i in range(50)]
+    for i in range(20):
+        engine.turn(0.05)
+        if all(len(acc) == 50 for acc in d_acc.values()):
+            break
+    for acc in d_acc.values():
+        assert expect == acc
+    #
+    engine.remove_pub_dest(
+        pub_sid=pub_sid,
+        addr='localhost',
+        port=5146)
+    assert [('127.0.0.1', 5145), ('127.0.0.1', 5147)] == engine.get_pub_dests(pub_sid)
+    engine.send(
+        sid=pub_sid,
+        bb=b'last')
+    for i in range(20):
+        engine.turn(0.05)
+        if d_acc[5145][-1] == b'last' and d_acc[5147][-1] == b'last':
+            break
+    assert b'last' == d_acc[5145][-1]
+    assert b'last' == d_acc[5147][-1]
+    assert 50 == len(d_acc[5146])
+    #
+    engine.close()
+    return True
+
+@test
+def should_copy_multicast_datagrams_to_every_member():
+    engine = Engine(
+        mtu=MTU)
+    acc_a = []
+    acc_b = []
+    def noop(**kwargs):
+        pass
+    for acc in (acc_a, acc_b):
+        def cb_sub_recv(cs_sub_recv, acc=acc):
+            acc.append(bytes(cs_sub_recv.bb))
+        engine.open_mcast_sub(
+            addr='239.255.51.49',
+            port=5148,
+            cb_sub_start=noop,
+            cb_sub_stop=noop,
+            cb_sub_recv=cb_sub_recv,
+            iface='127.0.0.1')
+    pub_sid = engine.open_mcast_pub(
+        addr='239.255.51.49',
+        port=5148,
+        cb_pub_start=noop,
+        cb_pub_stop=noop,
+        iface='127.0.0.1')
+    for i in range(10):
+        engine.send(
+            sid=pub_sid,
+            bb=str(i).encode())
+    expect = [str(i).encode() for i in range(10)]
+    for i in range(20):
+        engine.turn(0.05)
+        if len(acc_a) == 10 and len(acc_b) == 10:
+            break
+    assert expect == acc_a
+    assert expect == acc_b
+    #
+    try:
+        engine.open_mcast_pub(
+            addr='127.0.0.1',
+            port=5148,
+            cb_pub_start=noop,
+            cb_pub_stop=noop)
+        assert False, "should have refused a unicast address"
+    except Exception as e:
+        assert 'multicast' in str(e)
+    #
+    engine.close()
+    return True
+
+class UnixEcho:
+    def __init__(self, engine):
+        self.engine = engine
+        #
+        self.client_sid = None
+        self.acc_client = []
+        self.acc_condrop = []
+    def cb_tcp_server_start(self, cs_tcp_server_start):
+        pass
+    def cb_tcp_server_stop(self, cs_tcp_server_stop):
+        pass
+    def cb_tcp_accept_connect(self, cs_tcp_accept_connect):
+        pass
+    def cb_tcp_accept_condrop(self, cs_tcp_accept_condrop):
+        pass
+    def cb_tcp_accept_recv(self, cs_tcp_accept_recv):
+        self.engine.send(
+            sid=cs_tcp_accept_recv.accept_sid,
+            bb=cs_tcp_accept_recv.bb)
+    def cb_tcp_client_connect(self, cs_tcp_client_connect):
+        self.client_sid = cs_tcp_client_connect.client_sid
+    def cb_tcp_client_condrop(self, cs_tcp_client_condrop):
+        self.acc_condrop.append(cs_tcp_client_condrop.message)
+    def cb_tcp_client_recv(self, cs_tcp_client_recv):
+        self.acc_client.append(bytes(cs_tcp_client_recv.bb))
+
+@test
+def should_carry_streams_and_datagrams_over_unix_sockets():
+    engine = Engine(
+        mtu=MTU)
+    tmp_dir = tempfile.mkdtemp()
+    stream_path = os.path.join(tmp_dir, 'stream.sock')
+    dgram_path = os.path.join(tmp_dir, 'dgram.sock')
+    echo = UnixEcho(
+        engine=engine)
+    server_sid = engine.open_unix_server(
+        path=stream_path,
+        cb_tcp_server_start=echo.cb_tcp_server_start,
+        cb_tcp_server_stop=echo.cb_tcp_server_stop,
+        cb_tcp_accept_connect=echo.cb_tcp_accept_connect,
+        cb_tcp_accept_condrop=echo.cb_tcp_accept_condrop,
+        cb_tcp_accept_recv=echo.cb_tcp_accept_recv)
+    engine.open_unix_client(
+        path=stream_path,
+        cb_tcp_client_connect=echo.cb_tcp_client_connect,
+        cb_tcp_client_condrop=echo.cb_tcp_client_condrop,
+        cb_tcp_client_recv=echo.cb_tcp_client_recv)
+    for i in range(20):
+        engine.turn(0.05)
+        if echo.client_sid != None:
+            break
+    assert echo.client_sid != None
+    engine.send(
+        sid=echo.client_sid,
+        bb=b'hello')
+    for i in range(20):
+        engine.turn(0.05)
+        if b''.join(echo.acc_client) == b'hello':
+            break
+    assert b'hello' == b''.join(echo.acc_client)
+    #
+    # Connecting to nothing gives us a condrop, as tcp would.
+    engine.open_unix_client(
+        path=os.path.join(tmp_dir, 'absent.sock'),
+        cb_tcp_client_connect=echo.cb_tcp_client_connect,
+        cb_tcp_client_condrop=echo.cb_tcp_client_condrop,
+        cb_tcp_client_recv=echo.cb_tcp_client_recv)
+    for i in range(20):
+        engine.turn(0.05)
+        if echo.acc_condrop:
+            break
+    assert 1 == len(echo.acc_condrop)
+    #
+    acc_sub = []
+    def cb_sub_recv(cs_sub_recv):
+        acc_sub.append(bytes(cs_sub_recv.bb))
+    def noop(**kwargs):
+        pass
+    engine.open_unix_sub(
+        path=dgram_path,
+        cb_sub_start=noop,
+        cb_sub_stop=noop,
+        cb_sub_recv=cb_sub_recv)
+    pub_sid = engine.open_unix_pub(
+        path=dgram_path,
+        cb_pub_start=noop,
+        cb_pub_stop=noop)
+    for i in range(5):
+        engine.send(
+            sid=pub_sid,
+            bb=str(i).encode())
+    for i in range(20):
+        engine.turn(0.05)
+        if len(acc_sub) == 5:
+            break
+    assert [str(i).encode() for i in range(5)] == acc_sub
+    #
+    # Closing removes the socket files.
+    engine.close_tcp_server(
+        server_sid=server_sid)
+    assert not os.path.exists(stream_path)
+    engine.close()
+    assert not os.path.exists(dgram_path)
+    os.rmdir(tmp_dir)
+    return True
+
+class StreamRecorder:
+    '''
+    Sits on both ends of a loopback tcp connection, and records what arrives
+    on each.
+    '''
+    def __init__(self, engine):
+        self.engine = engine
+        #
+        self.client_sid = None
+        self.accept_sids = []
+        self.acc_accept = bytearray()
+        self.acc_client = bytearray()
+        self.accept_recv_count = 0
+    def cb_tcp_server_start(self, cs_tcp_server_start):
+        pass
+    def cb_tcp_server_stop(self, cs_tcp_server_stop):
+        pass
+    def cb_tcp_accept_connect(self, cs_tcp_accept_connect):
+        self.accept_sids.append(cs_tcp_accept_connect.accept_sid)
+    def cb_tcp_accept_condrop(self, cs_tcp_accept_condrop):
+        pass
+    def cb_tcp_accept_recv(self, cs_tcp_accept_recv):
+        self.accept_recv_count += 1
+        self.acc_accept.extend(cs_tcp_accept_recv.bb)
+    def cb_tcp_client_connect(self, cs_tcp_client_connect):
+        self.client_sid = cs_tcp_client_connect.client_sid
+    def cb_tcp_client_condrop(self, cs_tcp_client_condrop):
+        pass
+    def cb_tcp_client_recv(self, cs_tcp_client_recv):
+        self.acc_client.extend(cs_tcp_client_recv.bb)
+    def open_server(self, port, backlog=socket.SOMAXCONN):
+        return self.engine.open_tcp_server(
+            addr='127.0.0.1',
+            port=port,
+            cb_tcp_server_start=self.cb_tcp_server_start,
+            cb_tcp_server_stop=self.cb_tcp_server_stop,
+            cb_tcp_accept_connect=self.cb_tcp_accept_connect,
+            cb_tcp_accept_condrop=self.cb_tcp_accept_condrop,
+            cb_tcp_accept_recv=self.cb_tcp_accept_recv,
+            backlog=backlog)
+    def open_client(self, port):
+        return self.engine.open_tcp_client(
+            addr='127.0.0.1',
+            port=port,
+            cb_tcp_client_connect=self.cb_tcp_client_connect,
+            cb_tcp_client_condrop=self.cb_tcp_client_condrop,
+            cb_tcp_client_recv=self.cb_tcp_client_recv)
+    def connect(self, port):
+        '''
+        Opens a server and a client to it, and turns the engine until both
+        ends are up.
+        '''
+        self.open_server(port)
+        self.open_client(port)
+        for i in range(40):
+            self.engine.turn(0.05)
+            if self.client_sid != None and self.accept_sids:
+                break
+        assert self.client_sid != None
+        assert 1 == len(self.accept_sids)
+
+def make_payload(i):
+    '''
+    A payload that says where it sits in the stream. The lengths vary, so
+    that the kernel is unlikely to stop on a buffer boundary.
+    '''
+    size = 1000 + (i * 37) % 400
+    stamp = b'%08d;'%(i)
+    return (stamp * (size // len(stamp) + 1))[:size]
+
+@test
+def should_send_a_stream_intact_through_partial_sends():
+    engine = Engine(
+        mtu=MTU)
+    recorder = StreamRecorder(
+        engine=engine)
+    recorder.connect(5153)
+    client_sid = recorder.client_sid
+    ms = engine._get_ms_for_sid(client_sid)
+    # A small kernel buffer means that each sendmsg is offered more than it
+    # can take.
+    ms.sock.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, 4096)
+    #
+    payloads = [make_payload(i) for i in range(1500)]
+    expected = b''.join(payloads)
+    for bb in payloads:
+        engine.send(
+            sid=client_sid,
+            bb=bb)
+    assert len(expected) == engine.get_send_queue_bytes()
+    #
+    b_partial = False
+    for i in range(400):
+        engine.turn(0.05)
+        if ms.send_offset != 0:
+            b_partial = True
+        if len(recorder.acc_accept) >= len(expected):
+            break
+    assert b_partial
+    assert expected == bytes(recorder.acc_accept)
+    # Each call carried several buffers.
+    assert ms.count_send_calls < len(payloads)
+    assert 0 == engine.get_send_queue_bytes()
+    assert 0 == engine.get_send_queue_depth(client_sid)
+    #
+    engine.close()
+    return True
+
+def connect_raw_client(engine, recorder, port):
+    '''
+    Connects a plain socket to the recorder's server, and turns the engine
+    until it has accepted it. Returns the socket.
+    '''
+    count = len(recorder.accept_sids)
+    sock = socket.create_connection(('127.0.0.1', port))
+    for i in range(40):
+        engine.turn(0.05)
+        if len(recorder.accept_sids) > count:
+            break
+    assert count + 1 == len(recorder.accept_sids)
+    return sock
+
+@test
+def should_drain_a_readable_socket_within_the_read_budget():
+    engine = Engine(
+        mtu=MTU)
+    engine.set_recv_size(1000)
+    recorder = StreamRecorder(
+        engine=engine)
+    recorder.open_server(5154)
+    sock = connect_raw_client(engine, recorder, 5154)
+    try:
+        # With room in the budget, one turn reads until the socket is dry.
+        engine.set_read_budget(
+            max_bytes=1000000,
+            max_reads=1000)
+        sock.sendall(bytes(20000))
+        engine.turn(0.5)
+        assert 20 == recorder.accept_recv_count
+        assert 20000 == len(recorder.acc_accept)
+        #
+        # The read limit caps a turn.
+        engine.set_read_budget(
+            max_bytes=1000000,
+            max_reads=3)
+        sock.sendall(bytes(20000))
+        engine.turn(0.5)
+        assert 23 == recorder.accept_recv_count
+        engine.turn(0.5)
+        assert 26 == recorder.accept_recv_count
+        #
+        # So does the byte limit. We stop once a read takes us past it.
+        engine.set_read_budget(
+            max_bytes=2500,
+            max_reads=1000)
+        engine.turn(0.5)
+        assert 29 == recorder.accept_recv_count
+        #
+        # What is left waits for later turns.
+        for i in range(20):
+            engine.turn(0.05)
+        assert 40 == recorder.accept_recv_count
+        assert 40000 == len(recorder.acc_accept)
+    finally:
+        sock.close()
+    #
+    engine.close()
+    return True
+
+def get_listen_queue(sock):
+    '''
+    On linux, tcp_info for a listening socket carries the length of its
+    accept queue in tcpi_unacked, and its backlog in tcpi_sacked. Returns
+    (queued, backlog), or None where we cannot tell.
+    '''
+    if not hasattr(socket, 'TCP_INFO'):
+        return None
+    info = sock.getsockopt(socket.IPPROTO_TCP, socket.TCP_INFO, 32)
+    return struct.unpack_from('II', info, 24)
+
+@test
+def should_accept_pending_connections_within_the_accept_budget():
+    engine = Engine(
+        mtu=MTU)
+    engine.set_accept_budget(3)
+    recorder = StreamRecorder(
+        engine=engine)
+    server_sid = recorder.open_server(
+        port=5155,
+        backlog=16)
+    server_sock = engine._get_ms_for_sid(server_sid).sock
+    #
+    # Every client is waiting in the backlog before the engine gets a turn.
+    socks = [socket.create_connection(('127.0.0.1', 5155)) for i in range(10)]
+    try:
+        queue = get_listen_queue(server_sock)
+        if queue != None:
+            assert (10, 16) == queue
+        counts = []
+        for i in range(20):
+            before = len(recorder.accept_sids)
+            engine.turn(0.05)
+            counts.append(len(recorder.accept_sids) - before)
+            if len(recorder.accept_sids) == 10:
+                break
+        assert 3 == counts[0]
+        assert 3 >= max(counts)
+        assert 10 == len(set(recorder.accept_sids))
+        if queue != None:
+            assert (0, 16) == get_listen_queue(server_sock)
+    finally:
+        for sock in socks:
+            sock.close()
+    #
+    engine.close()
+    return True
+
+@test
+def should_send_copies_sips_and_owned_buffers_intact():
+    engine = Engine(
+        mtu=MTU)
+    recorder = StreamRecorder(
+        engine=engine)
+    recorder.connect(5156)
+    client_sid = recorder.client_sid
+    ms = engine._get_ms_for_sid(client_sid)
+    mempool = engine.mempool
+    outstanding = mempool.ltotal
+    #
+    # send copies, so the caller can reuse its buffer straight away.
+    bb = bytearray(make_payload(0))
+    engine.send(
+        sid=client_sid,
+        bb=bb)
+    bb[:] = bytes(len(bb))
+    assert outstanding + 1 == mempool.ltotal
+    #
+    # send_sip queues the sip itself.
+    sip = mempool.alloc(
+        size=1200)
+    sip.arr[:] = make_payload(1)[:1200]
+    engine.send_sip(
+        sid=client_sid,
+        sip=sip)
+    assert sip.arr is ms.send_buf[-1]
+    assert outstanding + 2 == mempool.ltotal
+    #
+    # send_owned queues the caller's buffer, and takes nothing from the pool.
+    owned = make_payload(2)
+    engine.send_owned(
+        sid=client_sid,
+        bb=owned)
+    assert owned is ms.send_buf[-1]
+    view = memoryview(make_payload(3))
+    engine.send_owned(
+        sid=client_sid,
+        bb=view)
+    assert outstanding + 2 == mempool.ltotal
+    #
+    expected = make_payload(0) + make_payload(1)[:1200] + owned + bytes(view)
+    for i in range(40):
+        engine.turn(0.05)
+        if len(recorder.acc_accept) >= len(expected):
+            break
+    assert expected == bytes(recorder.acc_accept)
+    assert outstanding == mempool.ltotal
+    assert 0 == engine.get_send_queue_bytes()
+    #
+    engine.close()
+    return True
+
+class ViewRecorder(StreamRecorder):
+    '''
+    Keeps each view that it is given. Retains the sip behind the first.
+    '''
+    def __init__(self, engine):
+        StreamRecorder.__init__(self, engine)
+        self.views = []
+        self.retained_sip = None
+    def cb_tcp_accept_recv(self, cs_tcp_accept_recv):
+        bb = cs_tcp_accept_recv.bb
+        self.views.append(bb)
+        if self.retained_sip == None:
+            self.retained_sip = self.engine.retain_recv(
+                sid=cs_tcp_accept_recv.accept_sid)
+        StreamRecorder.cb_tcp_accept_recv(self, cs_tcp_accept_recv)
+
+@test
+def should_recv_into_views_and_let_the_consumer_retain_them():
+    engine = Engine(
+        mtu=MTU)
+    recorder = ViewRecorder(
+        engine=engine)
+    recorder.open_server(5157)
+    sock = connect_raw_client(engine, recorder, 5157)
+    try:
+        accept_sid = recorder.accept_sids[0]
+        engine.recv_view_on(
+            sid=accept_sid)
+        ms = engine._get_ms_for_sid(accept_sid)
+        #
+        sock.sendall(b'first')
+        for i in range(20):
+            engine.turn(0.05)
+            if recorder.views:
+                break
+        sip = recorder.retained_sip
+        assert sip != None
+        assert memoryview == type(recorder.views[0])
+        assert sip is not ms.recv_sip
+        #
+        sock.sendall(b'second')
+        for i in range(20):
+            engine.turn(0.05)
+            if 2 == len(recorder.views):
+                break
+        assert b'firstsecond' == bytes(recorder.acc_accept)
+        # The second read went into a fresh sip, so the retained one still
+        # has the first message.
+        assert ms.recv_sip not in (None, sip)
+        assert b'first' == bytes(sip.arr[:5])
+        assert b'first' == bytes(recorder.views[0])
+        # The view that was not retained has been released.
+        try:
+            bytes(recorder.views[1])
+            raise Exception("should have released the view")
+        except ValueError as e:
+            assert 'released' in str(e)
+        #
+        # retain is only valid within the callback.
+        try:
+            engine.retain_recv(
+                sid=accept_sid)
+            raise Exception("should have refused the retain")
+        except Exception as e:
+            assert 'retain is only valid' in str(e)
+        engine.mempool.free(
+            sip=sip)
+    finally:
+        sock.close()
+    #
+    engine.close()
+    return True
+
+@test
+def should_keep_the_selector_in_step_with_socket_interest():
+    engine = Engine(
+        mtu=MTU)
+    recorder = StreamRecorder(
+        engine=engine)
+    recorder.open_server(5158)
+    client_sid = recorder.open_client(5158)
+    ms = engine._get_ms_for_sid(client_sid)
+    d_mask = engine.selector.d_mask
+    #
+    # While it connects, a tcp client waits to be writable.
+    assert SELECTOR_WRITE == d_mask[ms.fd]
+    for i in range(40):
+        engine.turn(0.05)
+        if recorder.client_sid != None:
+            break
+    assert client_sid == recorder.client_sid
+    assert SELECTOR_READ == d_mask[ms.fd]
+    #
+    # It wants to write only while it has something queued.
+    engine.send(
+        sid=client_sid,
+        bb=b'hello')
+    assert SELECTOR_READ|SELECTOR_WRITE == d_mask[ms.fd]
+    for i in range(40):
+        engine.turn(0.05)
+        if b'hello' == bytes(recorder.acc_accept):
+            break
+    assert b'hello' == bytes(recorder.acc_accept)
+    assert SELECTOR_READ == d_mask[ms.fd]
+    #
+    accept_ms = engine._get_ms_for_sid(recorder.accept_sids[0])
+    assert SELECTOR_READ == d_mask[accept_ms.fd]
+    #
+    engine.close()
+    return True
+
+if __name__ == '__main__':
+    run_tests()
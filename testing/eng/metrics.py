@@ -0,0 +1,132 @@
+#
+# metrics (testing)
+#
+# // license
+# Copyright 2016, Free Software Foundation.
+#
+# This file is part of Solent.
+#
+# Solent is free software: you can redistribute it and/or modify it under the
+# terms of the GNU Lesser General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option)
+# any later version.
+#
+# Solent is distributed in the hope that it will be useful, but WITHOUT ANY
+# WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE. See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along with
+# Solent. If not, see <http://www.gnu.org/licenses/>.
+
+
+from solent import Engine
+from solent import run_tests
+from solent import test
+from solent.eng.metrics import Metrics
+from solent.util import SpinMetricsConsole
+
+MTU = 1500
+
+@test
+def should_bucket_histogram_values():
+    metrics = Metrics()
+    histogram = metrics.histogram('h')
+    for i in range(99):
+        histogram.record(0.000010)
+    histogram.record(0.5)
+    #
+    # 10us falls in the bucket that tops out at 16us.
+    assert histogram.percentile(50) == 0.000016
+    assert histogram.percentile(100) == 0.5
+    d = metrics.snapshot()
+    assert d['h.count'] == 100
+    assert d['h.max'] == 0.5
+    #
+    return True
+
+@test
+def should_report_engine_and_sid_metrics():
+    engine = Engine(
+        mtu=MTU)
+    metrics = engine.enable_metrics()
+    assert metrics is engine.enable_metrics()
+    counter = metrics.counter('app.pokes')
+    counter.inc(3)
+    #
+    sub_sid = engine.open_sub(
+        addr='127.0.0.1',
+        port=5143,
+        cb_sub_start=lambda cs_sub_start: None,
+        cb_sub_stop=lambda cs_sub_stop: None,
+        cb_sub_recv=lambda cs_sub_recv: None)
+    pub_sid = engine.open_pub(
+        addr='127.0.0.1',
+        port=5143,
+        cb_pub_start=lambda cs_pub_start: None,
+        cb_pub_stop=lambda cs_pub_stop: None)
+    engine.send(
+        sid=pub_sid,
+        bb=b'hello')
+    for i in range(5):
+        engine.turn(0.05)
+    #
+    d = metrics.snapshot()
+    assert d['app.pokes'] == 3
+    assert d['eng.metasocks'] == 2
+    assert d['eng.metasocks.pub'] == 1
+    assert d['eng.metasocks.sub'] == 1
+    assert d['eng.turns'] == 5
+    assert d['eng.select_wait.count'] == 5
+    assert d['sid.%s.send_bytes'%(pub_sid)] == 5
+    assert d['sid.%s.recv_bytes'%(sub_sid)] == 5
+    assert d['sid.%s.send_queue'%(pub_sid)] == 0
+    #
+    text = metrics.render_text(
+        prefix='eng.metasocks.')
+    assert 'eng.metasocks.pub 1\n' in text
+    assert 'eng.turns' not in text
+    #
+    engine.close()
+    return True
+
+@test
+def should_serve_a_dump_larger_than_the_mtu():
+    engine = Engine(
+        mtu=MTU)
+    spin_metrics_console = engine.init_spin(
+        construct=SpinMetricsConsole)
+    spin_metrics_console.start(
+        ip='127.0.0.1',
+        port=5151)
+    metrics = engine.get_metrics()
+    for i in range(200):
+        metrics.counter('app.counter_%03d'%(i)).inc(i)
+    expected = metrics.render_text(
+        prefix='app.')
+    assert len(expected) > MTU
+    #
+    acc = []
+    def cb_tcp_client_connect(cs_tcp_client_connect):
+        engine.send(
+            sid=cs_tcp_client_connect.client_sid,
+            bb=b'metrics app.\n')
+    def cb_tcp_client_recv(cs_tcp_client_recv):
+        acc.append(cs_tcp_client_recv.bb)
+    engine.open_tcp_client(
+        addr='127.0.0.1',
+        port=5151,
+        cb_tcp_client_connect=cb_tcp_client_connect,
+        cb_tcp_client_condrop=lambda cs_tcp_client_condrop: None,
+        cb_tcp_client_recv=cb_tcp_client_recv)
+    for i in range(100):
+        engine.turn(0.01)
+        if len(b''.join(acc)) >= len(expected):
+            break
+    assert expected == b''.join(acc).decode('utf8')
+    #
+    engine.close()
+    return True
+
+if __name__ == '__main__':
+    run_tests()
@@ -0,0 +1,104 @@
+#
+# multi (testing)
+#
+# // license
+# Copyright 2016, Free Software Foundation.
+#
+# This file is part of Solent.
+#
+# Solent is free software: you can redistribute it and/or modify it under the
+# terms of the GNU Lesser General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option)
+# any later version.
+#
+# Solent is distributed in the hope that it will be useful, but WITHOUT ANY
+# WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE. See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along with
+# Solent. If not, see <http://www.gnu.org/licenses/>.
+
+
+from solent import run_tests
+from solent import test
+from solent.eng.multi import MultiSupervisor
+
+import socket
+import time
+
+MTU = 1500
+ADDR = '127.0.0.1'
+PORT = 5141
+
+class CogShard:
+    def __init__(self, engine, shard_n):
+        self.engine = engine
+        self.shard_n = shard_n
+    def cb_tcp_server_start(self, cs_tcp_server_start):
+        pass
+    def cb_tcp_server_stop(self, cs_tcp_server_stop):
+        pass
+    def cb_tcp_accept_connect(self, cs_tcp_accept_connect):
+        self.engine.send(
+            sid=cs_tcp_accept_connect.accept_sid,
+            bb=bytes([self.shard_n]))
+    def cb_tcp_accept_condrop(self, cs_tcp_accept_condrop):
+        pass
+    def cb_tcp_accept_recv(self, cs_tcp_accept_recv):
+        pass
+
+def cb_multi_init(engine, shard_n):
+    cog = CogShard(
+        engine=engine,
+        shard_n=shard_n)
+    engine.open_tcp_server(
+        addr=ADDR,
+        port=PORT,
+        cb_tcp_server_start=cog.cb_tcp_server_start,
+        cb_tcp_server_stop=cog.cb_tcp_server_stop,
+        cb_tcp_accept_connect=cog.cb_tcp_accept_connect,
+        cb_tcp_accept_condrop=cog.cb_tcp_accept_condrop,
+        cb_tcp_accept_recv=cog.cb_tcp_accept_recv,
+        reuseport=True)
+
+def ask_for_shard_n():
+    sock = socket.create_connection((ADDR, PORT), timeout=2)
+    try:
+        return sock.recv(1)[0]
+    finally:
+        sock.close()
+
+@test
+def should_serve_one_port_from_several_processes():
+    if not hasattr(socket, 'SO_REUSEPORT'):
+        return True
+    supervisor = MultiSupervisor(
+        shard_count=2,
+        mtu=MTU,
+        cb_multi_init=cb_multi_init)
+    supervisor.start()
+    try:
+        #
+        # Wait for the shards to be listening.
+        shard_n = None
+        for i in range(50):
+            try:
+                shard_n = ask_for_shard_n()
+                break
+            except ConnectionRefusedError:
+                time.sleep(0.05)
+        assert shard_n in (0, 1), "no shard answered on port %s"%(PORT)
+        for i in range(20):
+            assert ask_for_shard_n() in (0, 1)
+    finally:
+        supervisor.stop()
+        exit_codes = supervisor.wait()
+    #
+    # Both shards shut down cleanly.
+    assert [0, 0] == exit_codes
+    #
+    return True
+
+if __name__ == '__main__':
+    run_tests()
@@ -0,0 +1,260 @@
+# // license
+# Copyright 2016, Free Software Foundation.
+#
+# This file is part of Solent.
+#
+# Solent is free software: you can redistribute it and/or modify it under the
+# terms of the GNU Lesser General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option)
+# any later version.
+#
+# Solent is distributed in the hope that it will be useful, but WITHOUT ANY
+# WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE. See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along with
+# Solent. If not, see <http://www.gnu.org/licenses/>.
+
+from solent import run_tests
+from solent import test
+from solent.eng import Engine
+from solent.eng import SimEngine
+from solent.eng.nearcast_bridge import decode_values
+from solent.eng.nearcast_bridge import encode_frame
+from solent.eng.nearcast_bridge import FRAME_HEADER
+
+import os
+import tempfile
+import time
+
+MTU = 1500
+
+I_NEARCAST = '''
+    i message h
+        i field h
+
+    message tick
+        field n
+        field price
+
+    message order
+        field h
+        field detail
+'''
+
+class CogSender:
+    def __init__(self, cog_h, orb, engine):
+        self.cog_h = cog_h
+        self.orb = orb
+        self.engine = engine
+
+class CogReceiver:
+    def __init__(self, cog_h, orb, engine):
+        self.cog_h = cog_h
+        self.orb = orb
+        self.engine = engine
+        #
+        self.acc = []
+    def on_tick(self, n, price):
+        self.acc.append( ('tick', n, price) )
+    def on_order(self, h, detail):
+        self.acc.append( ('order', h, detail) )
+
+def init_side(engine, message_hs):
+    orb = engine.init_orb(
+        i_nearcast=I_NEARCAST)
+    sender = orb.init_cog(CogSender)
+    receiver = orb.init_cog(CogReceiver)
+    bridge = orb.init_nearcast_bridge(
+        message_hs=message_hs)
+    return (orb, sender, receiver, bridge)
+
+@test
+def should_round_trip_field_values():
+    values = [None, True, False, 0, -1, 2**31, -2**63, 2**100, 1.5, 'héllo',
+        b'\x00\xff', [1, 'a'], (2, None), {'k': [1.0]}]
+    out = bytearray()
+    encode_frame(out, 3, values)
+    (size, idx) = FRAME_HEADER.unpack_from(out, 0)
+    assert 3 == idx
+    assert len(out) == size + 4
+    got = decode_values(out, FRAME_HEADER.size, len(out))
+    assert values == got
+    assert tuple == type(got[12])
+    #
+    try:
+        encode_frame(out, 3, [object()])
+        raise Exception("should have refused the object")
+    except Exception as e:
+        assert 'Cannot send a object' in str(e)
+    #
+    return True
+
+@test
+def should_carry_selected_messages_in_order():
+    engine = SimEngine(
+        mtu=1500)
+    (orb_a, sender_a, receiver_a, bridge_a) = init_side(engine, ['tick'])
+    (orb_b, sender_b, receiver_b, bridge_b) = init_side(engine, ['tick', 'order'])
+    #
+    # Messages sent before there is a peer wait for it.
+    sender_a.nearcast.tick(
+        n=0,
+        price=0.0)
+    engine.run_for(0.1)
+    assert 1 == len(receiver_a.acc)
+    assert 0 < bridge_a.get_backlog()
+    #
+    bridge_a.open_tcp_server(
+        addr='127.0.0.1',
+        port=5150)
+    bridge_b.open_tcp_client(
+        addr='127.0.0.1',
+        port=5150)
+    engine.run_for(0.1)
+    assert bridge_a.is_connected()
+    assert bridge_b.is_connected()
+    assert 0 == bridge_a.get_backlog()
+    #
+    for n in range(1, 200):
+        sender_a.nearcast.tick(
+            n=n,
+            price=n / 2.0)
+    batch = orb_a.init_batch(
+        cog=sender_a,
+        message_h='tick',
+        typecodes={'n': 'q'})
+    batch.append(200, 100.0)
+    batch.append(201, 100.5)
+    batch.send()
+    # order is not selected on a, so it stays local.
+    sender_a.nearcast.order(
+        h='o1',
+        detail={'qty': 1})
+    engine.run_for(0.1)
+    expected = [('tick', n, n / 2.0) for n in range(202)]
+    assert expected == receiver_b.acc
+    #
+    # b selects both messages. It does not send a's ticks back, but it does
+    # send its own messages.
+    del receiver_a.acc[:]
+    sender_b.nearcast.order(
+        h='o2',
+        detail={'qty': 2})
+    engine.run_for(0.1)
+    assert [('order', 'o2', {'qty': 2})] == receiver_a.acc
+    #
+    engine.close()
+    return True
+
+@test
+def should_hold_messages_while_the_peer_is_slow():
+    engine = SimEngine(
+        mtu=1500)
+    engine.set_sim_latency(0.01)
+    (orb_a, sender_a, receiver_a, bridge_a) = init_side(engine, ['tick'])
+    (orb_b, sender_b, receiver_b, bridge_b) = init_side(engine, [])
+    bridge_a.open_tcp_server(
+        addr='127.0.0.1',
+        port=5152)
+    bridge_b.open_tcp_client(
+        addr='127.0.0.1',
+        port=5152)
+    engine.run_for(0.1)
+    assert bridge_a.is_connected()
+    engine.set_send_watermarks(
+        sid=bridge_a.peer_sid,
+        high=3000,
+        low=0)
+    #
+    # The engine only takes what fits under the watermark. The rest waits
+    # in the bridge until the queue drains.
+    for n in range(500):
+        sender_a.nearcast.tick(
+            n=n,
+            price=0.5)
+    engine.turn(
+        timeout=0)
+    assert bridge_a.b_pressure
+    assert engine.get_send_queue_depth(bridge_a.peer_sid) <= 3000 + MTU
+    assert 0 < bridge_a.get_backlog()
+    engine.run_for(0.5)
+    assert [n for (_, n, _) in receiver_b.acc] == list(range(500))
+    assert 0 == bridge_a.get_backlog()
+    #
+    # The backlog is bounded. Beyond it, messages are dropped.
+    del receiver_b.acc[:]
+    bridge_a.max_backlog = 6000
+    for n in range(1000):
+        sender_a.nearcast.tick(
+            n=n,
+            price=0.5)
+    engine.turn(
+        timeout=0)
+    assert bridge_a.get_backlog() < 6000 + 100
+    engine.run_for(0.5)
+    ns = [n for (_, n, _) in receiver_b.acc]
+    assert 0 < len(ns) < 1000
+    assert ns == sorted(ns)
+    #
+    engine.close()
+    return True
+
+@test
+def should_refuse_a_peer_with_another_schema():
+    engine = SimEngine(
+        mtu=1500)
+    (orb_a, sender_a, receiver_a, bridge_a) = init_side(engine, ['tick'])
+    orb_b = engine.init_orb(
+        i_nearcast='''
+            i message h
+                i field h
+            message tick
+                field n
+        ''')
+    bridge_b = orb_b.init_nearcast_bridge(
+        message_hs=['tick'])
+    bridge_a.open_unix_server(
+        path='/sim/bridge')
+    bridge_b.open_unix_client(
+        path='/sim/bridge')
+    engine.run_for(0.1)
+    assert not bridge_a.is_connected()
+    assert not bridge_b.is_connected()
+    #
+    engine.close()
+    return True
+
+@test
+def should_bridge_over_a_unix_socket():
+    path = os.path.join(
+        tempfile.mkdtemp(),
+        'bridge')
+    engine = Engine(
+        mtu=1500)
+    try:
+        (orb_a, sender_a, receiver_a, bridge_a) = init_side(engine, ['order'])
+        (orb_b, sender_b, receiver_b, bridge_b) = init_side(engine, [])
+        bridge_a.open_unix_server(
+            path=path)
+        bridge_b.open_unix_client(
+            path=path)
+        # Larger than the mtu, so that it goes in pieces.
+        detail = 'x' * 4000
+        sender_a.nearcast.order(
+            h='o1',
+            detail=detail)
+        t_end = time.time() + 2
+        while not receiver_b.acc and time.time() < t_end:
+            engine.turn(
+                timeout=0.01)
+        assert [('order', 'o1', detail)] == receiver_b.acc
+    finally:
+        engine.close()
+        os.rmdir(os.path.dirname(path))
+    #
+    return True
+
+if __name__ == '__main__':
+    run_tests()
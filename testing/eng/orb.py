@@ -18,8 +18,13 @@
 
 from solent import run_tests
 from solent import test
+from solent import get_log_level
+from solent import set_log_level
+from solent import LOG_WARN
+from solent.eng import SimEngine
 
-from fake import FakeEngine
+import os
+import tempfile
 
 I_NEARCAST_EXAMPLE = '''
     i message h
@@ -42,12 +47,542 @@ I_NEARCAST_EXAMPLE = '''
 
 @test
 def should_construct():
-    engine = FakeEngine()
+    engine = SimEngine(
+        mtu=1500)
     orb = engine.init_orb(
         i_nearcast=I_NEARCAST_EXAMPLE)
+    engine.close()
     #
     return True
 
+ACC = []
+
+class TrackPeople:
+    def __init__(self, orb):
+        self.orb = orb
+        #
+        self.count = 0
+    def on_person(self, h, firstname, lastname, age, organisation_h):
+        self.count += 1
+        ACC.append( ('track', firstname) )
+
+class CogPeople:
+    def __init__(self, cog_h, orb, engine):
+        self.cog_h = cog_h
+        self.orb = orb
+        self.engine = engine
+    def on_person(self, h, firstname, lastname, age, organisation_h):
+        ACC.append( (self.cog_h, firstname) )
+
+class CogOrganisations:
+    def __init__(self, cog_h, orb, engine):
+        self.cog_h = cog_h
+        self.orb = orb
+        self.engine = engine
+        #
+        self.track_people = orb.track(TrackPeople)
+    def on_organisation(self, h, name, address):
+        ACC.append( (self.cog_h, name) )
+
+def nearcast_person(orb, cog, firstname):
+    orb.nearcast(
+        cog=cog,
+        message_h='person',
+        h='p',
+        firstname=firstname,
+        lastname='l',
+        age=1,
+        organisation_h='o')
+
+@test
+def should_dispatch_only_to_consumers_and_to_cogs_added_later():
+    engine = SimEngine(
+        mtu=1500)
+    orb = engine.init_orb(
+        i_nearcast=I_NEARCAST_EXAMPLE)
+    cog_organisations = orb.init_cog(CogOrganisations)
+    del ACC[:]
+    #
+    nearcast_person(orb, cog_organisations, 'ann')
+    orb.nearcast(
+        cog=cog_organisations,
+        message_h='organisation',
+        h='o',
+        name='acme',
+        address='a')
+    orb.distribute()
+    assert [('track', 'ann'), ('CogOrganisations', 'acme')] == ACC
+    #
+    # A cog that arrives later hears what follows, after the track.
+    orb.init_cog(CogPeople)
+    del ACC[:]
+    nearcast_person(orb, cog_organisations, 'bob')
+    orb.distribute()
+    assert [('track', 'bob'), ('CogPeople', 'bob')] == ACC
+    assert 2 == cog_organisations.track_people.count
+    #
+    engine.close()
+    return True
+
+@test
+def should_check_nearcast_fields_only_in_strict_mode():
+    engine = SimEngine(
+        mtu=1500)
+    orb = engine.init_orb(
+        i_nearcast=I_NEARCAST_EXAMPLE)
+    cog = orb.init_cog(CogPeople)
+    del ACC[:]
+    #
+    # The generated sender queues the message directly.
+    cog.nearcast.person(
+        h='p',
+        firstname='cat',
+        lastname='l',
+        age=1,
+        organisation_h='o')
+    orb.distribute()
+    assert [('CogPeople', 'cat')] == ACC
+    #
+    # Without strict mode, a missing field is still caught when the record
+    # is filled, but with python's own error.
+    try:
+        orb.nearcast(
+            cog=cog,
+            message_h='organisation',
+            h='o')
+        raise Exception("should have refused this")
+    except TypeError:
+        pass
+    orb.strict_on()
+    try:
+        orb.nearcast(
+            cog=cog,
+            message_h='organisation',
+            h='o')
+        raise Exception("strict mode should have refused this")
+    except Exception as e:
+        assert 'inconsistent fields' in str(e)
+    # Senders that already exist go through the checks now too.
+    cog.nearcast.person(
+        h='p',
+        firstname='dan',
+        lastname='l',
+        age=1,
+        organisation_h='o')
+    orb.distribute()
+    assert ('CogPeople', 'dan') == ACC[-1]
+    #
+    engine.close()
+    return True
+
+@test
+def should_refuse_a_schema_that_cannot_be_a_sender():
+    engine = SimEngine(
+        mtu=1500)
+    orb = engine.init_orb(
+        i_nearcast='''
+            i message h
+                i field h
+            message class
+                field h
+        ''')
+    class CogQuiet:
+        def __init__(self, cog_h, orb, engine):
+            self.cog_h = cog_h
+            self.orb = orb
+            self.engine = engine
+    try:
+        orb.init_cog(CogQuiet)
+        raise Exception("should have refused the schema")
+    except Exception as e:
+        assert 'cannot be a nearcast name' in str(e)
+    #
+    engine.close()
+    return True
+
+@test
+def should_recycle_records_and_dispatch_positionally():
+    engine = SimEngine(
+        mtu=1500)
+    orb = engine.init_orb(
+        i_nearcast=I_NEARCAST_EXAMPLE)
+    cog = orb.init_cog(CogPeople)
+    del ACC[:]
+    record_class = orb.nearcast_schema.get_record_class('person')
+    assert ('h', 'firstname', 'lastname', 'age', 'organisation_h') == record_class.fields
+    assert not hasattr(record_class(), '__dict__')
+    #
+    # Records queue until distribute, and then go back to the pool with
+    # their fields cleared.
+    for firstname in ('ann', 'bob', 'cat'):
+        cog.nearcast.person(
+            h='p',
+            firstname=firstname,
+            lastname='l',
+            age=1,
+            organisation_h='o')
+    records = list(orb.ready_to_nearcast)
+    assert 3 == len(records)
+    assert 'bob' == records[1].firstname
+    assert {'h': 'p', 'firstname': 'bob', 'lastname': 'l', 'age': 1,
+        'organisation_h': 'o'} == records[1].to_dict()
+    orb.distribute()
+    assert [('CogPeople', 'ann'), ('CogPeople', 'bob'), ('CogPeople', 'cat')] == ACC
+    assert 3 == len(record_class.pool)
+    for record in records:
+        assert record in record_class.pool
+        assert None == record.firstname
+    #
+    # The next message reuses one of them.
+    cog.nearcast.person(
+        h='p',
+        firstname='dan',
+        lastname='l',
+        age=1,
+        organisation_h='o')
+    assert 2 == len(record_class.pool)
+    assert orb.ready_to_nearcast[0] in records
+    orb.distribute()
+    assert ('CogPeople', 'dan') == ACC[-1]
+    #
+    engine.close()
+    return True
+
+@test
+def should_refuse_a_field_that_a_record_needs():
+    engine = SimEngine(
+        mtu=1500)
+    orb = engine.init_orb(
+        i_nearcast='''
+            i message h
+                i field h
+            message hello
+                field release
+        ''')
+    try:
+        orb.nearcast_schema.get_record_class('hello')
+        raise Exception("should have refused the schema")
+    except Exception as e:
+        assert 'reserved' in str(e)
+    #
+    engine.close()
+    return True
+
+@test
+def should_deliver_fields_that_share_names_with_generated_code():
+    engine = SimEngine(
+        mtu=1500)
+    orb = engine.init_orb(
+        i_nearcast='''
+            i message h
+                i field h
+            message note
+                field record
+                field pool_note
+                field Record_note
+        ''')
+    class CogNotes:
+        def __init__(self, cog_h, orb, engine):
+            self.cog_h = cog_h
+            self.orb = orb
+            self.engine = engine
+        def on_note(self, record, pool_note, Record_note):
+            ACC.append( (record, pool_note, Record_note) )
+    cog = orb.init_cog(CogNotes)
+    del ACC[:]
+    for i in range(2):
+        cog.nearcast.note(
+            record='r%s'%i,
+            pool_note='p',
+            Record_note='c')
+        orb.distribute()
+    orb.nearcast(
+        cog=cog,
+        message_h='note',
+        record='r2',
+        pool_note='p',
+        Record_note='c')
+    orb.distribute()
+    assert [('r0', 'p', 'c'), ('r1', 'p', 'c'), ('r2', 'p', 'c')] == ACC
+    #
+    engine.close()
+    return True
+
+@test
+def should_deliver_messages_that_share_names_with_the_dispatcher():
+    engine = SimEngine(
+        mtu=1500)
+    orb = engine.init_orb(
+        i_nearcast='''
+            i message h
+                i field h
+            message wake
+                field n
+            message append
+                field n
+            message cog_h
+                field n
+            message orb
+                field n
+            message cog
+                field n
+        ''')
+    class CogNames:
+        def __init__(self, cog_h, orb, engine):
+            self.cog_h = cog_h
+            self.orb = orb
+            self.engine = engine
+        def on_wake(self, n):
+            ACC.append( ('wake', n) )
+        def on_append(self, n):
+            ACC.append( ('append', n) )
+        def on_cog_h(self, n):
+            ACC.append( ('cog_h', n) )
+        def on_orb(self, n):
+            ACC.append( ('orb', n) )
+        def on_cog(self, n):
+            ACC.append( ('cog', n) )
+    cog = orb.init_cog(CogNames)
+    expected = [('wake', 1), ('append', 2), ('cog_h', 3), ('orb', 4), ('cog', 5)]
+    for b_strict in (False, True):
+        if b_strict:
+            orb.strict_on()
+        del ACC[:]
+        cog.nearcast.wake(
+            n=1)
+        cog.nearcast.append(
+            n=2)
+        cog.nearcast.cog_h(
+            n=3)
+        cog.nearcast.orb(
+            n=4)
+        cog.nearcast.cog(
+            n=5)
+        orb.distribute()
+        assert expected == ACC
+    #
+    engine.close()
+    return True
+
+@test
+def should_refuse_a_field_in_the_generated_namespace():
+    engine = SimEngine(
+        mtu=1500)
+    orb = engine.init_orb(
+        i_nearcast='''
+            i message h
+                i field h
+            message note
+                field _nc_record
+        ''')
+    try:
+        orb.nearcast_schema.get_record_class('note')
+        raise Exception("should have refused the schema")
+    except Exception as e:
+        assert 'reserved' in str(e)
+    #
+    engine.close()
+    return True
+
+@test
+def should_file_snoop_whatever_the_log_level():
+    (fd, filename) = tempfile.mkstemp()
+    os.close(fd)
+    prev_level = get_log_level()
+    set_log_level(LOG_WARN)
+    try:
+        engine = SimEngine(
+            mtu=1500)
+        orb = engine.init_orb(
+            i_nearcast=I_NEARCAST_EXAMPLE)
+        orb.add_file_snoop(
+            filename=filename)
+        cog = orb.init_cog(CogPeople)
+        nearcast_person(orb, cog, 'ann')
+        orb.distribute()
+        engine.close()
+        with open(filename) as f_ptr:
+            text = f_ptr.read()
+        assert 'firstname:ann' in text
+    finally:
+        set_log_level(prev_level)
+        os.remove(filename)
+    #
+    return True
+
+I_NEARCAST_TICKS = '''
+    i message h
+        i field h
+
+    message tick
+        field n
+        field price
+'''
+
+class TrackTicks:
+    def __init__(self, orb):
+        self.orb = orb
+        #
+        self.count = 0
+    def on_tick(self, n, price):
+        self.count += 1
+
+class CogTickProducer:
+    def __init__(self, cog_h, orb, engine):
+        self.cog_h = cog_h
+        self.orb = orb
+        self.engine = engine
+
+class CogTickBatches:
+    def __init__(self, cog_h, orb, engine):
+        self.cog_h = cog_h
+        self.orb = orb
+        self.engine = engine
+        #
+        self.track_ticks = orb.track(TrackTicks)
+    def on_tick(self, n, price):
+        ACC.append( ('single', n) )
+    def on_tick__batch(self, batch):
+        ACC.append( ('batch', list(batch.column('n')), len(batch)) )
+
+class CogTickRows:
+    def __init__(self, cog_h, orb, engine):
+        self.cog_h = cog_h
+        self.orb = orb
+        self.engine = engine
+    def on_tick(self, n, price):
+        ACC.append( ('row', n, price) )
+
+@test
+def should_deliver_a_batch_whole_or_by_row():
+    engine = SimEngine(
+        mtu=1500)
+    orb = engine.init_orb(
+        i_nearcast=I_NEARCAST_TICKS)
+    producer = orb.init_cog(CogTickProducer)
+    cog_tick_batches = orb.init_cog(CogTickBatches)
+    orb.init_cog(CogTickRows)
+    del ACC[:]
+    #
+    batch = orb.init_batch(
+        cog=producer,
+        message_h='tick',
+        typecodes={'n': 'q'})
+    batch.append(1, 'a')
+    batch.append(2, 'b')
+    batch.column('n').extend([3, 4])
+    batch.column('price').extend(['c', 'd'])
+    assert 4 == len(batch)
+    batch.send()
+    # The batch has moved on to a fresh set of columns.
+    assert 0 == len(batch)
+    batch.append(5, 'e')
+    orb.distribute()
+    assert [ ('batch', [1, 2, 3, 4], 4)
+           , ('row', 1, 'a')
+           , ('row', 2, 'b')
+           , ('row', 3, 'c')
+           , ('row', 4, 'd')
+           ] == ACC
+    assert 4 == cog_tick_batches.track_ticks.count
+    #
+    batch.send()
+    orb.distribute()
+    assert ('row', 5, 'e') == ACC[-1]
+    #
+    # Single messages go to on_tick as usual.
+    producer.nearcast.tick(
+        n=6,
+        price='f')
+    orb.distribute()
+    assert [('single', 6), ('row', 6, 'f')] == ACC[-2:]
+    #
+    engine.close()
+    return True
+
+@test
+def should_refuse_inconsistent_batches():
+    engine = SimEngine(
+        mtu=1500)
+    orb = engine.init_orb(
+        i_nearcast=I_NEARCAST_TICKS)
+    producer = orb.init_cog(CogTickProducer)
+    #
+    batch = orb.init_batch(
+        cog=producer,
+        message_h='tick')
+    try:
+        batch.append(1)
+        raise Exception("should have refused the row")
+    except Exception as e:
+        assert 'values' in str(e)
+    batch.column('n').append(1)
+    try:
+        batch.send()
+        raise Exception("should have refused the batch")
+    except Exception as e:
+        assert 'different lengths' in str(e)
+    try:
+        orb.init_batch(
+            cog=producer,
+            message_h='tick',
+            typecodes={'volume': 'q'})
+        raise Exception("should have refused the typecode")
+    except Exception as e:
+        assert 'no field volume' in str(e)
+    #
+    class CogTickBad:
+        def __init__(self, cog_h, orb, engine):
+            self.cog_h = cog_h
+        def on_tick__batch(self, n, price):
+            pass
+    try:
+        orb.init_cog(CogTickBad)
+        raise Exception("should have refused the handler")
+    except Exception as e:
+        assert 'one arg' in str(e)
+    #
+    engine.close()
+    return True
+
+class CogTickViews:
+    '''
+    Keeps a view of each batch's n column, as numpy.frombuffer would.
+    '''
+    def __init__(self, cog_h, orb, engine):
+        self.cog_h = cog_h
+        self.orb = orb
+        self.engine = engine
+        #
+        self.views = []
+    def on_tick__batch(self, batch):
+        self.views.append(memoryview(batch.column('n')))
+
+@test
+def should_leave_batch_columns_valid_for_handlers_that_keep_them():
+    engine = SimEngine(
+        mtu=1500)
+    orb = engine.init_orb(
+        i_nearcast=I_NEARCAST_TICKS)
+    producer = orb.init_cog(CogTickProducer)
+    cog_tick_views = orb.init_cog(CogTickViews)
+    #
+    batch = orb.init_batch(
+        cog=producer,
+        message_h='tick',
+        typecodes={'n': 'q'})
+    for start in (0, 10):
+        for n in range(start, start + 3):
+            batch.append(n, 'p')
+        batch.send()
+        orb.distribute()
+    views = cog_tick_views.views
+    assert [0, 1, 2] == views[0].tolist()
+    assert [10, 11, 12] == views[1].tolist()
+    #
+    engine.close()
+    return True
+
 if __name__ == '__main__':
     run_tests()
 
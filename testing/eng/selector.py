@@ -0,0 +1,82 @@
+#
+# selector (testing)
+#
+# // license
+# Copyright 2016, Free Software Foundation.
+#
+# This file is part of Solent.
+#
+# Solent is free software: you can redistribute it and/or modify it under the
+# terms of the GNU Lesser General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option)
+# any later version.
+#
+# Solent is distributed in the hope that it will be useful, but WITHOUT ANY
+# WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE. See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along with
+# Solent. If not, see <http://www.gnu.org/licenses/>.
+
+from solent import run_tests
+from solent import test
+from solent.eng.selector import init_selector
+from solent.eng.selector import SELECTOR_READ
+from solent.eng.selector import SELECTOR_WRITE
+
+import select
+import socket
+
+def available_selector_hs():
+    lst = ['select']
+    if hasattr(select, 'poll'):
+        lst.append('poll')
+    if hasattr(select, 'epoll'):
+        lst.append('epoll')
+    return lst
+
+@test
+def should_report_readable_and_writable():
+    for selector_h in available_selector_hs():
+        selector = init_selector(
+            selector_h=selector_h)
+        (sock_a, sock_b) = socket.socketpair()
+        fd_a = sock_a.fileno()
+        #
+        # Nothing to read yet, but we can write.
+        selector.register(
+            fd=fd_a,
+            mask=SELECTOR_READ|SELECTOR_WRITE)
+        events = dict(selector.select(0))
+        assert events[fd_a] == SELECTOR_WRITE
+        #
+        # Drop write interest, and supply something to read.
+        selector.modify(
+            fd=fd_a,
+            mask=SELECTOR_READ)
+        sock_b.send(b'x')
+        events = dict(selector.select(1))
+        assert events[fd_a] == SELECTOR_READ
+        #
+        # Once unregistered, we hear nothing.
+        selector.unregister(
+            fd=fd_a)
+        assert 0 == selector.count()
+        #
+        selector.close()
+        sock_a.close()
+        sock_b.close()
+    #
+    return True
+
+@test
+def should_default_to_the_best_available_mechanism():
+    selector = init_selector()
+    assert selector.selector_h == available_selector_hs()[-1]
+    selector.close()
+    #
+    return True
+
+if __name__ == '__main__':
+    run_tests()
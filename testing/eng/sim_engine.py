@@ -0,0 +1,186 @@
+#
+# sim_engine (testing)
+#
+# // license
+# Copyright 2016, Free Software Foundation.
+#
+# This file is part of Solent.
+#
+# Solent is free software: you can redistribute it and/or modify it under the
+# terms of the GNU Lesser General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option)
+# any later version.
+#
+# Solent is distributed in the hope that it will be useful, but WITHOUT ANY
+# WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE. See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along with
+# Solent. If not, see <http://www.gnu.org/licenses/>.
+
+from solent import run_tests
+from solent import test
+from solent.eng import SimEngine
+
+import time
+
+MTU = 1500
+
+def noop(**kwargs):
+    pass
+
+class EchoPair:
+    '''
+    Server echoes, and the client records what comes back along with the
+    time it arrived.
+    '''
+    def __init__(self, engine):
+        self.engine = engine
+        #
+        self.client_sid = None
+        self.acc_recv = []
+        self.acc_condrop = []
+        self.acc_accept_condrop = []
+    def cb_tcp_accept_connect(self, cs_tcp_accept_connect):
+        pass
+    def cb_tcp_accept_condrop(self, cs_tcp_accept_condrop):
+        self.acc_accept_condrop.append(cs_tcp_accept_condrop.message)
+    def cb_tcp_accept_recv(self, cs_tcp_accept_recv):
+        self.engine.send(
+            sid=cs_tcp_accept_recv.accept_sid,
+            bb=cs_tcp_accept_recv.bb)
+    def cb_tcp_client_connect(self, cs_tcp_client_connect):
+        self.client_sid = cs_tcp_client_connect.client_sid
+    def cb_tcp_client_condrop(self, cs_tcp_client_condrop):
+        self.acc_condrop.append(cs_tcp_client_condrop.message)
+    def cb_tcp_client_recv(self, cs_tcp_client_recv):
+        self.acc_recv.append( (self.engine.clock.now(), cs_tcp_client_recv.bb) )
+
+def open_echo_pair(engine, port):
+    pair = EchoPair(
+        engine=engine)
+    engine.open_tcp_server(
+        addr='127.0.0.1',
+        port=port,
+        cb_tcp_server_start=noop,
+        cb_tcp_server_stop=noop,
+        cb_tcp_accept_connect=pair.cb_tcp_accept_connect,
+        cb_tcp_accept_condrop=pair.cb_tcp_accept_condrop,
+        cb_tcp_accept_recv=pair.cb_tcp_accept_recv)
+    engine.open_tcp_client(
+        addr='127.0.0.1',
+        port=port,
+        cb_tcp_client_connect=pair.cb_tcp_client_connect,
+        cb_tcp_client_condrop=pair.cb_tcp_client_condrop,
+        cb_tcp_client_recv=pair.cb_tcp_client_recv)
+    return pair
+
+@test
+def should_run_hours_of_timers_in_moments():
+    engine = SimEngine(
+        mtu=MTU)
+    acc = []
+    def cb_eng_timer(cs_eng_timer):
+        acc.append(cs_eng_timer.at_t)
+    engine.open_timer(
+        delay=1.0,
+        b_recurring=True,
+        cb_eng_timer=cb_eng_timer)
+    t_start = time.time()
+    engine.run_for(3600)
+    assert time.time() - t_start < 10
+    assert 3600 == engine.clock.now()
+    assert 3600 == len(acc)
+    assert [1.0, 2.0, 3.0] == acc[:3]
+    #
+    engine.close()
+    return True
+
+@test
+def should_carry_tcp_with_simulated_latency():
+    engine = SimEngine(
+        mtu=MTU)
+    engine.set_sim_latency(0.01)
+    pair = open_echo_pair(
+        engine=engine,
+        port=4000)
+    engine.run_for(0.05)
+    assert pair.client_sid != None
+    #
+    t_send = engine.clock.now()
+    engine.send(
+        sid=pair.client_sid,
+        bb=b'hello')
+    assert 5 == engine.get_send_queue_depth(pair.client_sid)
+    engine.run_for(0.1)
+    assert 1 == len(pair.acc_recv)
+    (t_recv, bb) = pair.acc_recv[0]
+    assert b'hello' == bb
+    # There and back.
+    assert abs(t_recv - t_send - 0.02) < 1e-9
+    assert 0 == engine.get_send_queue_depth(pair.client_sid)
+    #
+    # Closing our end is seen by the other side.
+    engine.close_tcp_client(
+        client_sid=pair.client_sid)
+    engine.run_for(0.1)
+    assert 1 == len(pair.acc_condrop)
+    assert ['empty_recv'] == pair.acc_accept_condrop
+    #
+    engine.close()
+    return True
+
+@test
+def should_refuse_a_connection_when_nothing_listens():
+    engine = SimEngine(
+        mtu=MTU)
+    acc = []
+    def cb_tcp_client_condrop(cs_tcp_client_condrop):
+        acc.append(cs_tcp_client_condrop.message)
+    engine.open_tcp_client(
+        addr='127.0.0.1',
+        port=4001,
+        cb_tcp_client_connect=noop,
+        cb_tcp_client_condrop=cb_tcp_client_condrop,
+        cb_tcp_client_recv=noop)
+    engine.cycle()
+    assert 1 == len(acc)
+    assert 'ECONNREFUSED' in acc[0]
+    #
+    engine.close()
+    return True
+
+@test
+def should_deliver_datagrams_in_order_to_every_sub():
+    engine = SimEngine(
+        mtu=MTU)
+    acc = []
+    for name in ('a', 'b'):
+        def cb_sub_recv(cs_sub_recv, name=name):
+            acc.append( (name, cs_sub_recv.bb) )
+        engine.open_mcast_sub(
+            addr='239.1.1.1',
+            port=4002,
+            cb_sub_start=noop,
+            cb_sub_stop=noop,
+            cb_sub_recv=cb_sub_recv)
+    pub_sid = engine.open_mcast_pub(
+        addr='239.1.1.1',
+        port=4002,
+        cb_pub_start=noop,
+        cb_pub_stop=noop)
+    for i in range(3):
+        engine.send(
+            sid=pub_sid,
+            bb=str(i).encode())
+    engine.cycle()
+    assert [('a', b'0'), ('b', b'0'),
+            ('a', b'1'), ('b', b'1'),
+            ('a', b'2'), ('b', b'2')] == acc
+    #
+    engine.close()
+    return True
+
+if __name__ == '__main__':
+    run_tests()
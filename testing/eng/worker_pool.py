@@ -0,0 +1,166 @@
+#
+# worker_pool (testing)
+#
+# // license
+# Copyright 2016, Free Software Foundation.
+#
+# This file is part of Solent.
+#
+# Solent is free software: you can redistribute it and/or modify it under the
+# terms of the GNU Lesser General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option)
+# any later version.
+#
+# Solent is distributed in the hope that it will be useful, but WITHOUT ANY
+# WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE. See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along with
+# Solent. If not, see <http://www.gnu.org/licenses/>.
+
+
+from solent import Engine
+from solent import run_tests
+from solent import test
+from solent.eng import SpinWorkerPool
+
+import threading
+
+MTU = 1500
+
+class Receiver:
+    def __init__(self):
+        self.acc = {}
+    def cb_worker_done(self, cs_worker_done):
+        engine = cs_worker_done.engine
+        job_h = cs_worker_done.job_h
+        result = cs_worker_done.result
+        exception = cs_worker_done.exception
+        #
+        self.acc[job_h] = (result, exception, threading.get_ident())
+
+def square(n):
+    return n*n
+
+def fail():
+    raise Exception("no")
+
+@test
+def should_deliver_results_on_the_loop_thread():
+    engine = Engine(
+        mtu=MTU)
+    spin_worker_pool = engine.init_spin(
+        construct=SpinWorkerPool,
+        worker_count=3)
+    receiver = Receiver()
+    #
+    d_expect = {}
+    for n in range(10):
+        job_h = spin_worker_pool.submit(
+            fn=square,
+            cb_worker_done=receiver.cb_worker_done,
+            n=n)
+        d_expect[job_h] = n*n
+    fail_h = spin_worker_pool.submit(
+        fn=fail,
+        cb_worker_done=receiver.cb_worker_done)
+    #
+    for i in range(50):
+        if 0 == spin_worker_pool.count_pending():
+            break
+        engine.turn(0.1)
+    assert 11 == len(receiver.acc)
+    loop_ident = threading.get_ident()
+    for (job_h, n) in d_expect.items():
+        (result, exception, ident) = receiver.acc[job_h]
+        assert result == n
+        assert exception == None
+        assert ident == loop_ident
+    (result, exception, ident) = receiver.acc[fail_h]
+    assert result == None
+    assert str(exception) == 'no'
+    #
+    engine.close()
+    for thread in spin_worker_pool.threads:
+        assert not thread.is_alive()
+    #
+    return True
+
+@test
+def should_drop_jobs_that_have_not_started_on_close():
+    engine = Engine(
+        mtu=MTU)
+    spin_worker_pool = engine.init_spin(
+        construct=SpinWorkerPool,
+        worker_count=1)
+    receiver = Receiver()
+    started = threading.Event()
+    release = threading.Event()
+    def block():
+        started.set()
+        release.wait(5)
+    acc_ran = []
+    def record(n):
+        acc_ran.append(n)
+    spin_worker_pool.submit(
+        fn=block,
+        cb_worker_done=receiver.cb_worker_done)
+    for n in range(20):
+        spin_worker_pool.submit(
+            fn=record,
+            cb_worker_done=receiver.cb_worker_done,
+            n=n)
+    assert started.wait(5)
+    #
+    # Release the running job only once close has had time to drop the
+    # queue.
+    timer = threading.Timer(0.1, release.set)
+    timer.start()
+    engine.close()
+    timer.join()
+    assert [] == acc_ran
+    assert {} == receiver.acc
+    for thread in spin_worker_pool.threads:
+        assert not thread.is_alive()
+    #
+    return True
+
+def leave():
+    raise SystemExit(3)
+
+@test
+def should_report_a_job_that_ends_its_worker():
+    engine = Engine(
+        mtu=MTU)
+    spin_worker_pool = engine.init_spin(
+        construct=SpinWorkerPool,
+        worker_count=2)
+    receiver = Receiver()
+    leave_h = spin_worker_pool.submit(
+        fn=leave,
+        cb_worker_done=receiver.cb_worker_done)
+    for i in range(50):
+        if 0 == spin_worker_pool.count_pending():
+            break
+        engine.turn(0.1)
+    assert 0 == spin_worker_pool.count_pending()
+    (result, exception, ident) = receiver.acc[leave_h]
+    assert result == None
+    assert SystemExit == type(exception)
+    # The job took its thread with it, but the other worker carries on.
+    job_h = spin_worker_pool.submit(
+        fn=square,
+        cb_worker_done=receiver.cb_worker_done,
+        n=4)
+    for i in range(50):
+        if 0 == spin_worker_pool.count_pending():
+            break
+        engine.turn(0.1)
+    assert 16 == receiver.acc[job_h][0]
+    #
+    engine.close()
+    return True
+
+if __name__ == '__main__':
+    run_tests()
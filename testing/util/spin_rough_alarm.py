@@ -0,0 +1,60 @@
+# // license
+# Copyright 2016, Free Software Foundation.
+#
+# This file is part of Solent.
+#
+# Solent is free software: you can redistribute it and/or modify it under the
+# terms of the GNU Lesser General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option)
+# any later version.
+#
+# Solent is distributed in the hope that it will be useful, but WITHOUT ANY
+# WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE. See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along with
+# Solent. If not, see <http://www.gnu.org/licenses/>.
+
+from solent import Engine
+from solent import run_tests
+from solent import test
+from solent.util import SpinRoughAlarm
+
+MTU = 1500
+
+class Receiver:
+    def __init__(self):
+        self.acc = []
+    def cb_alarm_event(self, cs_alarm_event):
+        self.acc.append(cs_alarm_event.value)
+
+@test
+def should_ring_alarms_without_being_polled():
+    engine = Engine(
+        mtu=MTU)
+    spin_rough_alarm = engine.init_spin(
+        construct=SpinRoughAlarm)
+    assert spin_rough_alarm.spin_h not in engine.polled_spins
+    receiver = Receiver()
+    now = engine.clock.now()
+    spin_rough_alarm.book_time(
+        cb_alarm_event=receiver.cb_alarm_event,
+        value='second',
+        at_t=now + 0.06)
+    spin_rough_alarm.book_time(
+        cb_alarm_event=receiver.cb_alarm_event,
+        value='first',
+        at_t=now + 0.03)
+    for i in range(50):
+        engine.turn(0.05)
+        if 2 == len(receiver.acc):
+            break
+    assert ['first', 'second'] == receiver.acc
+    assert [] == engine.runnable_spins
+    #
+    engine.close()
+    return True
+
+if __name__ == '__main__':
+    run_tests()